@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+'''
+Benchmarks rpisurv on any linux machine, no raspberry pi or cameras needed.
+
+cvlc, pngview, ffprobe, vcgencmd and tvservice are replaced by the stubs in benchmark/stubs and every camera is a local stub rtsp
+or http snapshot server with configurable latency and failure rate. The benchmark drives the real ScreenManager through rotations and
+reports the time until the first screen is shown, probe throughput, rotation latency, process counts and cpu time.
+
+Example:
+    python3 benchmark/run_benchmark.py --screens 4 --rtsp-streams 9 --rotations 20 --rtsp-latency 0.05 --rtsp-failure-rate 0.1
+'''
+import argparse
+import json
+import logging
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import yaml
+
+from stubservers import StubRTSPServer, StubHTTPSnapshotServer
+
+benchmark_dir = os.path.dirname(os.path.abspath(__file__))
+stubs_dir = os.path.join(benchmark_dir, "stubs")
+source_dir = os.path.join(os.path.dirname(benchmark_dir), "surveillance")
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark rpisurv with stub players and local stub cameras")
+    parser.add_argument("--displays", type=int, default=1, choices=[1, 2], help="number of hdmi displays reported by the tvservice stub")
+    parser.add_argument("--screens", type=int, default=3, help="screens per display")
+    parser.add_argument("--rtsp-streams", type=int, default=4, help="rtsp streams per screen")
+    parser.add_argument("--http-streams", type=int, default=1, help="http snapshot (imageurl) streams per screen")
+    parser.add_argument("--rtmp-streams", type=int, default=0, help="rtmp streams per screen, probed with the ffprobe stub")
+    parser.add_argument("--shared-rtsp-server", action="store_true", help="serve all rtsp streams from one server, like an NVR, instead of one server per camera")
+    parser.add_argument("--rtsp-latency", type=float, default=0.01, help="seconds before a stub rtsp server answers")
+    parser.add_argument("--rtsp-failure-rate", type=float, default=0.0, help="chance that a stub rtsp server drops a request")
+    parser.add_argument("--http-latency", type=float, default=0.01, help="seconds before a stub http server answers")
+    parser.add_argument("--http-failure-rate", type=float, default=0.0, help="chance that a stub http server answers with an error")
+    parser.add_argument("--ffprobe-latency", type=float, default=0.05, help="seconds the ffprobe stub takes")
+    parser.add_argument("--player-cpu", type=float, default=0.0, help="fraction of a cpu core every stub player burns")
+    parser.add_argument("--player-first-frame-delay", type=float, default=0.2, help="seconds until a stub player reports its first picture")
+    parser.add_argument("--player-crash-rate", type=float, default=0.0, help="chance that a stub player crashes within 30 seconds")
+    parser.add_argument("--probe-rounds", type=int, default=5, help="how many times all streams are probed in the probe throughput phase")
+    parser.add_argument("--rotations", type=int, default=10, help="rotations per display in the rotation phase")
+    parser.add_argument("--dwell", type=float, default=0.2, help="seconds to wait between two rotations")
+    parser.add_argument("--resource-budget", action="store_true", help="decide about caching with the resource budget like surveillance.py does, set its limits with --option (like max_decoder_load=6)")
+    parser.add_argument("--disable-pygame", action="store_true", help="do not draw with pygame (by default pygame draws on the dummy sdl video driver)")
+    parser.add_argument("--option", action="append", default=[], metavar="KEY=VALUE", help="extra option for the advanced section of general.yml, can be repeated")
+    parser.add_argument("--log-level", default="WARNING", help="log level of rpisurv during the benchmark")
+    parser.add_argument("--json", metavar="PATH", help="also write the results (and all rpisurv metrics) as json to PATH")
+    parser.add_argument("--keep-workdir", action="store_true", help="do not remove the generated working directory")
+    return parser.parse_args()
+
+
+def start_stub_servers(args):
+    '''Starts the stub cameras and returns (servers, camera_streams config of every screen of every display)'''
+    servers = []
+    shared_rtsp_server = None
+    if args.shared_rtsp_server:
+        shared_rtsp_server = StubRTSPServer(args.rtsp_latency, args.rtsp_failure_rate).start()
+        servers.append(shared_rtsp_server)
+    snapshot_image = os.path.join(source_dir, "demo", "resources", "demo.png")
+
+    displays_screens = []
+    for display in range(args.displays):
+        screens = []
+        for screen in range(args.screens):
+            camera_streams = []
+            for stream in range(args.rtsp_streams):
+                rtsp_server = shared_rtsp_server
+                if rtsp_server is None:
+                    rtsp_server = StubRTSPServer(args.rtsp_latency, args.rtsp_failure_rate).start()
+                    servers.append(rtsp_server)
+                camera_streams.append({"url": rtsp_server.url(f"display{display}/screen{screen}/stream{stream}")})
+            for stream in range(args.http_streams):
+                http_server = StubHTTPSnapshotServer(snapshot_image, args.http_latency, args.http_failure_rate).start()
+                servers.append(http_server)
+                camera_streams.append({"url": http_server.url(), "imageurl": True})
+            for stream in range(args.rtmp_streams):
+                camera_streams.append({"url": f"rtmp://127.0.0.1:1935/display{display}/screen{screen}/stream{stream}"})
+            screens.append({"camera_streams": camera_streams, "duration": 1})
+        displays_screens.append(screens)
+    return servers, displays_screens
+
+
+def create_workdir(args, displays_screens):
+    '''Creates a working directory with the conf directory rpisurv expects, pointing to the stub binaries'''
+    workdir = tempfile.mkdtemp(prefix="rpisurv_benchmark_")
+    os.makedirs(os.path.join(workdir, "conf"))
+    os.symlink(os.path.join(source_dir, "images"), os.path.join(workdir, "images"))
+
+    advanced = {
+        "update_stats": False,
+        "cvlc_path": os.path.join(stubs_dir, "cvlc"),
+        "vlc_path": os.path.join(stubs_dir, "cvlc"),
+        "pngview_path": os.path.join(stubs_dir, "pngview"),
+        "ffprobe_path": os.path.join(stubs_dir, "ffprobe"),
+        "vcgencmd_path": os.path.join(stubs_dir, "vcgencmd"),
+        "tvservice_path": os.path.join(stubs_dir, "tvservice"),
+    }
+    for option in args.option:
+        key, _, value = option.partition("=")
+        advanced[key] = yaml.safe_load(value)
+    general = {
+        "advanced": advanced,
+        "fallbacks": {"displays": [{"display_number": 2, "hdmi": 0, "device_name": "fallback", "resolution": {"width": 1920, "height": 1080}}]},
+    }
+    with open(os.path.join(workdir, "conf", "general.yml"), 'w') as general_file:
+        yaml.safe_dump(general, general_file)
+
+    for hdmi, screens in enumerate(displays_screens):
+        with open(os.path.join(workdir, "conf", f"display{hdmi + 1}.yml"), 'w') as display_file:
+            yaml.safe_dump({"essentials": {"screens": screens}}, display_file)
+
+    #Keep the logging of rpisurv, but only to the log file of the working directory
+    with open(os.path.join(source_dir, "conf", "logging.yml"), 'r') as logging_file:
+        logcfg = yaml.safe_load(logging_file)
+    for logger_cfg in [logcfg["root"]] + list(logcfg["loggers"].values()):
+        logger_cfg["handlers"] = ["h_rotfile"]
+        logger_cfg["level"] = args.log_level
+    logcfg["handlers"]["h_rotfile"]["level"] = args.log_level
+    with open(os.path.join(workdir, "conf", "logging.yml"), 'w') as logging_file:
+        yaml.safe_dump(logcfg, logging_file)
+    return workdir
+
+
+def count_child_processes():
+    '''Returns the number of direct child processes of the benchmark, these are all the players and pngview instances'''
+    count = 0
+    mypid = os.getpid()
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f"/proc/{pid}/stat", 'r') as stat_file:
+                stat = stat_file.read()
+        except OSError:
+            continue
+        #The command name can contain spaces, the fields after it are fixed
+        fields = stat[stat.rfind(")") + 2:].split()
+        if int(fields[1]) == mypid:
+            count = count + 1
+    return count
+
+
+def summarize(durations):
+    if not durations:
+        return {}
+    ordered = sorted(durations)
+    return {
+        "count": len(ordered),
+        "min": ordered[0],
+        "median": statistics.median(ordered),
+        "p95": ordered[min(len(ordered) - 1, int(round(0.95 * (len(ordered) - 1))))],
+        "max": ordered[-1],
+    }
+
+
+def run(args):
+    os.environ["RPISURV_BENCH_DISPLAYS"] = str(args.displays)
+    os.environ["RPISURV_BENCH_CVLC_CPU"] = str(args.player_cpu)
+    os.environ["RPISURV_BENCH_CVLC_CRASH_RATE"] = str(args.player_crash_rate)
+    os.environ["RPISURV_BENCH_CVLC_FIRST_FRAME_DELAY"] = str(args.player_first_frame_delay)
+    os.environ["RPISURV_BENCH_FFPROBE_LATENCY"] = str(args.ffprobe_latency)
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+    servers, displays_screens = start_stub_servers(args)
+    workdir = create_workdir(args, displays_screens)
+    #rpisurv reads its config relative to the working directory at import time
+    os.chdir(workdir)
+    sys.path.insert(0, source_dir)
+
+    from core.util.config import cfg
+    from core.util.setuplogging import setup_logging
+    from core.util import metrics
+    from core.util.prober import probe_camera_streams
+    from core.util.gpumem import GpuMemSampler, VcgencmdBackend
+    from core.util.budget import ResourceBudget
+    from core.PlayerSupervisor import supervisor
+    from core.ScreenManager import ScreenManager
+    from core.HealthChecker import HealthChecker
+    import surveillance
+
+    setup_logging()
+    results = {"arguments": vars(args)}
+    cpu_start = os.times()
+    wall_start = time.monotonic()
+
+    #Startup like surveillance.py does it: display detection with the tvservice stub, creating the screens and showing the first screen
+    fast_startup = cfg['advanced']['fast_startup'] if 'fast_startup' in cfg["advanced"] else True
+    start_time = time.monotonic()
+    health_checker = HealthChecker()
+    gpumem_sampler = GpuMemSampler(VcgencmdBackend(os.path.join(stubs_dir, "vcgencmd")))
+    gpumem_sampler.sample()
+    resource_budget = ResourceBudget(supervisor, gpumem_sampler) if args.resource_budget else None
+    displays = surveillance.parse_tvservice(os.path.join(stubs_dir, "tvservice"))
+    screenmanagers = []
+    for count, display in enumerate(displays):
+        screenmanagers.append(ScreenManager(f"screen_manager_{count}", display, True, args.disable_pygame or count > 0, resource_budget, health_checker))
+    health_checker.start()
+    results["startup_seconds"] = time.monotonic() - start_time
+
+    bootstrap_durations = []
+    if fast_startup:
+        for screenmanager in screenmanagers:
+            screenmanager.show_first_screen()
+        results["first_screen_seconds"] = time.monotonic() - start_time
+        for screenmanager in screenmanagers:
+            bootstrap_start_time = time.monotonic()
+            screenmanager.rotate_next()
+            bootstrap_durations.append(time.monotonic() - bootstrap_start_time)
+    else:
+        for screenmanager in screenmanagers:
+            bootstrap_start_time = time.monotonic()
+            screenmanager.rotate_next()
+            screenmanager.update_active_screen()
+            bootstrap_durations.append(time.monotonic() - bootstrap_start_time)
+        results["first_screen_seconds"] = time.monotonic() - start_time
+
+    #Rotation latency, with the background health checker running like in production
+    rotation_durations = []
+    peak_players = supervisor.get_running_player_count()
+    peak_processes = count_child_processes()
+    for rotation in range(args.rotations):
+        for screenmanager in screenmanagers:
+            start_time = time.monotonic()
+            screenmanager.rotate_next()
+            screenmanager.update_active_screen()
+            rotation_durations.append(time.monotonic() - start_time)
+        peak_players = max(peak_players, supervisor.get_running_player_count())
+        peak_processes = max(peak_processes, count_child_processes())
+        time.sleep(args.dwell)
+        gpumem_sampler.sample()
+
+    results["rotation"] = {
+        "bootstrap": summarize(bootstrap_durations),
+        "rotate": summarize(rotation_durations),
+    }
+    health_checker.stop()
+
+    #Probe throughput: probe every stream of every screen that has been shown, without using cached results
+    camera_streams = []
+    for screenmanager in screenmanagers:
+        camera_streams.extend(screenmanager.get_probed_camera_streams())
+    probe_durations = []
+    connectable = 0
+    for probe_round in range(args.probe_rounds):
+        start_time = time.monotonic()
+        probe_results = probe_camera_streams(camera_streams, deadline=30, name="benchmark")
+        probe_durations.append(time.monotonic() - start_time)
+        connectable = connectable + sum([1 for result in probe_results.values() if result])
+    total_probes = len(camera_streams) * args.probe_rounds
+    results["probe"] = {
+        "streams": len(camera_streams),
+        "rounds": summarize(probe_durations),
+        "probes_per_second": total_probes / sum(probe_durations) if sum(probe_durations) > 0 else None,
+        "connectable_ratio": connectable / total_probes if total_probes else None,
+    }
+    results["processes"] = {
+        "peak_running_players": peak_players,
+        "peak_child_processes": peak_processes,
+        "running_players_at_end": supervisor.get_running_player_count(),
+    }
+
+    for screenmanager in screenmanagers:
+        screenmanager.destroy()
+    supervisor.stop_all()
+
+    cpu_end = os.times()
+    results["cpu"] = {
+        "wall_seconds": time.monotonic() - wall_start,
+        "rpisurv_user_seconds": cpu_end.user - cpu_start.user,
+        "rpisurv_system_seconds": cpu_end.system - cpu_start.system,
+        "children_user_seconds": cpu_end.children_user - cpu_start.children_user,
+        "children_system_seconds": cpu_end.children_system - cpu_start.children_system,
+    }
+    results["stub_servers"] = {
+        "requests": sum([server.requests for server in servers]),
+        "failures": sum([server.failures for server in servers]),
+    }
+    results["metrics"] = metrics.registry.to_dict()
+
+    for server in servers:
+        server.stop()
+    if args.keep_workdir:
+        results["workdir"] = workdir
+    else:
+        shutil.rmtree(workdir)
+    return results
+
+
+def print_results(results):
+    def format_summary(summary):
+        if not summary:
+            return "n/a"
+        return f"n={summary['count']} min={summary['min']*1000:.1f}ms median={summary['median']*1000:.1f}ms p95={summary['p95']*1000:.1f}ms max={summary['max']*1000:.1f}ms"
+
+    print(f"startup:                {results['startup_seconds']*1000:.1f}ms")
+    print(f"first screen shown:     {results['first_screen_seconds']*1000:.1f}ms")
+    print(f"probe streams:          {results['probe']['streams']}")
+    print(f"probe round:            {format_summary(results['probe']['rounds'])}")
+    if results['probe']['probes_per_second'] is not None:
+        print(f"probe throughput:       {results['probe']['probes_per_second']:.1f} probes/s ({results['probe']['connectable_ratio']*100:.0f}% connectable)")
+    print(f"bootstrap:              {format_summary(results['rotation']['bootstrap'])}")
+    print(f"rotation:               {format_summary(results['rotation']['rotate'])}")
+    first_frame_values = [value["value"] for value in results["metrics"]["rpisurv_time_to_first_frame_seconds"]["values"]]
+    first_frames = sum([value["count"] for value in first_frame_values])
+    if first_frames:
+        print(f"time to first frame:    {sum([value['sum'] for value in first_frame_values]) / first_frames * 1000:.1f}ms mean over {first_frames} player starts")
+    if results["arguments"]["resource_budget"]:
+        print(f"caching skipped:        {sum([value['value'] for value in results['metrics']['rpisurv_cache_skipped_total']['values']])} times by the resource budget")
+    print(f"peak running players:   {results['processes']['peak_running_players']}")
+    print(f"peak child processes:   {results['processes']['peak_child_processes']}")
+    print(f"rpisurv cpu:            {results['cpu']['rpisurv_user_seconds']:.2f}s user {results['cpu']['rpisurv_system_seconds']:.2f}s system in {results['cpu']['wall_seconds']:.2f}s wall")
+    print(f"stub players cpu:       {results['cpu']['children_user_seconds']:.2f}s user {results['cpu']['children_system_seconds']:.2f}s system")
+    print(f"stub server requests:   {results['stub_servers']['requests']} ({results['stub_servers']['failures']} failed)")
+    if "workdir" in results:
+        print(f"working directory:      {results['workdir']}")
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    json_path = os.path.abspath(args.json) if args.json else None
+    results = run(args)
+    print_results(results)
+    if json_path is not None:
+        with open(json_path, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
@@ -0,0 +1,125 @@
+import hashlib
+import random
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+
+
+class StubServer:
+    """Base class of the stub servers, serves from a background thread on a free loopback port"""
+    handler_class = None
+
+    def __init__(self, latency=0.0, failure_rate=0.0):
+        #Seconds to wait before answering a request
+        self.latency = latency
+        #Chance that a request fails
+        self.failure_rate = failure_rate
+        self.requests = 0
+        self.failures = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingServer(("127.0.0.1", 0), self.handler_class)
+        self.server.stub = self
+        self.port = self.server.server_address[1]
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name=type(self).__name__, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def answer(self):
+        '''Waits for the configured latency and returns False if this request has to fail'''
+        time.sleep(self.latency)
+        failed = random.random() < self.failure_rate
+        with self.lock:
+            self.requests = self.requests + 1
+            if failed:
+                self.failures = self.failures + 1
+        return not failed
+
+
+class ThreadingServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class RTSPOptionsHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        #Keep the connection open for more requests, like a real camera does
+        while True:
+            headers = []
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    return
+                if line in (b"\r\n", b"\n"):
+                    break
+                headers.append(line.decode(errors="replace").strip())
+            if not headers:
+                continue
+            cseq = "0"
+            for header in headers[1:]:
+                name, _, value = header.partition(":")
+                if name.strip().lower() == "cseq":
+                    cseq = value.strip()
+            if not self.server.stub.answer():
+                #A failing camera drops the connection
+                return
+            if not headers[0].startswith("OPTIONS "):
+                response = f"RTSP/1.0 501 Not Implemented\r\nCSeq: {cseq}\r\n\r\n"
+            else:
+                response = f"RTSP/1.0 200 OK\r\nCSeq: {cseq}\r\nPublic: OPTIONS, DESCRIBE, SETUP, TEARDOWN, PLAY\r\n\r\n"
+            self.wfile.write(response.encode())
+
+
+class StubRTSPServer(StubServer):
+    """Answers rtsp OPTIONS requests, which is all rpisurv uses to probe rtsp streams"""
+    handler_class = RTSPOptionsHandler
+
+    def url(self, path="stream"):
+        return f"rtsp://127.0.0.1:{self.port}/{path}"
+
+
+class SnapshotHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        stub = self.server.stub
+        if not stub.answer():
+            self.send_response(500)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if self.headers.get("If-None-Match") == stub.etag:
+            self.send_response(304)
+            self.send_header("ETag", stub.etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(stub.image)))
+        self.send_header("ETag", stub.etag)
+        self.end_headers()
+        self.wfile.write(stub.image)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubHTTPSnapshotServer(StubServer):
+    """Serves one snapshot image with an ETag, like the jpg/png snapshot url of a camera"""
+    handler_class = SnapshotHandler
+
+    def __init__(self, image_path, latency=0.0, failure_rate=0.0):
+        super().__init__(latency, failure_rate)
+        with open(image_path, 'rb') as image_file:
+            self.image = image_file.read()
+        self.etag = '"' + hashlib.sha1(self.image).hexdigest() + '"'
+
+    def url(self, path="snapshot.png"):
+        return f"http://127.0.0.1:{self.port}/{path}"
@@ -1,28 +1,46 @@
 import logging
-import multiprocessing
 import base64
+import copy
 import re
 import socket
 import os
 import sys
 import io
 import subprocess
+import time
 import urllib.request, urllib.error, urllib.parse
 from urllib.parse import urlparse
 
 from . import worker
+from .PlayerSupervisor import supervisor
+from .util.backoff import CircuitBreaker, backoff_settings_from_config, probe_backoff_settings_from_config
+from .util import rtspprobe
+from .util.httpfetch import ImageFetcher
+from .util.budget import estimate_stream_cost
+from .util.metrics import probe_latency_seconds, stream_connectable
+from .util.vlcrc import PlayerControlError
+from .util.config import cfg
 
 logger = logging.getLogger('l_default')
 
+supported_schemes = ["rtsp", "http", "https", "file", "rtmp"]
+
+#Path of the ffprobe binary used to probe rtmp streams, override with ffprobe_path in general.yml
+ffprobe_path = cfg['advanced']['ffprobe_path'] if 'ffprobe_path' in cfg["advanced"] else "/usr/bin/ffprobe"
+
 
 class CameraStream:
     """This class makes a camera stream an object"""
     def __init__(self, name, camera_stream, drawinstance, display_hdmi_id):
         self.name = name
-        self.worker = None
+        #The config as it was written, before defaults are filled in, used to detect changes when the config is reloaded
+        self.original_cfg = copy.deepcopy(camera_stream)
+        #Handle of the player in the supervisor, None if no player is started
+        self.player_handle = None
         self.display_hdmi_id = display_hdmi_id
         self.drawinstance = drawinstance
-        self.stopworker = None
+        #Last known result of is_connectable in the form of (connectable, monotonic timestamp), None if never probed
+        self.probe_result = None
         self.cvlc_extra_options = ""
         #This option overrides any other coordinates passed to this stream
         self.force_coordinates=camera_stream.setdefault("force_coordinates", False)
@@ -33,8 +51,18 @@ class CameraStream:
         self.url = camera_stream["url"]
         self.enableaudio = camera_stream.setdefault("enableaudio", False)
         self.showontop = camera_stream.setdefault("showontop", False)
+        #The same backoff settings are used by the prober and by the supervisor that restarts crashing players
+        self.backoff_settings = backoff_settings_from_config(camera_stream)
+        self.probe_circuit_breaker = CircuitBreaker(self.name + "_probe", **probe_backoff_settings_from_config(camera_stream))
+        #Estimated decoder resources this stream needs when playing, relative to one 1080p h264 stream
+        self.decoder_cost = estimate_stream_cost(camera_stream)
+        if self.imageurl:
+            #Remembers etag/last-modified so unchanged images are not downloaded and drawn again
+            self.image_fetcher = ImageFetcher(self.url, self.probe_timeout)
+            #False until the image is drawn on top of the connecting placeholder of this stream
+            self.image_drawn = False
         if self.imageurl and self.showontop:
-            logger.error(f"CameraStream: {self.name} is an imageurl which does not support showontop" )
+            logger.error("CameraStream: %s is an imageurl which does not support showontop", self.name)
         #Check if rtsp_over_tcp option exist otherwise default to false
         self.rtsp_over_tcp=camera_stream["rtsp_over_tcp"] if 'rtsp_over_tcp' in camera_stream else False
         #If rtsp over tcp option is true add extra option to omxplayer
@@ -53,13 +81,13 @@ class CameraStream:
                 # Default to default rtsp port, if no port is given in the url
                 self.port = 554
 
-            #Command used for rtsp probing
-            self.rtsp_options_cmd = "OPTIONS " + self._manipulate_credentials_in_url("remove")  + " RTSP/1.0\r\nCSeq: 1\r\nUser-Agent: rpisurv\r\nAccept: application/sdp\r\n\r\n"
+            #Url used for rtsp probing
+            self.rtsp_options_url = self._manipulate_credentials_in_url("remove")
 
         self.obfuscated_credentials_url = self._manipulate_credentials_in_url("obfuscate")
 
-        if self.scheme not in ["rtsp", "http", "https", "file", "rtmp"]:
-            logger.error("CameraStream: " + self.name + " Scheme " + self.scheme + " in " + self.obfuscated_credentials_url + " is currently not supported, you can make a feature request on https://community.rpisurv.net")
+        if self.scheme not in supported_schemes:
+            logger.error("CameraStream: %s Scheme %s in %s is currently not supported, you can make a feature request on https://community.rpisurv.net", self.name, self.scheme, self.obfuscated_credentials_url)
             sys.exit()
 
     def is_imageurl(self):
@@ -98,70 +126,119 @@ class CameraStream:
             request = urllib.request.Request(self.url, None, headers )
             return urllib.request.urlopen(request, timeout=self.probe_timeout)
 
+    def set_probe_result(self, connectable):
+        self.probe_result = (connectable, time.monotonic())
+        stream_connectable.set(1 if connectable else 0, stream=self.name)
+
+    def get_cached_probe_result(self, max_age):
+        '''Returns the last probe result if it is not older then max_age seconds, otherwise returns None'''
+        probe_result = self.probe_result
+        if probe_result is None or time.monotonic() - probe_result[1] > max_age:
+            return None
+        return probe_result[0]
+
+    def get_probe_age(self):
+        '''Returns how many seconds ago this stream was probed, None if never probed'''
+        probe_result = self.probe_result
+        if probe_result is None:
+            return None
+        return time.monotonic() - probe_result[1]
+
+    def get_circuit_breaker_state(self):
+        '''Returns closed, open or half_open depending on recent probe failures'''
+        return self.probe_circuit_breaker.get_state()
+
     def is_connectable(self):
+        '''Probes the stream unless it failed too often recently, in which case it is reported unconnectable without probing until its backoff delay passed'''
+        if not self.probe_circuit_breaker.allow_attempt():
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("CameraStream: %s %s Not Connectable (circuit breaker open, next probe in %.1f seconds)", self.name, self.obfuscated_credentials_url, self.probe_circuit_breaker.get_retry_delay())
+            return False
+        start_time = time.monotonic()
+        try:
+            connectable = self._probe()
+        except Exception:
+            #Otherwise a half_open circuit breaker would keep waiting for the result of this trial
+            self.probe_circuit_breaker.record_failure()
+            raise
+        probe_latency_seconds.observe(time.monotonic() - start_time, stream=self.name)
+        if connectable:
+            self.probe_circuit_breaker.record_success()
+        else:
+            self.probe_circuit_breaker.record_failure()
+        return connectable
+
+    def _probe(self):
         if self.scheme == "rtmp":
             try:
-                ffprobeoutput = subprocess.check_output(['/usr/bin/ffprobe', '-v', 'quiet', "-print_format", "flat", "-show_error", self.url], text=True, timeout=self.probe_timeout)
+                ffprobeoutput = subprocess.check_output([ffprobe_path, '-v', 'quiet', "-print_format", "flat", "-show_error", self.url], text=True, timeout=self.probe_timeout)
                 return True
             except subprocess.TimeoutExpired as e:
-                logger.error(f"CameraStream: {self.name} {self.obfuscated_credentials_url} Not Connectable (ffprobe timed out, try increasing probe_timeout for this stream), configured timeout: {self.probe_timeout}")
+                logger.error("CameraStream: %s %s Not Connectable (ffprobe timed out, try increasing probe_timeout for this stream), configured timeout: %s", self.name, self.obfuscated_credentials_url, self.probe_timeout)
                 return False
             except Exception as e:
                 erroroutput_newlinesremoved=e.output.replace('\n', ' ')
-                logger.error(f"CameraStream: {self.name} {self.obfuscated_credentials_url} Not Connectable ({erroroutput_newlinesremoved}), configured timeout: {self.probe_timeout}")
+                logger.error("CameraStream: %s %s Not Connectable (%s), configured timeout: %s", self.name, self.obfuscated_credentials_url, erroroutput_newlinesremoved, self.probe_timeout)
                 return False
         if self.scheme == "rtsp":
             try:
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.settimeout(self.probe_timeout)
-                s.connect((self.hostname, self.port))
                 #Use OPTIONS command to check if we are dealing with a real rtsp server
-                s.send(self.rtsp_options_cmd.encode())
-                rtsp_response=s.recv(4096)
-                s.close()
+                #The connection to this host:port is kept open and reused for the next probe
+                rtsp_response = rtspprobe.options(self.hostname, self.port, self.rtsp_options_url, self.probe_timeout)
             except Exception as e:
-                logger.error("CameraStream: " + self.name + " " + str(self.obfuscated_credentials_url) + " Not Connectable (failed socket connect), configured timeout: " + str(self.probe_timeout) + " " + repr(e))
+                logger.error("CameraStream: %s %s Not Connectable (failed socket connect), configured timeout: %s %r", self.name, self.obfuscated_credentials_url, self.probe_timeout, e)
                 return False
 
             #If we come to this point it means we have some data received, before we return True we need to check if are connected to an RTSP server
             if not rtsp_response:
-                logger.error("CameraStream: " + self.name + " " + str(self.obfuscated_credentials_url) + " Not Connectable (failed rtsp validation, no response from rtsp server)")
+                logger.error("CameraStream: %s %s Not Connectable (failed rtsp validation, no response from rtsp server)", self.name, self.obfuscated_credentials_url)
                 return False
 
             if re.match("RTSP/1.0",rtsp_response.decode('utf-8').splitlines()[0]):
-                logger.debug("CameraStream: " + self.name + " " + str(self.obfuscated_credentials_url) + " Connectable")
+                logger.debug("CameraStream: %s %s Connectable", self.name, self.obfuscated_credentials_url)
                 return True
             else:
-                logger.error("CameraStream: " + self.name + " " + str(self.obfuscated_credentials_url) + " Not Connectable (failed rtsp validation, is this an rtsp stream?)")
+                logger.error("CameraStream: %s %s Not Connectable (failed rtsp validation, is this an rtsp stream?)", self.name, self.obfuscated_credentials_url)
                 return False
+        elif self.scheme in ["http","https"] and self.imageurl:
+            #A conditional request over the pooled connection of the image fetcher, a new image is kept for the next refresh instead of being downloaded twice
+            try:
+                self.image_fetcher.probe()
+            except Exception as e:
+                logger.error("CameraStream: %s %s Not Connectable (%r )", self.name, self.obfuscated_credentials_url, e)
+                return False
+            logger.debug("CameraStream: %s %s Connectable", self.name, self.obfuscated_credentials_url)
+            return True
         elif self.scheme in ["http","https"]:
              try:
                 connection = self._urllib2open_wrapper()
-                if connection.getcode() == 200:
-                    logger.debug("CameraStream: " + self.name + " " + str(self.obfuscated_credentials_url) + " Connectable")
-                    return True
-                else:
-                    logger.error("CameraStream: " + self.name + " " + str(self.obfuscated_credentials_url) + " Not Connectable (http response code: " + str(connection.getcode()) + ")")
-                    return False
-                connection.close()
+                try:
+                    if connection.getcode() == 200:
+                        logger.debug("CameraStream: %s %s Connectable", self.name, self.obfuscated_credentials_url)
+                        return True
+                    else:
+                        logger.error("CameraStream: %s %s Not Connectable (http response code: %s)", self.name, self.obfuscated_credentials_url, connection.getcode())
+                        return False
+                finally:
+                    connection.close()
              except urllib.error.URLError as e:
-                logger.error("CameraStream: " + self.name + " " + str(self.obfuscated_credentials_url) + " Not Connectable (URLerror), " + repr(e))
+                logger.error("CameraStream: %s %s Not Connectable (URLerror), %r", self.name, self.obfuscated_credentials_url, e)
                 return False
              except socket.timeout as e:
-                logger.error("CameraStream: " + self.name + " " + str(self.obfuscated_credentials_url) + " Not Connectable (failed socket connect, configured timeout: " + str(self.probe_timeout) + " ), " + repr(e))
+                logger.error("CameraStream: %s %s Not Connectable (failed socket connect, configured timeout: %s ), %r", self.name, self.obfuscated_credentials_url, self.probe_timeout, e)
                 return False
              except Exception as e:
-                 logger.error("CameraStream: " + self.name + " " + str(self.obfuscated_credentials_url) + " Not Connectable (" + repr(e) + " )")
+                 logger.error("CameraStream: %s %s Not Connectable (%r )", self.name, self.obfuscated_credentials_url, e)
                  return False
         elif self.scheme == "file":
             if os.path.isfile(self.parsed.path):
-                logger.debug(f"CameraStream: {self.name} {self.parsed.path} file found" )
+                logger.debug("CameraStream: %s %s file found", self.name, self.parsed.path )
                 return True
             else:
-                logger.error(f"CameraStream: {self.name} {self.parsed.path} file not found")
+                logger.error("CameraStream: %s %s file not found", self.name, self.parsed.path)
                 return False
         else:
-            logger.error("CameraStream: " + self.name + " Scheme " + str(self.scheme) + " in " + str(self.obfuscated_credentials_url) + " is currently not supported, you can make a feature request on https://community.rpisurv.net")
+            logger.error("CameraStream: %s Scheme %s in %s is currently not supported, you can make a feature request on https://community.rpisurv.net", self.name, self.scheme, self.obfuscated_credentials_url)
             sys.exit()
 
     def calculate_field_geometry(self):
@@ -176,73 +253,142 @@ class CameraStream:
     def refresh_image_from_url(self):
         if self.imageurl:
             # This is an imageurl instead of a camerastream, do not start cvlc stuff
-            if self.is_connectable():
-                try:
-                    # image_str = urllib2.urlopen(self.url).read()
-                    image_str = self._urllib2open_wrapper().read()
-                    # create a file object (stream)
-                    self.image_file = io.BytesIO(image_str)
-                    self.calculate_field_geometry()
-                    self.drawinstance.placeholder(self.coordinates[0], self.coordinates[1], self.normal_fieldwidth, self.normal_fieldheight, self.image_file)
-                except Exception as e:
-                    #Do not crash rpisurv if there is something wrong with loading the image at this time
-                    logger.error("CameraStream: This stream " + self.name + " refresh_image_from_url " + repr(e))
+            if not self.probe_circuit_breaker.allow_attempt():
+                logger.debug("CameraStream: %s skip refreshing imageurl (circuit breaker open)", self.name)
+                return
+            try:
+                # One conditional request, an unchanged image is not downloaded, decoded or drawn again
+                modified, image_str = self.image_fetcher.fetch()
+            except Exception as e:
+                #Do not crash rpisurv if there is something wrong with loading the image at this time
+                logger.error("CameraStream: %s %s refresh_image_from_url Not Connectable %r", self.name, self.obfuscated_credentials_url, e)
+                self.probe_circuit_breaker.record_failure()
+                return
+            self.probe_circuit_breaker.record_success()
+
+            if not modified and self.image_drawn:
+                logger.debug("CameraStream: This stream %s imageurl did not change, skip redrawing", self.name)
+                return
+            try:
+                self.calculate_field_geometry()
+                # create a file object (stream)
+                image_file = io.BytesIO(image_str) if modified else None
+                if not self.drawinstance.draw_image(self.coordinates[0], self.coordinates[1], self.normal_fieldwidth, self.normal_fieldheight, self.url, image_file):
+                    #There is no decoded image to redraw, download it again
+                    self.image_fetcher.reset()
+                    modified, image_str = self.image_fetcher.fetch()
+                    self.drawinstance.draw_image(self.coordinates[0], self.coordinates[1], self.normal_fieldwidth, self.normal_fieldheight, self.url, io.BytesIO(image_str))
+                self.image_drawn = True
+            except Exception as e:
+                #Do not crash rpisurv if there is something wrong with loading the image at this time
+                logger.error("CameraStream: This stream %s refresh_image_from_url %r", self.name, e)
         else:
-            logger.debug("CameraStream: This stream " + self.name + " is not an imageurl, skip refreshing imageurl")
+            logger.debug("CameraStream: This stream %s is not an imageurl, skip refreshing imageurl", self.name)
 
-    def start_stream(self, coordinates, layer):
+    def resolve_coordinates(self, coordinates):
+        '''Returns the coordinates this stream will be drawn on, force_coordinates override the pre-calculated coordinates'''
         if self.force_coordinates:
-            logger.debug("CameraStream: This stream " + self.name + " uses force_coordinates " + str(self.force_coordinates) + " which will override pre-calculated coordinates of " + str(coordinates) )
-            self.coordinates = self.force_coordinates
-        else:
-            self.coordinates=coordinates
+            logger.debug("CameraStream: This stream %s uses force_coordinates %s which will override pre-calculated coordinates of %s", self.name, self.force_coordinates, coordinates )
+            return list(self.force_coordinates)
+        return coordinates
+
+    def prepare_start(self, coordinates, layer):
+        '''Sets coordinates and layer for the next start and returns the player command line, None for an imageurl which has no player'''
+        self.coordinates = self.resolve_coordinates(coordinates)
 
         if self.showontop:
-            logger.debug(f"CameraStream: Start stream on top  of the other streams {self.name}")
+            logger.debug("CameraStream: Start stream on top  of the other streams %s", self.name)
             self.layer = layer + 1
         else:
             self.layer=layer
-        logger.debug("CameraStream: Start stream " + self.name + " on layer " + str(self.layer))
+        logger.debug("CameraStream: Start stream %s on layer %s", self.name, self.layer)
 
-        if not self.imageurl:
-            #Stop existing stream, if any, before drawing new
-            self.stop_stream()
-            # Start stream
-            self.stopworker = multiprocessing.Value('b', False)
-            self.worker = multiprocessing.Process(target=worker.worker, args=(
-                self.name,
-                self.url,
-                self.cvlc_extra_options,
-                self.coordinates,
-                self.stopworker,
-                self.enableaudio,
-                self.layer,
-                self.display_hdmi_id,
-                self.network_caching_ms
-            ))
-            self.worker.daemon = True
-            self.worker.start()
+        if self.imageurl:
+            return None
+        return worker.build_command_line(self.url, self.cvlc_extra_options, self.coordinates, self.enableaudio, self.layer, self.display_hdmi_id, self.network_caching_ms)
+
+    def get_player_key(self, coordinates):
+        '''Returns the key of the player this stream would run at coordinates, see worker.get_shared_player_key. None for an imageurl'''
+        if self.imageurl:
+            return None
+        #The layer is not part of the key
+        return worker.get_shared_player_key(worker.build_command_line(self.url, self.cvlc_extra_options, self.resolve_coordinates(coordinates), self.enableaudio, 0, self.display_hdmi_id, self.network_caching_ms))
 
+    def finish_start(self, player_handle):
+        '''Remembers the handle of the started player (None for an imageurl) and draws the status of this stream'''
+        self.player_handle = player_handle
         self.show_status()
 
         if self.imageurl:
+            #The connecting placeholder was drawn over the previous image
+            self.image_drawn = False
             self.refresh_image_from_url()
 
-
-    def restart_stream(self):
+    def start_stream(self, coordinates, layer):
+        #Stop existing stream, if any, before drawing new
         self.stop_stream()
-        self.start_stream(self.coordinates)
+        command_line = self.prepare_start(coordinates, layer)
+        player_handle = None
+        if command_line is not None:
+            # Start stream
+            player_handle = supervisor.start_player(self.name, command_line, self.backoff_settings, self.decoder_cost)
+        self.finish_start(player_handle)
+
+    def get_player_state(self):
+        '''Returns the state of the player of this stream as reported by the supervisor, None if no player is started'''
+        if self.player_handle is None:
+            return None
+        return supervisor.get_player_state(self.player_handle)
+
+    def _get_player_control(self):
+        if self.player_handle is None:
+            return None
+        return supervisor.get_player_control(self.player_handle)
+
+    def pause(self):
+        '''
+        Pauses the player of this stream without stopping it, returns False if it could not be paused.
+        A player that is shared with other screens pauses for those screens too
+        '''
+        control = self._get_player_control()
+        if control is None:
+            return False
+        try:
+            control.pause()
+        except PlayerControlError as e:
+            logger.error("CameraStream: %s could not be paused %r", self.name, e)
+            return False
+        return True
+
+    def resume(self):
+        '''Resumes the paused player of this stream, returns False if it could not be resumed'''
+        control = self._get_player_control()
+        if control is None:
+            return False
+        try:
+            control.resume()
+        except PlayerControlError as e:
+            logger.error("CameraStream: %s could not be resumed %r", self.name, e)
+            return False
+        return True
+
+    def get_decode_stats(self):
+        '''Returns the decode statistics of the running player of this stream (see VlcRcClient.get_stats), None if there is no player or it can not be reached'''
+        control = self._get_player_control()
+        if control is None:
+            return None
+        try:
+            return control.get_stats()
+        except PlayerControlError as e:
+            logger.debug("CameraStream: could not read decode statistics of %s %r", self.name, e)
+            return None
 
     def stop_stream(self):
-        logger.debug("CameraStream: Stop stream " + self.name)
+        logger.debug("CameraStream: Stop stream %s", self.name)
         # Only stop something if this is not an imageurl, for imageurl nothing has to be stopped
-        # Stopworker shared value will stop the while loop in the worker, so the worker will run to end. No need to explicitely terminate the worker
         if not self.imageurl:
-            #On first instantiation there will be no stopworker and there is nothing to be stopped
-            if self.stopworker is not None:
-                self.stopworker.value= True
-                logger.debug("CameraStream: MAIN Value of stopworker for " + self.name + " is " + str(self.stopworker.value))
-
-                #Wait for the worker to be terminated before continuing https://github.com/SvenVD/rpisurv/issues/84
-                logger.debug("CameraStream: Executing join for stream " + self.name)
-                self.worker.join()
+            #On first instantiation there will be no player and there is nothing to be stopped
+            if self.player_handle is not None:
+                #Wait for the player to be killed before continuing https://github.com/SvenVD/rpisurv/issues/84
+                supervisor.stop_player(self.player_handle)
+                self.player_handle = None
@@ -0,0 +1,64 @@
+import logging
+import threading
+
+from .util.config import cfg
+from .util.prober import probe_camera_streams
+
+logger = logging.getLogger('l_default')
+
+
+class HealthChecker:
+    """This class probes camera streams in a background thread and publishes the result on each camera stream"""
+    def __init__(self, name="health_checker"):
+        self.name = name
+        #Every camera stream is probed again once its last probe result is older then health_check_interval seconds
+        self.health_check_interval = cfg['advanced']['health_check_interval'] if 'health_check_interval' in cfg["advanced"] else 10
+        self.camera_streams = []
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def register(self, camera_streams):
+        '''Adds camera streams to be checked in the background'''
+        with self.lock:
+            for cam_stream in camera_streams:
+                if cam_stream not in self.camera_streams:
+                    self.camera_streams.append(cam_stream)
+        logger.debug("%s: %s camera streams registered", self.name, len(self.camera_streams))
+
+    def unregister(self, camera_streams):
+        '''Stops checking camera streams, for example because they were removed from the config'''
+        with self.lock:
+            self.camera_streams = [cam_stream for cam_stream in self.camera_streams if cam_stream not in camera_streams]
+        logger.debug("%s: %s camera streams registered", self.name, len(self.camera_streams))
+
+    def start(self):
+        logger.info("%s: starting background health checks every %s seconds", self.name, self.health_check_interval)
+        self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _get_due_camera_streams(self):
+        '''Returns the camera streams that need a new probe and the time in seconds until the next stream will be due'''
+        due_camera_streams = []
+        next_due = self.health_check_interval
+        with self.lock:
+            camera_streams = list(self.camera_streams)
+        for cam_stream in camera_streams:
+            probe_age = cam_stream.get_probe_age()
+            if probe_age is None or probe_age >= self.health_check_interval:
+                due_camera_streams.append(cam_stream)
+            else:
+                next_due = min(next_due, self.health_check_interval - probe_age)
+        return due_camera_streams, next_due
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            due_camera_streams, next_due = self._get_due_camera_streams()
+            if due_camera_streams:
+                deadline = max([cam_stream.probe_timeout for cam_stream in due_camera_streams]) + 1
+                probe_camera_streams(due_camera_streams, deadline, self.name)
+                continue
+            self.stop_event.wait(next_due)
@@ -0,0 +1,100 @@
+import logging
+
+from . import worker
+from .PlayerSupervisor import supervisor
+from .util.config import cfg
+
+logger = logging.getLogger('l_default')
+
+#Let screens that show the same camera at the same place use one player, override with share_players in general.yml
+share_players = cfg['advanced']['share_players'] if 'share_players' in cfg["advanced"] else True
+
+
+class SharedPlayer:
+    """One player and the camera streams that show their picture with it"""
+    def __init__(self, key, handle, layer):
+        self.key = key
+        self.handle = handle
+        #The layer the player was started on, which can be higher than the layer of the screens that use it now
+        self.layer = layer
+        #Camera stream: command line it would have started the player with
+        self.owners = {}
+
+
+class PlayerRegistry:
+    """
+    Keeps track of the players that run for the camera streams of all screens, so a camera that is shown at the same place on several screens runs only one player.
+    Players are keyed by their command line without the layer, so only streams with the same url, options, coordinates and display share a player.
+    A player can not be moved to other coordinates or another layer while it runs (mmal_vout only reads those at startup), a stream at another place always needs its own player.
+    Only used from the main thread
+    """
+    def __init__(self):
+        #Key: the player with that key on the highest layer, new streams are only shared with that one
+        self.shared_players = {}
+        #Camera stream: the player it uses
+        self.players_by_stream = {}
+
+    def share(self, cam_stream, command_line):
+        '''
+        Returns the handle of a running player cam_stream can use instead of starting its own, None if it has to start one.
+        A player on a lower layer than cam_stream would be hidden behind the black layer, so only players on the same or a higher layer are shared
+        '''
+        if not share_players:
+            return None
+        shared_player = self.shared_players.get(worker.get_shared_player_key(command_line))
+        if shared_player is None or shared_player.layer < cam_stream.layer:
+            return None
+        logger.debug("PlayerRegistry: %s uses the player of %s on layer %s", cam_stream.name, [owner.name for owner in shared_player.owners], shared_player.layer)
+        shared_player.owners[cam_stream] = command_line
+        self.players_by_stream[cam_stream] = shared_player
+        return shared_player.handle
+
+    def add(self, cam_stream, command_line, handle):
+        '''Registers the player that was started for cam_stream'''
+        key = worker.get_shared_player_key(command_line)
+        shared_player = SharedPlayer(key, handle, cam_stream.layer)
+        shared_player.owners[cam_stream] = command_line
+        self.players_by_stream[cam_stream] = shared_player
+        if key not in self.shared_players or self.shared_players[key].layer < shared_player.layer:
+            self.shared_players[key] = shared_player
+
+    def release(self, cam_stream):
+        '''Returns the handle of the player of cam_stream if no other stream uses it anymore and it has to be stopped, otherwise None'''
+        shared_player = self.players_by_stream.pop(cam_stream, None)
+        if shared_player is None:
+            return None
+        del shared_player.owners[cam_stream]
+        if shared_player.owners:
+            logger.debug("PlayerRegistry: %s stopped, keep running its player for %s", cam_stream.name, [owner.name for owner in shared_player.owners])
+            return None
+        if self.shared_players.get(shared_player.key) is shared_player:
+            del self.shared_players[shared_player.key]
+        return shared_player.handle
+
+    def get_shared_players(self, cam_streams):
+        '''Returns the players of cam_streams that are used by more than one stream or run on another layer than their streams'''
+        shared_players = []
+        for cam_stream in cam_streams:
+            shared_player = self.players_by_stream.get(cam_stream)
+            if shared_player is not None and shared_player not in shared_players and (len(shared_player.owners) > 1 or shared_player.layer != cam_stream.layer):
+                shared_players.append(shared_player)
+        return shared_players
+
+    def move(self, shared_player, owner, stop_timeout=None):
+        '''
+        Starts the player again with the command line of owner, so it runs on the layer of owner. Returns the handle of the old player, which still has to be stopped.
+        With stop_timeout the old player is stopped before the new one is started and None is returned, so the two never decode at the same time
+        '''
+        old_handle = shared_player.handle
+        if stop_timeout is not None:
+            supervisor.stop_players([old_handle], stop_timeout)
+            old_handle = None
+        shared_player.handle = supervisor.start_player(owner.name, shared_player.owners[owner], owner.backoff_settings, owner.decoder_cost)
+        shared_player.layer = owner.layer
+        for cam_stream in shared_player.owners:
+            cam_stream.player_handle = shared_player.handle
+        logger.debug("PlayerRegistry: moved the player of %s to layer %s", [cam_stream.name for cam_stream in shared_player.owners], shared_player.layer)
+        return old_handle
+
+
+player_registry = PlayerRegistry()
@@ -0,0 +1,431 @@
+import logging
+import atexit
+import concurrent.futures
+import functools
+import subprocess
+import itertools
+import os
+import selectors
+import shutil
+import tempfile
+import threading
+import time
+
+from . import worker
+from .util.backoff import CircuitBreaker
+from .util.metrics import player_exits_total, player_restarts_total, players_running, time_to_first_frame_seconds
+from .util.vlcrc import VlcRcClient
+
+logger = logging.getLogger('l_default')
+
+#A player that keeps running this long is considered to be started successfully
+healthy_after = 10
+
+
+class Player:
+    """One supervised cvlc child process"""
+    def __init__(self, handle, name, command_line, backoff_settings, decoder_cost, control_path=None):
+        self.handle = handle
+        self.name = name
+        self.command_line = command_line
+        self.decoder_cost = decoder_cost
+        #Crashing players are restarted with an exponential backoff, after too many consecutive crashes the circuit breaker opens and only allows one trial restart at a time
+        self.circuit_breaker = CircuitBreaker(name + "_player", **backoff_settings)
+        self.proc = None
+        self.pidfd = None
+        #stderr of the process, read by the supervisor thread for first frame detection until the first picture is shown
+        self.output = None
+        #The incomplete last line of the previous read of the output
+        self.output_buffer = b""
+        self.first_frame_at = None
+        self.started_at = None
+        self.reported_healthy = False
+        self.restart_at = None
+        self.restarts = 0
+        #Number of times the player was restarted because it made no progress
+        self.stalls = 0
+        self.stopping = False
+        #Client for the rc interface of the player, None without player control
+        self.control = VlcRcClient(control_path, name) if control_path is not None else None
+
+    def spawn(self):
+        command_line = self.command_line
+        if self.control is not None:
+            #Drop the connection to and the socket of the previous process
+            self.close_control()
+            command_line = worker.add_control_arguments(command_line, self.control.socket_path)
+        logger.debug("PlayerSupervisor: Starting stream %s with commandline %s", self.name, command_line)
+        self.proc = worker.start_subprocess(command_line)
+        self.started_at = time.monotonic()
+        self.first_frame_at = None
+        self.output_buffer = b""
+        self.reported_healthy = False
+        self.restart_at = None
+
+    def close_control(self):
+        if self.control is not None:
+            self.control.close()
+
+    def get_state(self):
+        if self.stopping:
+            return "stopped"
+        if self.restart_at is not None:
+            return "waiting_for_restart"
+        return "running"
+
+
+class PlayerSupervisor:
+    """This class starts all cvlc players from one thread in the main process, reaps them when they exit and restarts them with a backoff"""
+    def __init__(self, name="player_supervisor"):
+        self.name = name
+        self.players = {}
+        self.new_players = []
+        #(player, proc) of players that exited, reported by waiter threads when pidfd is not available
+        self.exited_players = []
+        self.handles = itertools.count(1)
+        self.lock = threading.Lock()
+        #Notified when a player shows its first picture or exits
+        self.first_frame_condition = threading.Condition(self.lock)
+        self.thread = None
+        self.selector = None
+        self.wakeup_read_fd = None
+        self.wakeup_write_fd = None
+        #Without pidfd support (linux < 5.3 or python < 3.9) every player gets a thread that blocks until its process exits
+        self.use_pidfd = hasattr(os, "pidfd_open")
+        #Directory with the control sockets of the players, None without player control
+        self.control_dir = None
+
+    def _ensure_started(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.selector = selectors.DefaultSelector()
+            self.wakeup_read_fd, self.wakeup_write_fd = os.pipe()
+            os.set_blocking(self.wakeup_read_fd, False)
+            os.set_blocking(self.wakeup_write_fd, False)
+            self.selector.register(self.wakeup_read_fd, selectors.EVENT_READ, None)
+            if worker.player_control:
+                self.control_dir = tempfile.mkdtemp(prefix="rpisurv_players_")
+                atexit.register(shutil.rmtree, self.control_dir, ignore_errors=True)
+            self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self.thread.start()
+            logger.debug("%s: started, using pidfd: %s", self.name, self.use_pidfd)
+
+    def _wakeup(self):
+        try:
+            os.write(self.wakeup_write_fd, b"\0")
+        except BlockingIOError:
+            #The pipe is full, so the supervisor will wake up anyway
+            pass
+
+    def start_player(self, name, command_line, backoff_settings, decoder_cost=0):
+        '''Starts a player and returns its handle, decoder_cost is used to keep track of the decoder resources in use'''
+        self._ensure_started()
+        handle = next(self.handles)
+        control_path = os.path.join(self.control_dir, f"player{handle}.sock") if self.control_dir is not None else None
+        player = Player(handle, name, command_line, backoff_settings, decoder_cost, control_path)
+        player.spawn()
+        with self.lock:
+            self.players[player.handle] = player
+            self.new_players.append(player)
+        self._wakeup()
+        return player.handle
+
+    def start_players(self, players_to_start):
+        '''Starts a list of (name, command_line, backoff_settings, decoder_cost) in parallel and returns their handles in the same order'''
+        if len(players_to_start) == 0:
+            return []
+        start_time = time.monotonic()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(8, len(players_to_start)), thread_name_prefix=self.name + "_start") as executor:
+            handles = list(executor.map(lambda player_to_start: self._timed_start_player(*player_to_start), players_to_start))
+        logger.debug("%s: started %s players in %.3f seconds", self.name, len(handles), time.monotonic() - start_time)
+        return handles
+
+    def _timed_start_player(self, name, command_line, backoff_settings, decoder_cost):
+        start_time = time.monotonic()
+        handle = self.start_player(name, command_line, backoff_settings, decoder_cost)
+        logger.debug("%s: starting %s took %.3f seconds", self.name, name, time.monotonic() - start_time)
+        return handle
+
+    def stop_players(self, handles, timeout):
+        '''Signals all players to stop at once and then waits for all of them together, at most timeout seconds in total'''
+        start_time = time.monotonic()
+        stopping = []
+        with self.lock:
+            for handle in handles:
+                player = self.players.get(handle)
+                if player is not None:
+                    player.stopping = True
+                    stopping.append((player, player.proc))
+        for player, proc in stopping:
+            if proc is not None:
+                worker.kill_subprocess(proc)
+        for player, proc in stopping:
+            if proc is not None:
+                try:
+                    proc.wait(max(0, timeout - (time.monotonic() - start_time)))
+                except subprocess.TimeoutExpired:
+                    logger.error("%s: %s did not exit within %s seconds after being killed", self.name, player.name, timeout)
+                    continue
+                if proc.stdin is not None:
+                    proc.stdin.close()
+            logger.debug("%s: %s stopped after %.3f seconds", self.name, player.name, time.monotonic() - start_time)
+        if stopping:
+            #Let the supervisor thread forget these players
+            self._wakeup()
+        logger.info("%s: stopped %s players in %.3f seconds", self.name, len(stopping), time.monotonic() - start_time)
+
+    def stop_player(self, handle):
+        '''Kills the player and waits until it has exited, the player will not be restarted anymore'''
+        with self.lock:
+            player = self.players.get(handle)
+            if player is None:
+                return
+            player.stopping = True
+            proc = player.proc
+        if proc is not None:
+            logger.debug("PlayerSupervisor: This stream %s is about to be stopped", player.name)
+            worker.stop_subprocess(proc)
+        #Let the supervisor thread forget this player
+        self._wakeup()
+        logger.info("PlayerSupervisor: This stream %s has been stopped", player.name)
+
+    def stop_all(self):
+        with self.lock:
+            handles = list(self.players)
+        for handle in handles:
+            self.stop_player(handle)
+
+    def wait_for_first_frames(self, handles, timeout):
+        '''
+        Waits at most timeout seconds until the players of handles show their first picture, returns False if the timeout expired.
+        Players that exited and wait for a restart are not waited for
+        '''
+        if not worker.first_frame_detection:
+            return True
+        def all_ready():
+            for handle in handles:
+                player = self.players.get(handle)
+                if player is not None and not player.stopping and player.restart_at is None and player.first_frame_at is None:
+                    return False
+            return True
+        with self.first_frame_condition:
+            return self.first_frame_condition.wait_for(all_ready, timeout)
+
+    def get_player_state(self, handle):
+        '''Returns a dict with the state of the player, None if the handle is unknown'''
+        with self.lock:
+            player = self.players.get(handle)
+            if player is None:
+                return None
+            return {
+                "name": player.name,
+                "state": player.get_state(),
+                "pid": player.proc.pid if player.proc is not None else None,
+                "restarts": player.restarts,
+                "stalls": player.stalls,
+                "time_to_first_frame": player.first_frame_at - player.started_at if player.first_frame_at is not None else None,
+                "circuit_breaker": player.circuit_breaker.get_state(),
+            }
+
+    def get_player_control(self, handle):
+        '''Returns the VlcRcClient of the player, None if the handle is unknown, the player is not running or player control is disabled'''
+        with self.lock:
+            player = self.players.get(handle)
+            if player is None or player.get_state() != "running":
+                return None
+            return player.control
+
+    def get_controlled_players(self):
+        '''Returns (handle, name, pid, VlcRcClient) of all running players that have a control channel'''
+        with self.lock:
+            return [(player.handle, player.name, player.proc.pid, player.control) for player in self.players.values() if player.get_state() == "running" and player.proc is not None and player.control is not None]
+
+    def restart_stalled_player(self, handle, pid):
+        '''
+        Kills the process pid of the player, the supervisor restarts it like a player that exited by itself.
+        Returns False if the player was stopped or its process was already replaced in the meantime
+        '''
+        with self.lock:
+            player = self.players.get(handle)
+            if player is None or player.stopping or player.proc is None or player.proc.pid != pid:
+                return False
+            player.stalls = player.stalls + 1
+            proc = player.proc
+        worker.kill_subprocess(proc)
+        return True
+
+    def get_running_player_count(self):
+        with self.lock:
+            return len([player for player in self.players.values() if player.get_state() == "running"])
+
+    def get_running_decoder_cost(self):
+        '''Returns the summed decoder cost of all players that are not stopped'''
+        with self.lock:
+            return sum([player.decoder_cost for player in self.players.values() if not player.stopping])
+
+    def _watch(self, player):
+        '''Registers the process of player with the selector, so the supervisor wakes up when it exits'''
+        if player.proc.stderr is not None:
+            player.output = player.proc.stderr
+            os.set_blocking(player.output.fileno(), False)
+            self.selector.register(player.output, selectors.EVENT_READ, functools.partial(self._read_output, player))
+        if self.use_pidfd:
+            try:
+                player.pidfd = os.pidfd_open(player.proc.pid)
+            except ProcessLookupError:
+                #Already stopped and reaped by stop_player
+                return
+            except OSError as e:
+                logger.error("%s: pidfd_open failed for %s %r, falling back to waiter threads", self.name, player.name, e)
+                self.use_pidfd = False
+            else:
+                self.selector.register(player.pidfd, selectors.EVENT_READ, functools.partial(self._handle_exit, player))
+                return
+        threading.Thread(target=self._wait_for_exit, args=(player, player.proc), name=self.name + "_" + player.name, daemon=True).start()
+
+    def _wait_for_exit(self, player, proc):
+        '''Runs in its own thread when pidfd is not available, blocks until proc exits and hands it over to the supervisor thread'''
+        proc.wait()
+        with self.lock:
+            self.exited_players.append((player, proc))
+        self._wakeup()
+
+    def _unwatch(self, player):
+        if player.pidfd is not None:
+            self.selector.unregister(player.pidfd)
+            os.close(player.pidfd)
+            player.pidfd = None
+        self._unwatch_output(player)
+
+    def _unwatch_output(self, player):
+        if player.output is not None:
+            self.selector.unregister(player.output)
+            player.output.close()
+            player.output = None
+
+    def _read_output(self, player):
+        '''
+        Called from the supervisor thread when the player wrote output, records when the player shows its first picture and logs the errors of cvlc.
+        cvlc logs verbose for first frame detection, so once the first picture is shown the output is closed and the supervisor does not wake up for it anymore
+        '''
+        if player.output is None:
+            #The exit of the player was handled earlier in the same select round
+            return
+        try:
+            data = os.read(player.output.fileno(), 65536)
+        except BlockingIOError:
+            return
+        lines = (player.output_buffer + data).split(b"\n")
+        #Keep an incomplete last line for the next read, unless the player closed its output
+        player.output_buffer = lines.pop()[-4096:] if data else b""
+        for line in lines + ([player.output_buffer] if not data else []):
+            if worker.player_error_marker in line:
+                logger.error("%s: %s cvlc %s", self.name, player.name, line.decode(errors="replace").strip())
+            if player.first_frame_at is None and worker.first_frame_marker in line:
+                with self.first_frame_condition:
+                    player.first_frame_at = time.monotonic()
+                    self.first_frame_condition.notify_all()
+                time_to_first_frame_seconds.observe(player.first_frame_at - player.started_at, stream=player.name)
+                logger.debug("%s: %s shows its first picture after %.3f seconds", self.name, player.name, player.first_frame_at - player.started_at)
+                break
+        if not data or player.first_frame_at is not None:
+            #Either the player exits, which is handled through its pidfd or waiter thread, or the output is not needed anymore.
+            #cvlc ignores SIGPIPE, its later log messages are dropped
+            self._unwatch_output(player)
+
+    def _handle_exit(self, player):
+        '''Called from the supervisor thread when the process of player has exited'''
+        self._unwatch(player)
+        player.close_control()
+        if player.stopping:
+            return
+        player.proc.wait()
+        if player.proc.stdin is not None:
+            player.proc.stdin.close()
+        player.proc = None
+        player_exits_total.inc(stream=player.name)
+        player.circuit_breaker.record_failure()
+        retry_delay = player.circuit_breaker.get_retry_delay()
+        with self.first_frame_condition:
+            player.restart_at = time.monotonic() + retry_delay
+            #Nobody has to wait for the first picture of this player anymore
+            self.first_frame_condition.notify_all()
+        logger.info("PlayerSupervisor: Player of %s exited, circuit breaker state: %s, restarting in %s seconds", player.name, player.circuit_breaker.get_state(), round(retry_delay, 1))
+
+    def _next_timeout(self):
+        '''Returns how long the supervisor may sleep before a restart or health deadline is due'''
+        now = time.monotonic()
+        deadlines = []
+        with self.lock:
+            players = list(self.players.values())
+        for player in players:
+            if player.restart_at is not None:
+                deadlines.append(player.restart_at)
+            elif not player.reported_healthy and player.started_at is not None:
+                deadlines.append(player.started_at + healthy_after)
+        if not deadlines:
+            return None
+        return max(0, min(deadlines) - now)
+
+    def _run(self):
+        while True:
+            for key, _ in self.selector.select(self._next_timeout()):
+                if key.data is None:
+                    try:
+                        while os.read(self.wakeup_read_fd, 512):
+                            pass
+                    except BlockingIOError:
+                        pass
+                else:
+                    #Handles the exit or the output of a player
+                    key.data()
+
+            with self.lock:
+                new_players = self.new_players
+                self.new_players = []
+                exited_players = self.exited_players
+                self.exited_players = []
+                players = list(self.players.values())
+
+            for player, proc in exited_players:
+                #Ignore processes of players that were stopped or already restarted in the meantime
+                if player.proc is proc:
+                    self._handle_exit(player)
+
+            for player in new_players:
+                if not player.stopping:
+                    self._watch(player)
+
+            now = time.monotonic()
+            for player in players:
+                if player.stopping:
+                    self._unwatch(player)
+                    player.close_control()
+                    with self.lock:
+                        self.players.pop(player.handle, None)
+                    continue
+                if player.restart_at is not None and now >= player.restart_at:
+                    if not player.circuit_breaker.allow_attempt():
+                        #The breaker is open, or its half_open trial did not report back yet. Its result is recorded when the player exits or becomes healthy
+                        player.restart_at = now + max(player.circuit_breaker.get_retry_delay(), 1)
+                        continue
+                    player.restarts = player.restarts + 1
+                    player_restarts_total.inc(stream=player.name)
+                    logger.info("PlayerSupervisor: Trying to restart %s attempts:%s", player.name, player.restarts)
+                    with self.lock:
+                        if player.stopping:
+                            continue
+                        player.spawn()
+                    self._watch(player)
+                elif player.proc is not None and not player.reported_healthy and now - player.started_at >= healthy_after:
+                    player.circuit_breaker.record_success()
+                    player.reported_healthy = True
+
+            players_running.set(self.get_running_player_count())
+
+
+#All players of all screens and displays are supervised by this single instance
+supervisor = PlayerSupervisor()
+#Do not leave orphaned players behind when rpisurv exits
+atexit.register(supervisor.stop_all)
@@ -2,8 +2,13 @@ import logging
 import math
 import time
 import collections
+import copy
 
 from .CameraStream import CameraStream
+from .PlayerSupervisor import supervisor
+from .PlayerRegistry import player_registry
+from .util.config import cfg
+from .util.prober import probe_camera_streams, probe_cache_ttl
 
 #We do not need exact floating point numbers, use builtin "float" instead
 #from decimal import getcontext, Decimals
@@ -11,34 +16,84 @@ from .CameraStream import CameraStream
 
 logger = logging.getLogger('l_default')
 
+#How long to wait in total for all streams of a screen to exit after they were killed, override with stream_stop_timeout in general.yml
+stream_stop_timeout = cfg['advanced']['stream_stop_timeout'] if 'stream_stop_timeout' in cfg["advanced"] else 5
+
 class Screen:
     """This class creates and handles camerastreams objects and their position"""
     def __init__(self, screenname, screen_cfg, display, drawinstance):
         ## Init vars
         #Use vcgencmd dispmanx_list to see on which layer framebuffer is located
-        #Highest observed was 2147483647 on a rpi4, start high with some tolerance,so caching has a long way to count down before it needs to reset the layer
+        #Highest observed was 2147483647 on a rpi4, start high with some tolerance. The screen manager sets the layer from its layer allocator before the screen is drawn
         self.layer_init_value=2000000000
         self.layer=self.layer_init_value
         self.display_vlc_hdmi_id=str(int(display["hdmi"]) + 1)
-        self.disable_probing_for_all_streams = screen_cfg.setdefault('disable_probing_for_all_streams', False)
-        self.nr_of_columns = screen_cfg.setdefault('nr_of_columns', 2)
         self.name = screenname
-        self.screen_cfg = screen_cfg
-        self.camera_streams_cfg = screen_cfg["camera_streams"]
-        self.duration = self.screen_cfg.setdefault('duration', 30)
-        logger.debug("Screen: " + self.name + " duration from config is: " + str(self.duration))
+        self._read_screen_cfg(screen_cfg)
         self.drawinstance = drawinstance
         self.first_run = True
         self.start_of_active_time = -1
         self.previous_connectable_camera_streams = []
+        self.connectable_camera_streams = []
+        self.cam_streams_to_draw = []
+        #Camera streams that are started on this screen, with the (coordinates, layer) they were started with
+        self.running_streams = {}
 
 
         ## Init functions
         # Sets internal variable resolution
         self.resolution_width = int(display["resolution"]["width"])
         self.resolution_height = int(display["resolution"]["height"])
+        #Used to give every camera stream of this screen a unique name, also when streams are added by a config reload
+        self.cam_stream_counter = 0
         self._init_camera_streams()
+        self._read_probe_deadline()
 
+    def _read_screen_cfg(self, screen_cfg):
+        #The config as it was written, before defaults are filled in, used to detect changes when the config is reloaded
+        self.original_screen_cfg = copy.deepcopy(screen_cfg)
+        self.disable_probing_for_all_streams = screen_cfg.setdefault('disable_probing_for_all_streams', False)
+        self.nr_of_columns = screen_cfg.setdefault('nr_of_columns', 2)
+        self.screen_cfg = screen_cfg
+        self.camera_streams_cfg = screen_cfg["camera_streams"]
+        self.duration = self.screen_cfg.setdefault('duration', 30)
+        logger.debug("Screen: %s duration from config is: %s", self.name, self.duration)
+
+    def _read_probe_deadline(self):
+        #All streams of this screen are probed in parallel, so by default the slowest single probe bounds the total probe time
+        self.probe_deadline = self.screen_cfg.setdefault('probe_deadline', max([cam_stream.probe_timeout for cam_stream in self.all_camera_streams], default=3) + 1)
+
+    def apply_config(self, screen_cfg):
+        '''
+        Applies a reloaded config of this screen in place and returns True if it changed.
+        Camera streams with an unchanged config are kept, so they keep playing if this screen is shown. Removed streams are stopped
+        '''
+        if screen_cfg == self.original_screen_cfg:
+            return False
+        logger.info("Screen: %s config changed, applying it", self.name)
+        self._read_screen_cfg(screen_cfg)
+
+        unused_camera_streams = list(self.all_camera_streams)
+        self.all_camera_streams = []
+        for camera_stream in self.camera_streams_cfg:
+            cam_stream = next((cam_stream for cam_stream in unused_camera_streams if cam_stream.original_cfg == camera_stream), None)
+            if cam_stream is None:
+                cam_stream = self._create_camera_stream(camera_stream)
+                logger.info("Screen: %s added camera stream %s", self.name, cam_stream.name)
+            else:
+                unused_camera_streams.remove(cam_stream)
+            self.all_camera_streams.append(cam_stream)
+        self._read_probe_deadline()
+
+        for cam_stream in unused_camera_streams:
+            logger.info("Screen: %s removed camera stream %s", self.name, cam_stream.name)
+        self._stop_running_streams([cam_stream for cam_stream in unused_camera_streams if cam_stream in self.running_streams])
+        self.connectable_camera_streams = [cam_stream for cam_stream in self.connectable_camera_streams if cam_stream in self.all_camera_streams]
+        self.cam_streams_to_draw = self.connectable_camera_streams
+        #Force a redraw the next time this screen is updated, streams that keep their coordinates keep playing
+        self.previous_connectable_camera_streams = []
+        self.first_run = True
+        return True
 
     def has_image_url(self):
         """Returns True if this screen has at least one stream that is an imageurl"""
@@ -46,48 +101,74 @@ class Screen:
         for camera_stream in self.all_camera_streams:
             if camera_stream.is_imageurl():
                 logger.debug(
-                    "Screen: " + self.name + " has_image_url: detected at least one imageurl: " + camera_stream.name )
+                    "Screen: %s has_image_url: detected at least one imageurl: %s", self.name, camera_stream.name )
                 return True
         return False
 
+    def get_warm_up_images(self):
+        '''Returns the (image path, width, height) of the images that are drawn when all streams of this screen are connectable'''
+        if len(self.all_camera_streams) == 0:
+            return [("images/noconnectable.png", self.resolution_width, self.resolution_height)]
+        tiles, placeholders = self._calculate_layout(self.all_camera_streams)
+        images = [("images/placeholder.png", width, height) for x, y, width, height in placeholders]
+        for cam_stream, coordinates in tiles:
+            images.append(("images/connecting.png", int(coordinates[2] - coordinates[0]), int(coordinates[3] - coordinates[1])))
+        return images
+
+    def get_player_keys(self):
+        '''Returns the keys of the players the next update_screen would run, so players of another screen with the same key can be shared'''
+        if len(self.cam_streams_to_draw) == 0:
+            return set()
+        tiles, placeholders = self._calculate_layout(self.cam_streams_to_draw)
+        return set([cam_stream.get_player_key(coordinates) for cam_stream, coordinates in tiles]) - set([None])
+
+    def stop_streams_not_in(self, player_keys):
+        '''Stops the running streams whose player key is not in player_keys'''
+        self._stop_running_streams([cam_stream for cam_stream, (coordinates, layer) in self.running_streams.items() if cam_stream.get_player_key(coordinates) not in player_keys])
+
+    def get_probed_camera_streams(self):
+        '''Returns the camera streams that need to be probed, which are none if disable_probing_for_all_streams is set'''
+        if self.disable_probing_for_all_streams:
+            return []
+        return self.all_camera_streams
+
     def _init_camera_streams(self):
         '''Instantiate camera instances and put them in a list'''
         self.all_camera_streams = []
-        counter = 0
         for camera_stream in self.camera_streams_cfg:
-            counter = counter + 1
-            cam_stream_name = self.name + "_cam_stream" + str(counter)
-            cam_stream = CameraStream(cam_stream_name, camera_stream, self.drawinstance, self.display_vlc_hdmi_id)
-            self.all_camera_streams.append(cam_stream)
+            self.all_camera_streams.append(self._create_camera_stream(camera_stream))
+
+    def _create_camera_stream(self, camera_stream):
+        self.cam_stream_counter = self.cam_stream_counter + 1
+        cam_stream_name = self.name + "_cam_stream" + str(self.cam_stream_counter)
+        return CameraStream(cam_stream_name, camera_stream, self.drawinstance, self.display_vlc_hdmi_id)
 
     def update_connectable_camera_streams(self, skip = False):
         '''Filters a list of camerastream instances into a new list of connectable camera_streams'''
         if skip:
-            logger.debug("Screen: " + self.name + " Skipping checking connectable cameras, skip value is: " + str(skip))
+            logger.debug("Screen: %s Skipping checking connectable cameras, skip value is: %s", self.name, skip)
             # Sometimes we do not want to wait on checking connectable camera streams, so this shortcut is taken (essentially skip checking)
             if self.first_run:
                 # We need the camera stream to be initialised with something in the beginning if we decide to skip the checking of connectivity
-                logger.debug("Screen: " + self.name + " first run")
+                logger.debug("Screen: %s first run", self.name)
                 self.connectable_camera_streams = self.all_camera_streams
                 self.first_run = False
             else:
                 self.connectable_camera_streams = self.previous_connectable_camera_streams
         else:
-            logger.debug("Screen: Start polling connectivity for the camera_streams part of screen: " + self.name)
-            self.connectable_camera_streams=[]
-            for cam_stream in self.all_camera_streams:
-                    if cam_stream.is_connectable():
-                        self.connectable_camera_streams.append(cam_stream)
+            logger.debug("Screen: Start polling connectivity for the camera_streams part of screen: %s", self.name)
+            #Results published by the background health checker are used when they are recent enough, only stale streams are probed here
+            probe_results = probe_camera_streams(self.all_camera_streams, self.probe_deadline, self.name, max_age=probe_cache_ttl)
+            #Keep the configured order of the streams
+            self.connectable_camera_streams = [cam_stream for cam_stream in self.all_camera_streams if probe_results[cam_stream]]
 
         self.cam_streams_to_draw = self.connectable_camera_streams
-        self.cam_streams_to_stop = self.previous_connectable_camera_streams
 
 
     def destroy(self):
-        logger.debug("Screen: Destroying screen: " + self.name)
+        logger.debug("Screen: Destroying screen: %s", self.name)
 
-        for cam_stream_to_stop in self.previous_connectable_camera_streams:
-            cam_stream_to_stop.stop_stream()
+        self._stop_running_streams(list(self.running_streams))
 
         # Reset vars for next iteration of this screen, object stays in memory
         self.previous_connectable_camera_streams = []
@@ -96,27 +177,27 @@ class Screen:
 
     def set_layer(self,layer):
         self.layer = layer
-        logger.debug("Screen: layer for screen " + self.name + " has been set to " + str(self.layer))
+        logger.debug("Screen: layer for screen %s has been set to %s", self.name, self.layer)
 
     def get_layer(self):
         return self.layer
 
-    def reset_layer(self):
-        logger.debug("Screen: layer for screen " + self.name + " will be reset to " + str(self.layer_init_value) + " coming from " + str(self.layer))
-        self.layer=self.layer_init_value
-
     def reset_active_timer(self):
-        logger.debug("Screen: reset_active_timer " + self.name)
+        logger.debug("Screen: reset_active_timer %s", self.name)
         #Set start time
-        self.start_of_active_time = time.time()
-        logger.debug("Screen: " + self.name + " start_of_active_time: " + str(self.start_of_active_time))
+        self.start_of_active_time = time.monotonic()
+        logger.debug("Screen: %s start_of_active_time: %s", self.name, self.start_of_active_time)
 
     def get_active_run_time(self):
         '''Returns how long the screen is in active mode'''
-        active_run_time = int(round((time.time() - self.start_of_active_time)))
-        logger.debug("Screen: " + self.name + " active_run_time: " + str(active_run_time) + " / " + str(self.duration))
+        active_run_time = int(round((time.monotonic() - self.start_of_active_time)))
+        logger.debug("Screen: %s active_run_time: %s / %s", self.name, active_run_time, self.duration)
         return active_run_time
 
+    def get_active_remaining_time(self):
+        '''Returns how many seconds are left before this screen has been active for its duration'''
+        return self.duration - (time.monotonic() - self.start_of_active_time)
+
     def _is_connectable_streams_changed(self):
         """Returns True if previous_connectable_camera_streams list has different items from connectable_camera_streams regardless of order"""
         #logger.debug(f"connectable_camera_streams {collections.Counter(self.connectable_camera_streams)} previous_connectable_camera_streams {collections.Counter(self.previous_connectable_camera_streams)}")
@@ -126,102 +207,173 @@ class Screen:
             return True
 
     def update_screen(self):
+        #All placeholders and images of one redraw are presented on the display at once
+        with self.drawinstance.frame():
+            self._update_screen()
+
+    def _calculate_layout(self, cam_streams):
+        """Returns the coordinates [x1,y1,x2,y2] for every camera stream and the placeholders (x, y, width, height) that fill the unused screen space"""
+        tiles = []
+        placeholders = []
+        nr_of_columns=int(self.nr_of_columns)
+        fields = len(cam_streams)
+
+        #If you have less fields than columns then only set fields amount columns
+        if fields <= nr_of_columns:
+            nr_of_columns=fields
+
+        #We calculate needed numbers of rows based on how many fields we have and how many columns per row we want
+        nr_of_rows=math.ceil(float(fields)/nr_of_columns)
+
+        default_fieldwidth=int(self.resolution_width/nr_of_columns)
+        default_fieldheight=int(self.resolution_height/nr_of_rows)
+
+        normal_fieldwidth=default_fieldwidth
+        normal_fieldheight=default_fieldheight
+
+        currentrow=1
+        currentwindow=1
+        currentrowlength=nr_of_columns
+
+        x1=0
+        y1=0
+        x2=normal_fieldwidth
+        y2=normal_fieldheight
+
+        for cam_stream in cam_streams:
+
+            if currentwindow > currentrowlength:
+                #This is a new row event
+                x1=0
+                x2=normal_fieldwidth
+                y1=y1 + normal_fieldheight
+                y2=y2 + normal_fieldheight
+
+                currentrow = currentrow + 1
+                #Next row ends when we are at following currentwindow index number
+                currentrowlength = currentrowlength + nr_of_columns
+            else:
+                #This is a window in the same row
+                x1=x1 + normal_fieldwidth
+                x2=x2 + normal_fieldwidth
+
+            #If this is the first field/window override some settings
+            if currentwindow == 1:
+                x1=0
+                x2=normal_fieldwidth
+
+            if currentwindow == fields:
+                #Start calculation to display placeholders
+                free_horizontal_pixels = self.resolution_width - x2
+                #If we have some unused screen space. Start drawing placeholders to fill the free space
+                if free_horizontal_pixels > 0:
+                    logger.debug("Screen: We have %s free_horizontal_pixels unused screen. Start drawing placeholders to fill the free space", free_horizontal_pixels)
+                    nr_of_placeholders=free_horizontal_pixels/normal_fieldwidth
+                    count_placeholders = 0
+                    placeholder_x = x1 + normal_fieldwidth
+                    placeholder_y = y1
+                    while count_placeholders < nr_of_placeholders:
+                        placeholders.append((placeholder_x, placeholder_y, normal_fieldwidth, normal_fieldheight))
+                        count_placeholders = count_placeholders + 1
+                        placeholder_x = placeholder_x + normal_fieldwidth
+
+            # x1 #x coordinate upper left corner
+            # y1 #y coordinate upper left corner
+            # x2 #x coordinate absolute where window should end, count from left to right
+            # y2 #y coordinate from where window should end, count from top to bottom of screen
+            #force_coordinates of a stream override the pre-calculated coordinates
+            tiles.append((cam_stream, cam_stream.resolve_coordinates([x1,y1,x2,y2])))
+
+            currentwindow = currentwindow + 1
+
+        return tiles, placeholders
+
+    def stop_streams(self, cam_streams):
+        '''Stops all given camera streams at once and waits for them together'''
+        #Players that other screens still use keep running
+        handles = [handle for handle in [player_registry.release(cam_stream) for cam_stream in cam_streams] if handle is not None]
+        if handles:
+            logger.debug("Screen: %s stopping %s streams", self.name, len(handles))
+            supervisor.stop_players(handles, stream_stop_timeout)
+        for cam_stream in cam_streams:
+            cam_stream.player_handle = None
+
+    def wait_until_ready(self, timeout):
+        '''Waits at most timeout seconds until all started streams of this screen show their first picture, returns False if the timeout expired'''
+        handles = [cam_stream.player_handle for cam_stream in self.running_streams if cam_stream.player_handle is not None]
+        return supervisor.wait_for_first_frames(handles, timeout)
+
+    def start_streams(self, tiles):
+        '''Starts all given (camera stream, coordinates) at once on the layer of this screen'''
+        cam_streams = []
+        command_lines = []
+        players_to_start = []
+        player_handles = {}
+        for cam_stream, coordinates in tiles:
+            command_line = cam_stream.prepare_start(coordinates, self.layer)
+            if command_line is None:
+                continue
+            #A stream that another screen already shows at the same place keeps playing in that player
+            shared_handle = player_registry.share(cam_stream, command_line)
+            if shared_handle is not None:
+                player_handles[cam_stream] = shared_handle
+                continue
+            cam_streams.append(cam_stream)
+            command_lines.append(command_line)
+            players_to_start.append((cam_stream.name, command_line, cam_stream.backoff_settings, cam_stream.decoder_cost))
+        for cam_stream, command_line, handle in zip(cam_streams, command_lines, supervisor.start_players(players_to_start)):
+            player_registry.add(cam_stream, command_line, handle)
+            player_handles[cam_stream] = handle
+        #Drawing the status of the streams needs to happen from this thread
+        for cam_stream, coordinates in tiles:
+            cam_stream.finish_start(player_handles.get(cam_stream))
+
+    def _stop_running_streams(self, cam_streams):
+        self.stop_streams(cam_streams)
+        for cam_stream in cam_streams:
+            del self.running_streams[cam_stream]
+
+    def _update_screen(self):
         # Other option to compare could be with to convert the list into a set: print set(connectable_camera_streams) == set(previous_connectable_camera_streams)
         # Only re-draw screen if something is changed or try redrawing if there is no camerastream that is connectable OR if we change the screen
         if self._is_connectable_streams_changed() or len(self.previous_connectable_camera_streams) == 0:
-            logger.debug(f"Screen {self.name} needs update/redraw: changes in connectable camera streams detected.( previous: {len(self.previous_connectable_camera_streams)} / now: {len(self.connectable_camera_streams)} or different connectable streams then before )")
-            #Stop all running streams before redrawing
-            for cam_stream_to_stop in self.cam_streams_to_stop:
-                cam_stream_to_stop.stop_stream()
-
-
-            nr_of_columns=int(self.nr_of_columns)
+            logger.debug("Screen %s needs update/redraw: changes in connectable camera streams detected.( previous: %s / now: %s or different connectable streams then before )", self.name, len(self.previous_connectable_camera_streams), len(self.connectable_camera_streams))
 
             # Start algorithm to start new streams
             fields = len(self.cam_streams_to_draw)
-            logger.debug( "Screen: " + self.name + " number of fields= " + str(fields))
+            logger.debug( "Screen: %s number of fields= %s", self.name, fields)
 
             if fields == 0:
+                self._stop_running_streams(list(self.running_streams))
                 #Draw no connectable placeholder
                 self.drawinstance.placeholder(0, 0, self.resolution_width, self.resolution_height, "images/noconnectable.png")
                 self.previous_connectable_camera_streams = self.connectable_camera_streams
                 return
 
-
-            #If you have less fields than columns then only set fields amount columns
-            if fields <= nr_of_columns:
-                nr_of_columns=fields
-
-            #We calculate needed numbers of rows based on how many fields we have and how many columns per row we want
-            nr_of_rows=math.ceil(float(fields)/nr_of_columns)
-
-            default_fieldwidth=int(self.resolution_width/nr_of_columns)
-            default_fieldheight=int(self.resolution_height/nr_of_rows)
-
-            normal_fieldwidth=default_fieldwidth
-            normal_fieldheight=default_fieldheight
-
-            currentrow=1
-            currentwindow=1
-            currentrowlength=nr_of_columns
-
-            x1=0
-            y1=0
-            x2=normal_fieldwidth
-            y2=normal_fieldheight
-
-            for cam_stream in self.cam_streams_to_draw:
-
-                if currentwindow > currentrowlength:
-                    #This is a new row event
-                    x1=0
-                    x2=normal_fieldwidth
-                    y1=y1 + normal_fieldheight
-                    y2=y2 + normal_fieldheight
-
-                    currentrow = currentrow + 1
-                    #Next row ends when we are at following currentwindow index number
-                    currentrowlength = currentrowlength + nr_of_columns
-                else:
-                    #This is a window in the same row
-                    x1=x1 + normal_fieldwidth
-                    x2=x2 + normal_fieldwidth
-
-                #If this is the first field/window override some settings
-                if currentwindow == 1:
-                    x1=0
-                    x2=normal_fieldwidth
-
-                if currentwindow == fields:
-                    #Start calculation to display placeholders
-                    free_horizontal_pixels = self.resolution_width - x2
-                    #If we have some unused screen space. Start drawing placeholders to fill the free space
-                    if free_horizontal_pixels > 0:
-                        logger.debug("Screen: We have " + str(free_horizontal_pixels) + " free_horizontal_pixels unused screen. Start drawing placeholders to fill the free space")
-                        nr_of_placeholders=free_horizontal_pixels/normal_fieldwidth
-                        count_placeholders = 0
-                        placeholder_x = x1 + normal_fieldwidth
-                        placeholder_y = y1
-                        while count_placeholders < nr_of_placeholders:
-                            self.drawinstance.placeholder(placeholder_x, placeholder_y, normal_fieldwidth, normal_fieldheight, "images/placeholder.png")
-                            count_placeholders = count_placeholders + 1
-                            placeholder_x = placeholder_x + normal_fieldwidth
-
-                logger.debug("Screen: cam stream name =" + cam_stream.name)
-                cam_stream_name = "cam_stream" + str(currentwindow)
-                # x1 #x coordinate upper left corner
-                # y1 #y coordinate upper left corner
-                # x2 #x coordinate absolute where window should end, count from left to right
-                # y2 #y coordinate from where window should end, count from top to bottom of screen
-                cam_stream.start_stream([x1,y1,x2,y2], self.layer)
-                #Debug test
-                #cam_stream.set_videopos([x1 + 50 ,y1 +50 ,x2 +50 ,y2 +50])
-
-                currentwindow = currentwindow + 1
+            tiles, placeholders = self._calculate_layout(self.cam_streams_to_draw)
+
+            #Only streams that disappeared or that need other coordinates are stopped, streams that keep their place keep playing
+            new_running_streams = {cam_stream: (coordinates, self.layer) for cam_stream, coordinates in tiles}
+            self._stop_running_streams([cam_stream for cam_stream in self.running_streams if self.running_streams[cam_stream] != new_running_streams.get(cam_stream)])
+
+            for placeholder_x, placeholder_y, placeholder_width, placeholder_height in placeholders:
+                self.drawinstance.placeholder(placeholder_x, placeholder_y, placeholder_width, placeholder_height, "images/placeholder.png")
+
+            tiles_to_start = []
+            #Checked once, so the loop below does not pay for debug logging when it is disabled
+            debug_enabled = logger.isEnabledFor(logging.DEBUG)
+            for cam_stream, coordinates in tiles:
+                if cam_stream in self.running_streams:
+                    if debug_enabled:
+                        logger.debug("Screen: %s cam stream %s keeps coordinates %s, keep it running", self.name, cam_stream.name, coordinates)
+                    continue
+                if debug_enabled:
+                    logger.debug("Screen: cam stream name =%s", cam_stream.name)
+                tiles_to_start.append((cam_stream, coordinates))
+                self.running_streams[cam_stream] = new_running_streams[cam_stream]
+            self.start_streams(tiles_to_start)
         else:
-            logger.debug("Screen: Connectable camera streams stayed the same, from " + str(
-                len(self.previous_connectable_camera_streams)) + " to " + str(
-                len(self.connectable_camera_streams)) + ", screen: " + self.name + " does not need full redraw")
+            logger.debug("Screen: Connectable camera streams stayed the same, from %s to %s, screen: %s does not need full redraw", len(self.previous_connectable_camera_streams), len(self.connectable_camera_streams), self.name)
 
         self.previous_connectable_camera_streams = self.connectable_camera_streams
 
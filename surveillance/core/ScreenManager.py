@@ -1,8 +1,16 @@
 import logging
+import time
 import yaml
 
-from .Screen import Screen
+from core.util.config import cfg
+
+from .Screen import Screen, stream_stop_timeout
+from .PlayerRegistry import player_registry, share_players
+from .PlayerSupervisor import supervisor
+from .CameraStream import supported_schemes
 from core.util.draw import Draw
+from core.util.layers import LayerAllocator
+from core.util.metrics import rotation_duration_seconds
 
 
 
@@ -10,7 +18,7 @@ logger = logging.getLogger('l_default')
 
 class ScreenManager:
     """This class creates and handles screens objects and rotation"""
-    def __init__(self,screen_manager_name, display, enable_opportunistic_caching_next_screen, disable_pygame):
+    def __init__(self,screen_manager_name, display, enable_opportunistic_caching_next_screen, disable_pygame, resource_budget=None, health_checker=None):
         self.name = screen_manager_name
         self.want_to_be_destroyed = False
         self.firstrun = True
@@ -25,189 +33,413 @@ class ScreenManager:
             self.drawinstance.insert_black_background(int(self.display["resolution"]["width"]), int(self.display["resolution"]["height"]),self.display["display_number"])
 
         self.enable_opportunistic_caching_next_screen = enable_opportunistic_caching_next_screen
-
-        self.futurecacheindex = 1
-        self.currentcacheindex = -1
-
+        #Decides per screen if there are enough resources left to cache it, None means always cache
+        self.resource_budget = resource_budget
+        #The camera streams of every screen are registered here once the screen is instantiated
+        self.health_checker = health_checker
+        #With fast_startup only the active screen is instantiated at startup, the others once they are cached or shown
+        self.fast_startup = cfg['advanced']['fast_startup'] if 'fast_startup' in cfg["advanced"] else True
+        #On rotation wait at most this many seconds until all streams of the cached screen show video, 0 rotates right away
+        self.rotation_ready_timeout = cfg['advanced']['rotation_ready_timeout'] if 'rotation_ready_timeout' in cfg["advanced"] else 0
+
+        #How many screens are kept cached behind the active screen
+        self.cache_depth = cfg['advanced']['cache_depth'] if 'cache_depth' in cfg["advanced"] else 1
+        #Indexes of the cached screens, ordered from the highest layer (right behind the active screen) to the lowest
+        self.cached_indexes = []
+        #Indexes of the screens that were selected by hand, the most recent last
+        self.recently_selected_indexes = []
+        #Layer of the black layer that hides the cached screens, None if there is none
+        self.black_layer = None
+        #Hands out the layers of the active and the cached screens, every display has its own layers
+        self.layer_allocator = LayerAllocator(f"{self.name}_layers")
 
         self._init_screens()
 
 
     def _fetch_display_config(self):
-        configpath=f"conf/display{int(self.display['hdmi']) + 1 }.yml"
-        logger.debug(f"{self.name}: Looking for config file {configpath}")
-        with open(configpath, 'r') as ymlfile:
-            cfg = yaml.load(ymlfile)
+        self.configpath=f"conf/display{int(self.display['hdmi']) + 1 }.yml"
+        logger.debug("%s: Looking for config file %s", self.name, self.configpath)
+        with open(self.configpath, 'r') as ymlfile:
+            cfg = yaml.load(ymlfile, Loader=yaml.Loader)
             self.screens_cfg=cfg['essentials']['screens']
             self.disable_autorotation = cfg['essentials'].setdefault('disable_autorotation', False)
 
-    def _create_cached_screen(self):
-
-        #Remove any previous black layer, if any. _create_cached_screen is called in any scenario even when no real cache needs to be drawn
-        self.drawinstance.kill_black_layer()
-
-        #We need to draw the cached screen behind the current active screen, but we need to leave extra free layers between the cached screen and the current active screen
-        # - one layer is needed for a black background so that the cached screen is hidden at all times
+    def get_config_path(self):
+        return self.configpath
+
+    def _validate_screens_cfg(self, screens_cfg):
+        '''Raises ValueError if screens_cfg can not be applied, so a reload with a typo does not take down the running screens'''
+        if not isinstance(screens_cfg, list) or len(screens_cfg) == 0:
+            raise ValueError("no screens configured")
+        for screen_cfg in screens_cfg:
+            if not isinstance(screen_cfg, dict) or not isinstance(screen_cfg.get("camera_streams"), list):
+                raise ValueError("every screen needs a list of camera_streams")
+            for camera_stream in screen_cfg["camera_streams"]:
+                if not isinstance(camera_stream, dict) or not isinstance(camera_stream.get("url"), str):
+                    raise ValueError("every camera stream needs an url")
+                if camera_stream["url"].split("://")[0] not in supported_schemes:
+                    raise ValueError(f"scheme of {camera_stream['url'].split('://')[0]} is not supported")
+
+    def reload_config(self):
+        '''
+        Re-reads the display config and applies it. Only screens whose config changed are updated and camera streams with an unchanged config keep playing.
+        Returns (added camera streams, removed camera streams) that need to be probed, so the health checker can be updated
+        '''
+        previous_probed_camera_streams = self.get_probed_camera_streams()
+        previous_screens_cfg = self.screens_cfg
+        previous_disable_autorotation = self.disable_autorotation
+        try:
+            self._fetch_display_config()
+            self._validate_screens_cfg(self.screens_cfg)
+        except Exception as e:
+            logger.error("%s: could not reload %s, keep running with the previous config (%r)", self.name, self.configpath, e)
+            self.screens_cfg = previous_screens_cfg
+            self.disable_autorotation = previous_disable_autorotation
+            return [], []
+
+        changed_screens = []
+        for index, screen_cfg in enumerate(self.screens_cfg):
+            if index >= len(self.all_screens):
+                logger.info("%s: added screen %s", self.name, self._get_screen_name(index))
+                self.all_screens.append(None)
+                if not self.fast_startup:
+                    changed_screens.append(self._get_screen(index))
+            elif self.all_screens[index] is not None and self.all_screens[index].apply_config(screen_cfg):
+                changed_screens.append(self.all_screens[index])
+            #Screens that are not instantiated yet will use the new config once they are needed
+        for index in range(len(self.screens_cfg), len(self.all_screens)):
+            if self.all_screens[index] is None:
+                continue
+            logger.info("%s: removed screen %s", self.name, self.all_screens[index].name)
+            if index in self.cached_indexes:
+                #Also gives its layer back to the layer allocator
+                self._evict_cached_screen(index)
+            else:
+                self.all_screens[index].destroy()
+        del self.all_screens[len(self.screens_cfg):]
+        self.max_index = len(self.all_screens) - 1
+        self._warm_up_image_cache(changed_screens)
+
+        #Removed screens were stopped above
+        self.recently_selected_indexes = [index for index in self.recently_selected_indexes if index <= self.max_index]
+
+        if self.activeindex > self.max_index:
+            #The active screen does not exist anymore, start over like at startup
+            logger.info("%s: the active screen was removed, starting again with the first screen", self.name)
+            for screen in self._get_instantiated_screens(self.all_screens):
+                screen.destroy()
+            self.cached_indexes = []
+            self.activeindex = 0
+            self.layer_allocator.release_all()
+            self._get_screen(self.activeindex).set_layer(self.layer_allocator.allocate())
+            self._update_black_layer()
+            self.firstrun = True
+            self.rotate_next()
+            self.update_active_screen()
+        else:
+            active_screen = self._get_screen(self.activeindex)
+            if active_screen in changed_screens:
+                self.update_active_screen()
+            for index in self.cached_indexes:
+                cached_screen = self._get_screen(index)
+                if cached_screen in changed_screens:
+                    cached_screen.update_connectable_camera_streams(skip=cached_screen.disable_probing_for_all_streams)
+                    cached_screen.update_screen()
+            if not self.firstrun:
+                #The screens to cache depend on the number of screens and on imageurls of the active screen
+                self._update_cache()
+
+        probed_camera_streams = self.get_probed_camera_streams()
+        added_camera_streams = [cam_stream for cam_stream in probed_camera_streams if cam_stream not in previous_probed_camera_streams]
+        removed_camera_streams = [cam_stream for cam_stream in previous_probed_camera_streams if cam_stream not in probed_camera_streams]
+        return added_camera_streams, removed_camera_streams
+
+    def _get_wanted_cache_indexes(self):
+        '''
+        Returns the indexes of the screens that should be cached, most important first and at most cache_depth.
+        First the next screen in rotation order, then the screens that were recently selected by hand (most recent first), then the screens after the next screen in rotation order
+        '''
+        if self.max_index == 0 or not self.enable_opportunistic_caching_next_screen:
+            return []
+        rotation_order = [(self.activeindex + offset) % (self.max_index + 1) for offset in range(1, self.max_index + 1)]
+        wanted_indexes = [rotation_order[0]] + list(reversed(self.recently_selected_indexes)) + rotation_order[1:]
+        wanted_indexes = [index for index in dict.fromkeys(wanted_indexes) if index != self.activeindex]
+        return wanted_indexes[:self.cache_depth]
+
+    def _allocate_cache_layer(self, position):
+        '''Returns the layer for a screen cached at position (0 is right behind the active screen), None if there is no free layer at that position'''
+        if position == 0:
+            above_layer = self._get_screen(self.activeindex).get_layer()
+        else:
+            above_layer = self._get_screen(self.cached_indexes[position - 1]).get_layer()
+        if position == len(self.cached_indexes):
+            #Leave room to cache a more important screen in between later
+            return self.layer_allocator.allocate(lower_than=above_layer, gap=self.cache_depth)
+        return self.layer_allocator.allocate(lower_than=above_layer, higher_than=self._get_screen(self.cached_indexes[position]).get_layer())
+
+    def _update_cache(self):
+        '''
+        Starts the wanted screens hidden behind the active screen and stops the cached screens that are not wanted anymore.
+        Cached screens are kept in the order of their layers, the first one has the highest layer, right behind the active screen
+        '''
+        #We need to draw the cached screens behind the current active screen, the layer allocator leaves extra free layers between a cached screen and the screen in front of it
+        # - one layer is needed for a black background so that the cached screens are hidden at all times
         # - another layer is needed for caching "showontop" streams, these need to go behind the black background but before the normal cached screens
-        #Summary layers (optional) "showontop" stream > normal active streams > pngview black screen > (optional) "showontop" cached streams > normal cached streams
-        self.futurelayer=self.all_screens[self.activeindex].get_layer() - 3
-        self.all_screens[self.futurecacheindex].set_layer(self.futurelayer)
-
-        self.skip_cache_once = False
-        self.lowerthreshold_layer = 2000
-        #We may not go in the lower layers since that is where pygame and the console buffer resides
-        #If we go to low the latter will be drawn over our videos
-        if self.all_screens[self.futurecacheindex].get_layer() < self.lowerthreshold_layer:
-            logger.debug(f"{self.name}: skip caching next screen: {self.all_screens[self.futurecacheindex].name} once, because we need to reset the layer counter")
-            self.all_screens[self.futurecacheindex].reset_layer()
-            # We need to skip caching once when resetting the counter, otherwise the future screen thats needs to be cached will be shown over the activescreen
-            self.skip_cache_once = True
-
-        if self.all_screens[self.activeindex].has_image_url():
-            #TL;DR: If the CURRENT ACTIVE screen has imageurl then do not cache next screen as the next screen is not guaranteed to have gaps where the imageurl should be displayed
-            #   The current and the next screen video camerastreams positions are always drawn on layers above the pygame layer.
+        #Summary layers (optional) "showontop" stream > normal active streams > pngview black screen > ((optional) "showontop" cached streams > normal cached streams) for every cached screen
+        wanted_indexes = self._get_wanted_cache_indexes()
+        if wanted_indexes and self._get_screen(self.activeindex).has_image_url():
+            #TL;DR: If the CURRENT ACTIVE screen has imageurl then do not cache screens as the cached screens are not guaranteed to have gaps where the imageurl should be displayed
+            #   The current and the cached screens video camerastreams positions are always drawn on layers above the pygame layer.
             #   For the active screen this is no problem as it knows where to leaves gaps. Through these gaps we can view the lower pygame layer (where the image urls are displayed).
-            #   However, if the next screen (cached) is drawn on a gap of the current screen then we can not peak through to the lowest layers where pygame lives anymore
+            #   However, if a cached screen is drawn on a gap of the current screen then we can not peak through to the lowest layers where pygame lives anymore
             #   Note that we can not make this more dynamic by explicitely checking for connectable image url, because then a screen starting with imageurl that will become connected later during the same run
             #   can not be displayed because the cached screen was already drawn on top of the pygame layer
-            logger.info(
-                f"{self.name}: skip caching next screen: {self.all_screens[self.futurecacheindex].name} (pygame, used to display image, is not compatible with dispmanx layers caching mechanism)")
-            self.skip_cache_once = True
-
-        # Check what streams are connectable for the next screen and update this next screens= instance with the information
-        if self.get_future_cached_screen_disable_probing_for_all_streams():
-            # Do not check for connectable cameras when disable_probing_for_all_streams is set to true, just try to draw all of them, and hard fail for the ones that are not connectable
-            self.all_screens[self.futurecacheindex].update_connectable_camera_streams(skip=True)
-        else:
-            self.all_screens[self.futurecacheindex].update_connectable_camera_streams(skip=False)
-
-
-        if self.enable_opportunistic_caching_next_screen and not self.skip_cache_once:
-            logger.debug(
-                f"{self.name}: _create_cached_screen with index {self.futurecacheindex} updating screen: {self.all_screens[self.futurecacheindex].name} in cache")
-
-            #Insert black screen on top of cached layer, so that it does not bleed through in some cases (like when active screen is still building up or on redrawing active screen)
-            #We can not use pygame for this, like we do when caching is disabled, since pygame will always draw on the same low layer and will thus be drawn over by both the active and the cached screen
-            #We do not insert a black screen if there is no cache needed
-            self.drawinstance.insert_black_layer(int(self.display["resolution"]["width"]), int(self.display["resolution"]["height"]),
-                                    str(self.all_screens[self.futurecacheindex].get_layer() + 2), self.display["display_number"])
-
-            #Update the screen for a cached screen means: start all cvlc instances for this screen in the background
-            self.all_screens[self.futurecacheindex].update_screen()
+            logger.info("%s: skip caching screens (pygame, used to display image, is not compatible with dispmanx layers caching mechanism)", self.name)
+            wanted_indexes = []
+
+        for index in [index for index in self.cached_indexes if index not in wanted_indexes]:
+            self._evict_cached_screen(index)
+
+        for index in wanted_indexes:
+            if index in self.cached_indexes:
+                continue
+            #Cache behind the more important cached screens, so that showing a cached screen only needs to stop less important screens in front of it
+            wanted_position = len([cached_index for cached_index in self.cached_indexes if wanted_indexes.index(cached_index) < wanted_indexes.index(index)])
+            #If there are no free layers at that position, cache it behind all cached screens or else at any position with free layers
+            for position in [wanted_position] + list(range(len(self.cached_indexes), -1, -1)):
+                layer = self._allocate_cache_layer(position)
+                if layer is not None:
+                    break
+            if layer is None:
+                #Only happens when the active screen reached the lowest layers, the next screen that is not cached starts again on the highest layers
+                logger.info("%s: skip caching screen %s, because there are no free layers left behind the active screen", self.name, self._get_screen(index).name)
+                continue
+            if not self._cache_screen(index, position, layer):
+                self.layer_allocator.release(layer)
+
+        self._update_black_layer()
+        self._move_shared_players()
+        logger.debug("%s: active screen index %s, cached screen indexes %s", self.name, self.activeindex, self.cached_indexes)
+
+    def _cache_screen(self, index, position, layer):
+        '''Starts the screen at index hidden on layer, returns False if there are not enough resources left'''
+        screen = self._get_screen(index)
+        # Check what streams are connectable for the screen, do not check when disable_probing_for_all_streams is set to true, just try to draw all of them
+        screen.update_connectable_camera_streams(skip=screen.disable_probing_for_all_streams)
+        if self.resource_budget is not None:
+            if not self.resource_budget.can_cache(f"{self.name}: cache {screen.name}", screen.cam_streams_to_draw):
+                logger.info("%s: skip caching screen: %s because there are not enough resources left", self.name, screen.name)
+                return False
+        logger.debug("%s: caching screen %s on layer %s", self.name, screen.name, layer)
+        screen.set_layer(layer)
+        #Update the screen for a cached screen means: start all cvlc instances for this screen in the background
+        screen.update_screen()
+        self.cached_indexes.insert(position, index)
+        return True
+
+    def _evict_cached_screen(self, index):
+        logger.debug("%s: stop cached screen %s", self.name, self._get_screen(index).name)
+        self._get_screen(index).destroy()
+        self.layer_allocator.release(self._get_screen(index).get_layer())
+        self.cached_indexes.remove(index)
+
+    def _move_shared_players(self):
+        '''
+        A shared player keeps running on the layer it was started on. Once the active screen does not use it anymore, it is started again on the layer of the highest cached screen that uses it,
+        otherwise it would be shown over the active screen or over the next screen that is shown
+        '''
+        active_screen = self._get_screen(self.activeindex)
+        cam_streams = [cam_stream for index in self.cached_indexes for cam_stream in self._get_screen(index).running_streams]
+        old_handles = []
+        for shared_player in player_registry.get_shared_players(cam_streams):
+            if any(owner in active_screen.running_streams for owner in shared_player.owners):
+                continue
+            highest_owner = max(shared_player.owners, key=lambda cam_stream: cam_stream.layer)
+            if shared_player.layer != highest_owner.layer:
+                #The new player normally starts before the old one is stopped, so the picture does not go black. Without decoder headroom for both, stop the old one first
+                if self.resource_budget is None or self.resource_budget.has_decoder_headroom(f"{self.name}: move {highest_owner.name}", highest_owner.decoder_cost):
+                    old_handles.append(player_registry.move(shared_player, highest_owner))
+                else:
+                    player_registry.move(shared_player, highest_owner, stream_stop_timeout)
+        if old_handles:
+            supervisor.stop_players(old_handles, stream_stop_timeout)
+
+    def _update_black_layer(self):
+        #Insert black screen right behind the active screen, so that the cached screens do not bleed through in some cases (like when active screen is still building up or on redrawing active screen)
+        #We can not use pygame for this, like we do when caching is disabled, since pygame will always draw on the same low layer and will thus be drawn over by both the active and the cached screens
+        #We do not insert a black screen if nothing is cached
+        black_layer = self.layer_allocator.get_black_layer(self._get_screen(self.activeindex).get_layer()) if self.cached_indexes else None
+        if black_layer == self.black_layer:
+            return
+        self.drawinstance.kill_black_layer()
+        if black_layer is not None:
+            self.drawinstance.insert_black_layer(int(self.display["resolution"]["width"]), int(self.display["resolution"]["height"]), str(black_layer), self.display["display_number"])
+        self.black_layer = black_layer
+
+    def _show_screen(self, index, skip_probing):
+        '''
+        Makes the screen at index the active screen. A cached screen is shown right away by stopping the active screen and the cached screens in front of it,
+        any other screen is started in place of the active screen
+        '''
+        previous_active_screen = self._get_screen(self.activeindex)
+        screen = self._get_screen(index)
+        was_cached = index in self.cached_indexes
+        if was_cached:
+            if self.rotation_ready_timeout > 0 and screen.running_streams:
+                #Players of the cached screen that are still buffering would be shown as black tiles
+                if not screen.wait_until_ready(self.rotation_ready_timeout):
+                    logger.info("%s: not all streams of %s show video after %s seconds, showing it anyway", self.name, screen.name, self.rotation_ready_timeout)
+            #Cached screens in front of this screen would cover it
+            for cached_index in self.cached_indexes[:self.cached_indexes.index(index)]:
+                self._evict_cached_screen(cached_index)
+            self.cached_indexes.remove(index)
+            logger.debug("%s: destroying previous screen %s", self.name, previous_active_screen.name)
+            previous_active_screen.destroy()
+            self.layer_allocator.release(previous_active_screen.get_layer())
         else:
-            #If self.enable_opportunistic_caching_next_screen is False then the _create_cached_screen does not really create a cached screen, it only updates internal counters
-            logger.debug(f"{self.name}: Skip caching screen {self.all_screens[self.futurecacheindex].name} because of parameters enable_opportunistic_caching_next_screen: {self.enable_opportunistic_caching_next_screen} / skip_cache_once: {self.skip_cache_once}")
-
-        self.currentcacheindex = self.futurecacheindex
-        self.futurecacheindex = self.futurecacheindex + 1
-        if self.futurecacheindex > self.max_index:
-            logger.debug(f"{self.name}: futurecacheindex ({self.futurecacheindex} >= {self.max_index}), resetting futurecacheindex")
-            self.futurecacheindex = 0
+            screen.update_connectable_camera_streams(skip=skip_probing or screen.disable_probing_for_all_streams)
+            highest_cached_layer = self._get_screen(self.cached_indexes[0]).get_layer() if self.cached_indexes else None
+            layer = None
+            if share_players:
+                #Start the screen right behind the previous screen before stopping that one, so streams that both screens show at the same place keep playing
+                layer = self.layer_allocator.allocate(lower_than=previous_active_screen.get_layer(), higher_than=highest_cached_layer)
+            if layer is not None:
+                #The other streams are stopped first, so the players of both screens do not need decoders at the same time
+                previous_active_screen.stop_streams_not_in(screen.get_player_keys())
+            else:
+                logger.debug("%s: destroying previous screen %s", self.name, previous_active_screen.name)
+                previous_active_screen.destroy()
+                self.layer_allocator.release(previous_active_screen.get_layer())
+                previous_active_screen = None
+                #The highest free layers, which leaves the most room to cache screens behind it
+                layer = self.layer_allocator.allocate(higher_than=highest_cached_layer)
+            screen.set_layer(layer)
+
+        self.activeindex = index
+        logger.debug("%s: next screen: %s active", self.name, screen.name)
+        screen.reset_active_timer()
+        screen.update_screen()
+        if not was_cached and previous_active_screen is not None:
+            logger.debug("%s: destroying previous screen %s", self.name, previous_active_screen.name)
+            previous_active_screen.destroy()
+            self.layer_allocator.release(previous_active_screen.get_layer())
+        #Move the black layer behind the new active screen, a cached screen is visible from now on
+        self._update_black_layer()
+        #Cache screens for the next rotate
+        self._update_cache()
 
     def get_active_screen_run_time(self):
-        return self.all_screens[self.activeindex].get_active_run_time()
+        return self._get_screen(self.activeindex).get_active_run_time()
+
+    def get_active_screen_remaining_time(self):
+        return self._get_screen(self.activeindex).get_active_remaining_time()
 
     def get_active_screen_duration(self):
-        return self.all_screens[self.activeindex].duration
+        return self._get_screen(self.activeindex).duration
 
     def get_active_screen_disable_probing_for_all_streams(self):
-        return self.all_screens[self.activeindex].disable_probing_for_all_streams
-
-    def get_future_cached_screen_disable_probing_for_all_streams(self):
-        return self.all_screens[self.futurecacheindex].disable_probing_for_all_streams
+        return self._get_screen(self.activeindex).disable_probing_for_all_streams
 
     def force_show_screen(self, requested_index):
         '''this method force a particular screen to be shown on-screen'''
-        logger.debug(f"{self.name}: activeindex = {self.activeindex}, futurecacheindex = {self.futurecacheindex}")
+        logger.debug("%s: activeindex = %s, cached indexes = %s", self.name, self.activeindex, self.cached_indexes)
         if requested_index > self.max_index:
             #Note name of screens start with 1 but list of screens index start at 0
-            logger.debug(f"{self.name}: Force screen {requested_index + 1} requested, but this screen does not exist")
+            logger.debug("%s: Force screen %s requested, but this screen does not exist", self.name, requested_index + 1)
         elif requested_index == self.activeindex:
             #Note name of screens start with 1 but list of screens index start at 0
-            logger.debug(f"{self.name}: Force screen {requested_index + 1} requested, but this screen is already active")
-        elif requested_index == self.currentcacheindex:
-            #Note name of screens start with 1 but list of screens index start at 0
-            logger.debug(f"{self.name}: Force screen {requested_index + 1} requested, this screen is already in cache, do a normal rotate")
-            self.rotate_next()
+            logger.debug("%s: Force screen %s requested, but this screen is already active", self.name, requested_index + 1)
         else:
             #Note name of screens start with 1 but list of screens index start at 0
-            logger.debug(f"{self.name}: Force screen {requested_index + 1} requested")
-
-            #Destroy current active and cached screens
-            self.all_screens[self.activeindex].destroy()
-            self.all_screens[self.currentcacheindex].destroy()
-
-            #Show new requested screen
-            self.activeindex = requested_index
-            self.all_screens[requested_index].reset_active_timer()
+            logger.debug("%s: Force screen %s requested, in cache: %s", self.name, requested_index + 1, requested_index in self.cached_indexes)
+            #Screens selected by hand stay cached while they are among the cache_depth most recently selected screens
+            if requested_index in self.recently_selected_indexes:
+                self.recently_selected_indexes.remove(requested_index)
+            self.recently_selected_indexes.append(requested_index)
+            del self.recently_selected_indexes[:max(0, len(self.recently_selected_indexes) - self.cache_depth)]
             #For faster drawing skip probing(we are optimistic and assume all screens are connectable)
-            self.all_screens[requested_index].update_connectable_camera_streams(skip=True)
-            self.all_screens[requested_index].update_screen()
-
-            #Cache a new screen for next normal rotation.
-            self.futurecacheindex = requested_index + 1
-            if self.futurecacheindex > self.max_index:
-                logger.debug(f"{self.name} force screen futurecacheindex ({self.futurecacheindex} >= {self.max_index}), resetting futurecacheindex ")
-                self.futurecacheindex = 0
-            self._create_cached_screen()
+            self._show_screen(requested_index, skip_probing=True)
 
     def rotate_next(self):
         ''' this methods contains logic destroy the current screen so that the next screen which was started behind it is shown'''
 
         if self.max_index == 0:
-            logger.debug(f"{self.name}: only one screen configured, do not rotate")
+            logger.debug("%s: only one screen configured, do not rotate", self.name)
             #Screen are default started in cache/offscreen, reset_active_timer to show onscreen
-            self.all_screens[self.activeindex].reset_active_timer()
+            self._get_screen(self.activeindex).reset_active_timer()
             return
 
-        logger.debug(f"{self.name}: rotate event, indexes BEFORE rotate: futurecacheindex: {self.futurecacheindex} activeindex: {self.activeindex} max index is {self.max_index}")
-        #Delete current active screen
+        start_time = time.monotonic()
+        logger.debug("%s: rotate event, BEFORE rotate: activeindex: %s cached indexes: %s max index is %s", self.name, self.activeindex, self.cached_indexes, self.max_index)
         if self.firstrun:
-            #During firstrun we need to start an active screen and the next screen hidden on a layer lower then the active screen
+            #During firstrun we need to start an active screen and the next screens hidden on layers lower then the active screen
             #We do this, so that on a rotate event the next screen can be shown without delay as all streams are already connected
-            logger.debug(f"{self.name} starting first run active screen {self.all_screens[self.activeindex].name}")
-            self.all_screens[self.activeindex].reset_active_timer()
-            self._create_cached_screen()
+            logger.debug("%s starting first run active screen %s", self.name, self._get_screen(self.activeindex).name)
+            self._get_screen(self.activeindex).reset_active_timer()
+            self._update_cache()
             self.firstrun = False
 
         else:
-            #During normal rotate event we need to do 3 things
-            #- Destroy the current screen (cached screen in lower layer (if any) becomes visible)
-            #- Start a new cached offscreen screen
-            logger.debug(f"{self.name}: destroying previous screen {self.all_screens[self.activeindex].name}")
-            self.all_screens[self.activeindex].destroy()
-            #Now the cached screen should already be displayed because the active on top was destroyed
-            logger.debug(f"{self.name}: next screen: {self.all_screens[ self.currentcacheindex].name} active")
-            self.all_screens[self.currentcacheindex].reset_active_timer()
-            self.all_screens[self.currentcacheindex].update_screen()
-
-            self.activeindex = self.currentcacheindex
+            #During normal rotate event we need to do 2 things
+            #- Destroy the current screen (the next screen, if it is cached in a lower layer, becomes visible)
+            #- Start new cached offscreen screens
+            self._show_screen(self.activeindex + 1 if self.activeindex < self.max_index else 0, skip_probing=False)
+            logger.debug("%s: rotate event, AFTER rotate: activeindex: %s cached indexes: %s max index is %s", self.name, self.activeindex, self.cached_indexes, self.max_index)
 
-            #We also need to create a new cache for the next rotate
-            self._create_cached_screen()
-
-            logger.debug(f"{self.name}: rotate event, indexes AFTER rotate: futurecacheindex: {self.futurecacheindex} activeindex: {self.activeindex} max index is {self.max_index}")
+        rotation_duration_seconds.observe(time.monotonic() - start_time, screen_manager=self.name)
 
 
     def _init_screens(self):
-        '''This method initiates all screen instances'''
-        counter = 1
-        self.all_screens=[]
+        '''This method initiates the screen instances, with fast_startup only the first screen is instantiated here'''
         # -1 because list start at zero
         self.max_index = len(self.screens_cfg) - 1
-        for screen_cfg in self.screens_cfg:
-            logger.debug(f"{self.name}: Initialising screen with config {screen_cfg}")
-            self.all_screens.append(Screen(str(self.name) + "_screen" + str(counter), screen_cfg, self.display, self.drawinstance))
-            counter = counter + 1
+        self.all_screens = [None] * len(self.screens_cfg)
+        for index in range(len(self.screens_cfg)):
+            if index == self.activeindex or not self.fast_startup:
+                self._get_screen(index)
+        self._get_screen(self.activeindex).set_layer(self.layer_allocator.allocate())
 
         #Show a connecting screen on first run, so that in case of many streams = long initial startup, the user knows what is happening.
         self.drawinstance.placeholder(0, 0, int(self.display["resolution"]["width"]), int(self.display["resolution"]["height"]), "images/connecting.png")
         self.drawinstance.refresh()
 
+    def _get_screen_name(self, index):
+        return str(self.name) + "_screen" + str(index + 1)
+
+    def _get_screen(self, index):
+        '''Returns the screen at index, the screen is instantiated the first time it is needed'''
+        if self.all_screens[index] is None:
+            logger.debug("%s: Initialising screen with config %s", self.name, self.screens_cfg[index])
+            screen = Screen(self._get_screen_name(index), self.screens_cfg[index], self.display, self.drawinstance)
+            self.all_screens[index] = screen
+            self._warm_up_image_cache([screen])
+            if self.health_checker is not None:
+                self.health_checker.register(screen.get_probed_camera_streams())
+        return self.all_screens[index]
+
+    def _get_instantiated_screens(self, screens):
+        return [screen for screen in screens if screen is not None]
+
+    def _warm_up_image_cache(self, screens):
+        #Decode and scale the static images for the tile sizes of the screens, so redrawing a screen is only blitting
+        warm_up_image_cache = cfg['advanced']['warm_up_image_cache'] if 'warm_up_image_cache' in cfg["advanced"] else True
+        if warm_up_image_cache and screens:
+            warm_up_images = [("images/connecting.png", int(self.display["resolution"]["width"]), int(self.display["resolution"]["height"]))]
+            for screen in screens:
+                warm_up_images.extend(screen.get_warm_up_images())
+            self.drawinstance.warm_up(list(dict.fromkeys(warm_up_images)))
+
+    def get_probed_camera_streams(self):
+        '''Returns all camera streams of the instantiated screens that need to be probed'''
+        probed_camera_streams = []
+        for screen in self._get_instantiated_screens(self.all_screens):
+            probed_camera_streams.extend(screen.get_probed_camera_streams())
+        return probed_camera_streams
+
     def get_disable_autorotation(self):
         if self.disable_autorotation:
             logger.debug(
-                f"{self.name}: disable_autorotation is True, use input keyboard/mouse/touch only to rotate between screens")
+                "%s: disable_autorotation is True, use input keyboard/mouse/touch only to rotate between screens", self.name)
         return self.disable_autorotation
 
     def _init_drawinstance(self):
@@ -216,21 +448,31 @@ class ScreenManager:
     def get_drawinstance(self):
         return self.drawinstance
 
+    def show_first_screen(self):
+        '''Starts all streams of the active screen at once without waiting on probes, so video is shown as soon as possible after startup'''
+        active_screen = self._get_screen(self.activeindex)
+        logger.debug("%s: show first screen %s", self.name, active_screen.name)
+        active_screen.reset_active_timer()
+        active_screen.update_connectable_camera_streams(skip=True)
+        active_screen.update_screen()
+
     def update_active_screen(self,skip_update_connectable_camera = False):
         '''To be used in main loop and is used to update connectable and unconnectable camera streams on the current displayed screen'''
-        logger.debug(f"{self.name}: update_active_screen {self.all_screens[self.activeindex].name}")
+        logger.debug("%s: update_active_screen %s", self.name, self._get_screen(self.activeindex).name)
         if self.get_active_screen_disable_probing_for_all_streams():
             #disable_probing_for_all_streams has been requested, skip all smart logic
-            self.all_screens[self.activeindex].update_connectable_camera_streams(skip=True)
-            logger.debug(f"{self.name}: SKIPPING update_connectable_camera_streams, because disable_probing_for_all_streams for this screen {self.all_screens[self.activeindex].name} was set")
+            self._get_screen(self.activeindex).update_connectable_camera_streams(skip=True)
+            logger.debug("%s: SKIPPING update_connectable_camera_streams, because disable_probing_for_all_streams for this screen %s was set", self.name, self._get_screen(self.activeindex).name)
         else:
-            self.all_screens[self.activeindex].update_connectable_camera_streams(skip=False)
-            logger.debug(f"{self.name}: update_connectable_camera_streams, disable_probing_for_all_streams is off for this screen, so using probes {self.all_screens[self.activeindex].name}")
+            self._get_screen(self.activeindex).update_connectable_camera_streams(skip=False)
+            logger.debug("%s: update_connectable_camera_streams, disable_probing_for_all_streams is off for this screen, so using probes %s", self.name, self._get_screen(self.activeindex).name)
 
-        self.all_screens[self.activeindex].update_screen()
+        self._get_screen(self.activeindex).update_screen()
+        #Cached screens may have shared streams the active screen just stopped
+        self._move_shared_players()
 
     def destroy(self):
-        logger.debug(f"{self.name}: THIS IS THE END, DESTROYING")
-        for screen in self.all_screens:
+        logger.debug("%s: THIS IS THE END, DESTROYING", self.name)
+        for screen in self._get_instantiated_screens(self.all_screens):
             screen.destroy()
         self.drawinstance.destroy()
@@ -0,0 +1,81 @@
+import logging
+import threading
+import time
+
+from . import worker
+from .util.config import cfg
+from .util.metrics import player_stalls_total
+from .util.vlcrc import PlayerControlError
+
+logger = logging.getLogger('l_default')
+
+
+class StallWatchdog:
+    """
+    This class samples the decode statistics of every running player in a background thread over its control channel.
+    A player that keeps running but made no progress for stall_timeout seconds shows a frozen picture, it is restarted by the supervisor
+    """
+    def __init__(self, supervisor, name="stall_watchdog"):
+        self.name = name
+        self.supervisor = supervisor
+        #A player whose decoded frames (or input bytes if it reports no frames) did not increase for this many seconds is restarted, 0 disables the watchdog
+        self.stall_timeout = cfg['advanced']['stall_timeout'] if 'stall_timeout' in cfg["advanced"] else 30
+        self.stall_check_interval = cfg['advanced']['stall_check_interval'] if 'stall_check_interval' in cfg["advanced"] else 5
+        #(handle, pid): (last progress counter, monotonic time it last changed)
+        self.progress = {}
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.stall_timeout <= 0:
+            logger.info("%s: stall detection is disabled", self.name)
+            return
+        if not worker.player_control:
+            logger.info("%s: stall detection needs player_control, it is disabled", self.name)
+            return
+        logger.info("%s: restarting players that show no progress for %s seconds, checking every %s seconds", self.name, self.stall_timeout, self.stall_check_interval)
+        self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _get_progress(self, stats):
+        '''Returns (name, value) of the counter that increases while the player shows video, value is None if the player reports none'''
+        if "decoded_frames" in stats:
+            return "decoded_frames", stats["decoded_frames"]
+        return "input_bytes_read", stats.get("input_bytes_read")
+
+    def check_players(self):
+        '''Samples all controlled players once and restarts the ones that are stalled, returns the names of the restarted players'''
+        now = time.monotonic()
+        progress = {}
+        stalled = []
+        for handle, name, pid, control in self.supervisor.get_controlled_players():
+            try:
+                state = control.get_state()
+                counter_name, counter = self._get_progress(control.get_stats())
+            except PlayerControlError as e:
+                #Not knowing is no reason to restart, for example vlc is still starting its rc interface
+                logger.debug("%s: could not sample %s %r", self.name, name, e)
+                if (handle, pid) in self.progress:
+                    progress[(handle, pid)] = self.progress[(handle, pid)]
+                continue
+            last_counter, last_progress_at = self.progress.get((handle, pid), (None, now))
+            if counter is None or counter != last_counter or state == "paused":
+                #A paused player is not stalled, the time without progress starts again when it resumes
+                last_progress_at = now
+            elif now - last_progress_at >= self.stall_timeout:
+                logger.error("%s: %s made no progress for %.0f seconds (%s stays at %s), restarting it", self.name, name, now - last_progress_at, counter_name, counter)
+                if self.supervisor.restart_stalled_player(handle, pid):
+                    player_stalls_total.inc(stream=name)
+                    stalled.append(name)
+                continue
+            progress[(handle, pid)] = (counter, last_progress_at)
+        #Forget players that were stopped or restarted
+        self.progress = progress
+        return stalled
+
+    def _run(self):
+        while not self.stop_event.wait(self.stall_check_interval):
+            self.check_players()
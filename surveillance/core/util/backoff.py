@@ -0,0 +1,121 @@
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger('l_default')
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+def backoff_settings_from_config(camera_stream):
+    '''Reads the backoff and circuit breaker options of one camera stream from the display config, with defaults'''
+    return {
+        "initial_delay": camera_stream.setdefault("backoff_initial_delay", 1),
+        "max_delay": camera_stream.setdefault("backoff_max_delay", 300),
+        "multiplier": camera_stream.setdefault("backoff_multiplier", 2),
+        "jitter": camera_stream.setdefault("backoff_jitter", 0.2),
+        "failure_threshold": camera_stream.setdefault("circuit_breaker_failure_threshold", 3),
+    }
+
+
+def probe_backoff_settings_from_config(camera_stream):
+    '''Returns the backoff settings for probing a camera stream, probes are cheap so a camera that comes back is noticed sooner than with the player delay'''
+    backoff_settings = backoff_settings_from_config(camera_stream)
+    backoff_settings["max_delay"] = camera_stream.setdefault("probe_backoff_max_delay", 30)
+    return backoff_settings
+
+
+class Backoff:
+    """Exponential backoff with jitter"""
+    def __init__(self, initial_delay=1, max_delay=300, multiplier=2, jitter=0.2):
+        self.initial_delay = float(initial_delay)
+        self.max_delay = float(max_delay)
+        self.multiplier = float(multiplier)
+        self.jitter = float(jitter)
+        self.attempts = 0
+
+    def next_delay(self):
+        '''Returns the delay for the next attempt and increases the attempt counter'''
+        delay = min(self.max_delay, self.initial_delay * (self.multiplier ** self.attempts))
+        self.attempts = self.attempts + 1
+        #Spread the attempts of streams that failed at the same moment (like all streams behind one NVR)
+        return max(0, delay * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+    def reset(self):
+        self.attempts = 0
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker with closed, open and half_open states
+    closed: attempts are allowed, after failure_threshold consecutive failures the breaker opens
+    open: attempts are refused until the backoff delay has passed, then the breaker becomes half_open
+    half_open: one trial attempt is allowed at a time, success closes the breaker, failure opens it again with a longer delay
+    """
+    def __init__(self, name, initial_delay=1, max_delay=300, multiplier=2, jitter=0.2, failure_threshold=3):
+        self.name = name
+        self.failure_threshold = int(failure_threshold)
+        self.backoff = Backoff(initial_delay, max_delay, multiplier, jitter)
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.open_until = 0
+        #True while the trial attempt of the half_open state did not record its result yet
+        self.trial_in_progress = False
+        self.lock = threading.Lock()
+
+    def _set_state(self, state):
+        if state != self.state:
+            logger.info("CircuitBreaker: %s state changed from %s to %s", self.name, self.state, state)
+            self.state = state
+
+    def _update_state(self):
+        if self.state == OPEN and time.monotonic() >= self.open_until:
+            self.trial_in_progress = False
+            self._set_state(HALF_OPEN)
+
+    def get_state(self):
+        with self.lock:
+            self._update_state()
+            return self.state
+
+    def allow_attempt(self):
+        '''
+        Returns True if an attempt may be made now. In the half_open state only the first caller gets the trial attempt,
+        every caller that gets True has to call record_success or record_failure afterwards
+        '''
+        with self.lock:
+            self._update_state()
+            if self.state == OPEN:
+                return False
+            if self.state == HALF_OPEN:
+                if self.trial_in_progress:
+                    return False
+                self.trial_in_progress = True
+            return True
+
+    def get_retry_delay(self):
+        '''Returns the seconds until the next attempt is allowed, 0 if an attempt is allowed now'''
+        with self.lock:
+            if self.state != OPEN:
+                return 0
+            return max(0, self.open_until - time.monotonic())
+
+    def record_success(self):
+        with self.lock:
+            self.consecutive_failures = 0
+            self.trial_in_progress = False
+            self.backoff.reset()
+            self._set_state(CLOSED)
+
+    def record_failure(self):
+        with self.lock:
+            self.consecutive_failures = self.consecutive_failures + 1
+            self.trial_in_progress = False
+            if self.state == HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                delay = self.backoff.next_delay()
+                self.open_until = time.monotonic() + delay
+                logger.debug("CircuitBreaker: %s %s consecutive failures, next attempt allowed in %.1f seconds", self.name, self.consecutive_failures, delay)
+                self._set_state(OPEN)
@@ -0,0 +1,72 @@
+import logging
+import os
+
+from .config import cfg
+from .metrics import cache_skipped_total
+
+logger = logging.getLogger('l_default')
+
+#Decoder cost of a codec relative to h264, which is hardware decoded on the pi
+codec_cost_factors = {"h264": 1.0, "mjpeg": 1.0, "h265": 3.0, "hevc": 3.0}
+
+#Cost of one 1920x1080 h264 stream, all costs are expressed relative to this
+reference_pixels = 1920 * 1080
+
+
+def estimate_stream_cost(camera_stream_cfg):
+    '''Estimates the decoder cost of one camera stream from its stream_resolution and codec options, 1.0 is one 1080p h264 stream'''
+    stream_resolution = str(camera_stream_cfg.setdefault("stream_resolution", "1920x1080"))
+    codec = str(camera_stream_cfg.setdefault("codec", "h264")).lower()
+    try:
+        width, height = [int(value) for value in stream_resolution.lower().split("x")]
+    except ValueError:
+        logger.error("ResourceBudget: could not parse stream_resolution %s, expected <width>x<height>, assuming 1920x1080", stream_resolution)
+        width, height = 1920, 1080
+    return (width * height) / reference_pixels * codec_cost_factors.get(codec, 1.0)
+
+
+class ResourceBudget:
+    """This class decides if there are enough decoder, gpu memory and cpu resources left to cache a screen"""
+    def __init__(self, supervisor, gpumem_sampler=None):
+        self.supervisor = supervisor
+        self.gpumem_sampler = gpumem_sampler
+        #Total decoder cost of all running players on all displays, 1.0 is one 1080p h264 stream. None means no limit, the decoder limits of the pi models differ too much for a default
+        self.max_decoder_load = cfg['advanced']['max_decoder_load'] if 'max_decoder_load' in cfg["advanced"] else None
+        #Do not cache when less then this fraction of gpu memory is free
+        self.min_free_gpumem_pct = cfg['advanced']['min_free_gpumem_pct_for_caching'] if 'min_free_gpumem_pct_for_caching' in cfg["advanced"] else 0.15
+        #Do not cache when the 1 minute load average per cpu core is higher then this
+        self.max_cpu_load = cfg['advanced']['max_cpu_load_for_caching'] if 'max_cpu_load_for_caching' in cfg["advanced"] else 0.8
+
+    def has_decoder_headroom(self, name, extra_load):
+        '''Returns True if players with extra_load can run next to the players that are already running, without checking gpu memory and cpu'''
+        current_load = self.supervisor.get_running_decoder_cost()
+        if self.max_decoder_load is not None and current_load + extra_load > self.max_decoder_load:
+            logger.debug("ResourceBudget: no decoder headroom for %s, decoder load would be %.2f of max_decoder_load %s", name, current_load + extra_load, self.max_decoder_load)
+            return False
+        return True
+
+    def can_cache(self, name, camera_streams):
+        '''Returns True if the players of camera_streams can be started on top of the players that are already running'''
+        current_load = self.supervisor.get_running_decoder_cost()
+        extra_load = sum([cam_stream.decoder_cost for cam_stream in camera_streams if not cam_stream.is_imageurl()])
+        if self.max_decoder_load is not None and current_load + extra_load > self.max_decoder_load:
+            logger.info("ResourceBudget: %s does not fit, decoder load would be %.2f (running %.2f + cached %.2f) of max_decoder_load %s", name, current_load + extra_load, current_load, extra_load, self.max_decoder_load)
+            cache_skipped_total.inc(reason="decoder_load")
+            return False
+
+        if self.gpumem_sampler is not None:
+            for memtype in self.gpumem_sampler.memtypes:
+                pctfree = self.gpumem_sampler.get_pctfree(memtype)
+                if pctfree is not None and pctfree < self.min_free_gpumem_pct:
+                    logger.info("ResourceBudget: %s does not fit, only %.1f%% free %s gpu memory, need %.1f%%", name, pctfree*100, memtype, self.min_free_gpumem_pct*100)
+                    cache_skipped_total.inc(reason="gpu_memory")
+                    return False
+
+        cpu_load = os.getloadavg()[0] / (os.cpu_count() or 1)
+        if cpu_load > self.max_cpu_load:
+            logger.info("ResourceBudget: %s does not fit, cpu load per core is %.2f, max_cpu_load_for_caching is %s", name, cpu_load, self.max_cpu_load)
+            cache_skipped_total.inc(reason="cpu_load")
+            return False
+
+        logger.debug("ResourceBudget: %s fits, decoder load will be %.2f of max_decoder_load %s", name, current_load + extra_load, self.max_decoder_load)
+        return True
@@ -1,4 +1,19 @@
 import yaml
 #Separate config.py to we can import it to be used as global config, without having it to be passed to every function/class
-with open("conf/general.yml", 'r') as ymlfile:
-    cfg = yaml.load(ymlfile, Loader=yaml.Loader)
\ No newline at end of file
+config_path = "conf/general.yml"
+
+with open(config_path, 'r') as ymlfile:
+    cfg = yaml.load(ymlfile, Loader=yaml.Loader)
+
+
+def reload_config():
+    '''Re-reads general.yml into cfg in place, so every module sees the new values. Returns the names of the advanced options that changed'''
+    with open(config_path, 'r') as ymlfile:
+        new_cfg = yaml.load(ymlfile, Loader=yaml.Loader)
+    if not isinstance(new_cfg, dict) or not isinstance(new_cfg.get("advanced"), dict):
+        raise ValueError(f"{config_path} has no advanced section")
+    old_advanced = cfg.get("advanced", {})
+    changed_options = sorted([option for option in set(old_advanced) | set(new_cfg["advanced"]) if old_advanced.get(option) != new_cfg["advanced"].get(option)])
+    cfg.clear()
+    cfg.update(new_cfg)
+    return changed_options
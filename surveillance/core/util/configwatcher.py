@@ -0,0 +1,130 @@
+import logging
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+import time
+
+logger = logging.getLogger('l_default')
+
+#From linux/inotify.h
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+#Editors either write the file in place or write a new file and move it over the old one
+watch_mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+event_header = struct.Struct("iIII")
+
+
+class ConfigWatcher:
+    """
+    Watches config files for changes with inotify, or by comparing modification times if inotify is not available.
+    Changes are not applied from the watcher thread, the main loop asks for changed files with get_changed_paths
+    """
+    def __init__(self, paths, name="config_watcher", settle_time=0.5, poll_interval=2):
+        self.name = name
+        #Editors can write a file in several steps, a change is only reported once the file has been quiet for settle_time seconds
+        self.settle_time = settle_time
+        #Only used when inotify is not available
+        self.poll_interval = poll_interval
+        self.paths = [os.path.abspath(path) for path in paths]
+        #Watched directory (with symlinks resolved) and file name of every path
+        self.watched = {path: (os.path.realpath(os.path.dirname(path)), os.path.basename(path)) for path in self.paths}
+        #Path: monotonic time of the last change
+        self.changed = {}
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        inotify_fd = self._init_inotify()
+        if inotify_fd is None:
+            logger.info("%s: inotify is not available, checking %s for changes every %s seconds", self.name, self.paths, self.poll_interval)
+            self.thread = threading.Thread(target=self._poll, name=self.name, daemon=True)
+        else:
+            logger.info("%s: watching %s for changes", self.name, self.paths)
+            self.thread = threading.Thread(target=self._watch, args=(inotify_fd,), name=self.name, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def get_changed_paths(self):
+        '''Returns the paths that changed and have been quiet for at least settle_time seconds, every change is returned only once'''
+        now = time.monotonic()
+        with self.lock:
+            settled = [path for path, changed_at in self.changed.items() if now - changed_at >= self.settle_time]
+            for path in settled:
+                del self.changed[path]
+        return settled
+
+    def _mark_changed(self, path):
+        with self.lock:
+            self.changed[path] = time.monotonic()
+
+    def _init_inotify(self):
+        '''Returns an inotify fd watching the directories of all paths, None if inotify can not be used'''
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            inotify_fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except (OSError, AttributeError) as e:
+            logger.debug("%s: inotify_init1 not available %r", self.name, e)
+            return None
+        if inotify_fd < 0:
+            logger.debug("%s: inotify_init1 failed with errno %s", self.name, ctypes.get_errno())
+            return None
+        self.watch_descriptors = {}
+        for directory in set([directory for directory, _ in self.watched.values()]):
+            watch_descriptor = libc.inotify_add_watch(inotify_fd, directory.encode(), watch_mask)
+            if watch_descriptor < 0:
+                logger.debug("%s: inotify_add_watch %s failed with errno %s", self.name, directory, ctypes.get_errno())
+                os.close(inotify_fd)
+                return None
+            self.watch_descriptors[watch_descriptor] = directory
+        return inotify_fd
+
+    def _watch(self, inotify_fd):
+        try:
+            while not self.stop_event.is_set():
+                #Wake up regularly to notice stop()
+                readable, _, _ = select.select([inotify_fd], [], [], 1)
+                if not readable:
+                    continue
+                try:
+                    data = os.read(inotify_fd, 65536)
+                except BlockingIOError:
+                    continue
+                offset = 0
+                while offset + event_header.size <= len(data):
+                    watch_descriptor, mask, cookie, name_length = event_header.unpack_from(data, offset)
+                    name = data[offset + event_header.size:offset + event_header.size + name_length].rstrip(b"\0").decode(errors="replace")
+                    offset = offset + event_header.size + name_length
+                    directory = self.watch_descriptors.get(watch_descriptor)
+                    for path, watched in self.watched.items():
+                        if watched == (directory, name):
+                            logger.debug("%s: %s changed (inotify mask %s)", self.name, path, hex(mask))
+                            self._mark_changed(path)
+        finally:
+            os.close(inotify_fd)
+
+    def _get_signature(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def _poll(self):
+        signatures = {path: self._get_signature(path) for path in self.paths}
+        while not self.stop_event.wait(self.poll_interval):
+            for path in self.paths:
+                signature = self._get_signature(path)
+                if signature != signatures[path]:
+                    signatures[path] = signature
+                    logger.debug("%s: %s changed", self.name, path)
+                    self._mark_changed(path)
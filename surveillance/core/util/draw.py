@@ -24,10 +24,15 @@
 
 
 import logging
+import collections
+import contextlib
 import pygame
 import subprocess
 import os
 import signal
+import time
+
+from .config import cfg
 
 logger = logging.getLogger('l_default')
 
@@ -42,10 +47,21 @@ class Draw:
         self.blacklayer_proc=None
         self.blackbackground_proc=None
         self.disable_pygame=disable_pygame
+        # pngview credits go to https://github.com/AndrewFromMelbourne/raspidmx
+        self.pngview_path=cfg['advanced']['pngview_path'] if 'pngview_path' in cfg["advanced"] else "bin/pngview"
+        #Decoded images, keyed by image path or imageurl
+        self.decoded_images={}
+        #Least recently used cache of decoded and scaled images, keyed by (image path or imageurl, width, height)
+        self.scaled_images=collections.OrderedDict()
+        self.scaled_images_max_size=cfg['advanced']['image_cache_size'] if 'image_cache_size' in cfg["advanced"] else 64
+        #Areas of the surface that changed since they were last presented on the display
+        self.dirty_rects=[]
+        #Greater then 0 while a frame is being drawn, see frame()
+        self.frame_depth=0
 
         if self.disable_pygame:
             logger.debug(
-                f"{self.name} draw.init we are instructed to disable pygame, no imageurls or status backgrounds will be drawn")
+                "%s draw.init we are instructed to disable pygame, no imageurls or status backgrounds will be drawn", self.name)
 
         else:
             pygame.init()
@@ -57,41 +73,99 @@ class Draw:
     def placeholder(self,absposx,absposy,width,height,background_img_path):
         """This function creates a new placeholder"""
         if self.disable_pygame:
-            logger.debug(f"{self.name} Refuse to create placeholder with coordinates: {absposx}, {absposy} and width: {width} height: {height} with image {background_img_path} since we do not have a pygame surface to draw on" )
+            logger.debug("%s Refuse to create placeholder with coordinates: %s, %s and width: %s height: %s with image %s since we do not have a pygame surface to draw on", self.name, absposx, absposy, width, height, background_img_path )
             return None
         else:
-            logger.debug(f"{self.name} Drawing placeholder with coordinates: {absposx}, {absposy} and width: {width} height: {height} with image {background_img_path}" )
-            background_img = pygame.image.load(background_img_path)
-            background_img = pygame.transform.scale(background_img, (width, height))
-            self.surface.blit(background_img, (absposx, absposy))
+            logger.debug("%s Drawing placeholder with coordinates: %s, %s and width: %s height: %s with image %s", self.name, absposx, absposy, width, height, background_img_path )
+            background_img = self._get_scaled_image(background_img_path, width, height)
+            self.dirty_rects.append(self.surface.blit(background_img, (absposx, absposy)))
             self.refresh()
             return background_img
 
 
-    def check_input(self):
+    def _wait_for_events(self, timeout):
+        '''Blocks until at least one input event arrives or timeout seconds have passed, returns the pending events'''
+        events = []
+        if timeout > 0:
+            if pygame.version.vernum[0] >= 2:
+                event = pygame.event.wait(int(timeout * 1000))
+                if event.type != pygame.NOEVENT:
+                    events.append(event)
+            else:
+                #pygame 1.x can not wait with a timeout, check for input every 50ms until the timeout expires
+                end_time = time.monotonic() + timeout
+                while not pygame.event.peek() and time.monotonic() < end_time:
+                    pygame.time.wait(50)
+        events.extend(pygame.event.get())
+        return events
+
+    def _get_scaled_image(self,source,width,height):
+        """Returns the image of source (an image path or an already decoded imageurl) scaled to width and height, from cache if possible"""
+        key = (source, width, height)
+        scaled_image = self.scaled_images.get(key)
+        if scaled_image is not None:
+            self.scaled_images.move_to_end(key)
+            return scaled_image
+        if source not in self.decoded_images:
+            # Only image paths end up here, imageurls are always decoded by draw_image first
+            self.decoded_images[source] = pygame.image.load(source)
+        scaled_image = pygame.transform.scale(self.decoded_images[source], (width, height))
+        self.scaled_images[key] = scaled_image
+        if len(self.scaled_images) > self.scaled_images_max_size:
+            self.scaled_images.popitem(last=False)
+        return scaled_image
+
+    def warm_up(self,images):
+        """Decodes and scales a list of (image path, width, height) in advance, so drawing them later is only a blit"""
+        if self.disable_pygame:
+            return
+        for background_img_path, width, height in images:
+            self._get_scaled_image(background_img_path, int(width), int(height))
+        logger.debug("%s Warmed up image cache with %s images, cache contains %s images", self.name, len(images), len(self.scaled_images))
+
+    def draw_image(self,absposx,absposy,width,height,url,image_file=None):
+        """Draws the image of an imageurl. If image_file is given it is decoded and cached for url, otherwise the cached decoded image of url is used.
+        Returns False if there is no cached decoded image for url"""
+        if self.disable_pygame:
+            logger.debug("%s Refuse to draw image %s since we do not have a pygame surface to draw on", self.name, url )
+            return True
+        if image_file is not None:
+            self.decoded_images[url] = pygame.image.load(image_file)
+            #Scaled versions of the previous image of this url are outdated
+            for key in [key for key in self.scaled_images if key[0] == url]:
+                del self.scaled_images[key]
+        elif url not in self.decoded_images:
+            return False
+        logger.debug("%s Drawing image with coordinates: %s, %s and width: %s height: %s from %s", self.name, absposx, absposy, width, height, url )
+        self.dirty_rects.append(self.surface.blit(self._get_scaled_image(url, width, height), (absposx, absposy)))
+        self.refresh()
+        return True
+
+    def check_input(self, timeout=0):
+        '''Returns the first input event, if timeout is given wait at most timeout seconds for input to arrive'''
         if not self.disable_pygame:
             try:
-                for event in pygame.event.get():
+                for event in self._wait_for_events(timeout):
                     if event.type == pygame.KEYDOWN:
                         if event.key == pygame.K_q or event.key == pygame.K_a or event.key == pygame.K_KP_DIVIDE or event.key == pygame.K_BACKSPACE:
-                            logger.debug(f"{self.name} Keypress 'a' or 'q' or 'backspace' or 'keypad /' detected.")
+                            logger.debug("%s Keypress 'a' or 'q' or 'backspace' or 'keypad /' detected.", self.name)
                             return "end_event"
                         if event.key == pygame.K_n or event.key == pygame.K_SPACE or event.key == pygame.K_KP_PLUS:
-                            logger.debug(f"{self.name} Keypress 'n' or 'space' or 'keypad +' detected.")
+                            logger.debug("%s Keypress 'n' or 'space' or 'keypad +' detected.", self.name)
                             return "next_event"
                         if event.key == pygame.K_r or event.key == pygame.K_KP_PERIOD or event.key == pygame.K_COMMA:
-                            logger.debug(f"{self.name} Keypress 'r' or ',' or 'keypad .' detected")
+                            logger.debug("%s Keypress 'r' or ',' or 'keypad .' detected", self.name)
                             return "resume_rotation"
                         if event.key == pygame.K_p or event.key == pygame.K_KP_MULTIPLY:
-                            logger.debug(f"{self.name} Keypress 'p' or 'keypad *' detected")
+                            logger.debug("%s Keypress 'p' or 'keypad *' detected", self.name)
                             return "pause_rotation"
                         for numeric_key_counter, key in enumerate([pygame.K_F1,pygame.K_F2,pygame.K_F3,pygame.K_F4,pygame.K_F5,pygame.K_F6,pygame.K_F7,pygame.K_F8,pygame.K_F9,pygame.K_F10,pygame.K_F11,pygame.K_F12]):
                             if event.key == key:
-                                logger.debug(f"{self.name} Keypress 'F" + str(numeric_key_counter + 1) + "' detected")
+                                logger.debug("%s Keypress 'F%s' detected", self.name, numeric_key_counter + 1)
                                 return numeric_key_counter
                         for numeric_key_counter, key in enumerate([pygame.K_KP0,pygame.K_KP1,pygame.K_KP2,pygame.K_KP3,pygame.K_KP4,pygame.K_KP5,pygame.K_KP6,pygame.K_KP7,pygame.K_KP8,pygame.K_KP9]):
                             if event.key == key:
-                                logger.debug(f"{self.name} Keypress 'keypad " + str(numeric_key_counter + 1) + "' detected")
+                                logger.debug("%s Keypress 'keypad %s' detected", self.name, numeric_key_counter + 1)
                                 return numeric_key_counter
                         else:
                             return None
@@ -105,33 +179,47 @@ class Draw:
                     elif event.type == pygame.MOUSEBUTTONUP:
                         #For debug set_visible(True)
                         #pygame.mouse.set_visible(True)
-                        logger.debug(f"{self.name} draw: pygame.MOUSEBUTTONUP detected")
+                        logger.debug("%s draw: pygame.MOUSEBUTTONUP detected", self.name)
                         pos = pygame.mouse.get_pos()
                         display_w = pygame.display.Info().current_w
-                        logger.debug(f"{self.name} draw touch/mouse handling: pygame detected display width of " + str(display_w))
+                        logger.debug("%s draw touch/mouse handling: pygame detected display width of %s", self.name, display_w)
                         quarter = display_w / 4
                         firstQuarter = quarter
                         lastQuarter = display_w - quarter
-                        logger.debug(f"{self.name} draw touch/mouse handling: firstQuarter " + str(firstQuarter) + " and lastquarter " + str(lastQuarter))
+                        logger.debug("%s draw touch/mouse handling: firstQuarter %s and lastquarter %s", self.name, firstQuarter, lastQuarter)
                         if pos[0] > lastQuarter:
-                            logger.debug(f"{self.name} draw touch/mouse handling: detected touch/mouse in lastquarter")
+                            logger.debug("%s draw touch/mouse handling: detected touch/mouse in lastquarter", self.name)
                             touchResult = "next_event"
                         elif pos[0] > firstQuarter and pos[0] < lastQuarter:
-                            logger.debug(f"{self.name} draw touch/mouse handling: detected touch/mouse in middle")
+                            logger.debug("%s draw touch/mouse handling: detected touch/mouse in middle", self.name)
                             touchResult = "resume_rotation"
                         else:
-                            logger.debug(f"{self.name} draw touch/mouse handling: detected touch/mouse in first quarter")
+                            logger.debug("%s draw touch/mouse handling: detected touch/mouse in first quarter", self.name)
                             touchResult = "pause_rotation"
                         return touchResult
             except pygame.error as e:
-                logger.debug(f"{self.name} draw: Exception " + repr(e))
+                logger.debug("%s draw: Exception %r", self.name, e)
                 exit(0)
         else:
             logger.debug(
-                f"{self.name} draw: pygame is disabled so this instance will not check input")
+                "%s draw: pygame is disabled so this instance will not check input", self.name)
+            time.sleep(timeout)
+    @contextlib.contextmanager
+    def frame(self):
+        """Collects all drawing done inside this context and presents it on the display once at the end"""
+        self.frame_depth = self.frame_depth + 1
+        try:
+            yield
+        finally:
+            self.frame_depth = self.frame_depth - 1
+            self.refresh()
+
     def refresh(self):
-        if not self.disable_pygame:
-            pygame.display.flip()
+        """Presents the changed areas on the display, this is postponed until the end of the frame if a frame is being drawn"""
+        if not self.disable_pygame and self.frame_depth == 0 and self.dirty_rects:
+            logger.debug("%s draw: presenting %s dirty rectangles", self.name, len(self.dirty_rects))
+            pygame.display.update(self.dirty_rects)
+            self.dirty_rects = []
 
     def destroy(self):
         self.kill_black_layer()
@@ -143,9 +231,8 @@ class Draw:
 
     #Non pygame draw
     def insert_black_layer(self,width,height,layer,displayid):
-        logger.debug(f"{self.name} draw: blank_screen blanking the screen on layer {layer} with width {width} height {height}")
-        # pngview credits go to https://github.com/AndrewFromMelbourne/raspidmx
-        command_line = ["bin/pngview",
+        logger.debug("%s draw: blank_screen blanking the screen on layer %s with width %s height %s", self.name, layer, width, height)
+        command_line = [self.pngview_path,
                        "-b", "0",
                        "-l", str(layer),
                        "-d", str(displayid),
@@ -157,9 +244,8 @@ class Draw:
         self.blacklayer_proc = subprocess.Popen(command_line,shell=False, preexec_fn=os.setsid, stdin=subprocess.PIPE)
 
     def insert_black_background(self,width,height,displayid):
-        logger.debug(f"{self.name} draw: insert_black_background on layer 1000 with width {width} height {height}")
-        # pngview credits go to https://github.com/AndrewFromMelbourne/raspidmx
-        command_line = ["bin/pngview",
+        logger.debug("%s draw: insert_black_background on layer 1000 with width %s height %s", self.name, width, height)
+        command_line = [self.pngview_path,
                        "-b", "0",
                        "-l", str(1000),
                        "-d", str(displayid),
@@ -173,7 +259,7 @@ class Draw:
     def kill_black_layer(self):
         if self.blacklayer_proc is not None:
             logger.debug(
-                f"{self.name} draw: kill_black_layer proc {self.blacklayer_proc.pid}")
+                "%s draw: kill_black_layer proc %s", self.name, self.blacklayer_proc.pid)
             os.killpg(os.getpgid(self.blacklayer_proc.pid), signal.SIGKILL)
             self.blacklayer_proc.wait()
             self.blacklayer_proc = None
@@ -181,7 +267,7 @@ class Draw:
     def kill_black_background(self):
         if self.blackbackground_proc is not None:
             logger.debug(
-                f"{self.name} draw: kill_black_background proc {self.blackbackground_proc.pid}")
+                "%s draw: kill_black_background proc %s", self.name, self.blackbackground_proc.pid)
             os.killpg(os.getpgid(self.blackbackground_proc.pid), signal.SIGKILL)
             self.blackbackground_proc.wait()
             self.blackbackground_proc = None
\ No newline at end of file
@@ -0,0 +1,100 @@
+import logging
+import collections
+import re
+import subprocess
+import time
+
+from .metrics import gpu_memory_free_bytes, gpu_memory_total_bytes, gpu_memory_free_trend_bytes_per_second
+logger = logging.getLogger('l_default')
+
+
+def convert_gpumem_string_to_bytes(inputmem):
+    """ Converts the memory related string returned by command line tools into bytes"""
+    conversions = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    outputmem_bytes = float(re.sub('[A-Za-z]+', '', inputmem)) * conversions.get(re.sub(r'\d+', '', inputmem), 1)
+    logger.debug("convert_gpumem_string_to_bytes: inputmem:%s outputmem_bytes:%s", inputmem, outputmem_bytes)
+    return outputmem_bytes
+
+
+class VcgencmdBackend:
+    """Reads free and total gpu memory with vcgencmd, the totals do not change at runtime and are only read once"""
+    def __init__(self, vcgencmd_path='/usr/bin/vcgencmd'):
+        self.vcgencmd_path = vcgencmd_path
+        #memtype: total bytes
+        self.totals = {}
+
+    def _get_mem(self, keyword):
+        raw = subprocess.check_output([self.vcgencmd_path, 'get_mem', keyword], text=True, timeout=1)
+        regex_result = re.search(keyword + r"=(\d+[a-zA-Z]?)", raw)
+        if regex_result is None:
+            raise ValueError(f"Could not parse {keyword} from {raw.strip()}")
+        return convert_gpumem_string_to_bytes(regex_result.group(1))
+
+    def read(self, memtype):
+        '''Returns (free bytes, total bytes) of memtype (reloc or malloc)'''
+        if memtype not in self.totals:
+            self.totals[memtype] = self._get_mem(memtype + "_total")
+        return self._get_mem(memtype), self.totals[memtype]
+
+
+class StaticBackend:
+    """Returns fixed readings, for testing and benchmarking on machines without vcgencmd"""
+    def __init__(self, readings):
+        #readings is a dict of memtype: (free bytes, total bytes)
+        self.readings = readings
+
+    def read(self, memtype):
+        return self.readings[memtype]
+
+
+class GpuMemSampler:
+    """This class samples free gpu memory and keeps a history of recent readings per memory type"""
+    def __init__(self, backend=None, memtypes=("malloc", "reloc"), history_size=60, pctfree_threshold=0.05):
+        self.backend = backend if backend is not None else VcgencmdBackend()
+        self.memtypes = memtypes
+        self.pctfree_threshold = pctfree_threshold
+        #Ring buffer of (monotonic timestamp, free bytes, total bytes) per memory type
+        self.history = {memtype: collections.deque(maxlen=history_size) for memtype in memtypes}
+
+    def sample(self):
+        '''Takes one reading of every memory type and logs an error when free memory is low'''
+        for memtype in self.memtypes:
+            try:
+                free_bytes, total_bytes = self.backend.read(memtype)
+            except Exception as e:
+                logger.error("Skipping calculating free %s memory because of %r", memtype, e)
+                continue
+            self.history[memtype].append((time.monotonic(), free_bytes, total_bytes))
+            gpu_memory_free_bytes.set(free_bytes, memtype=memtype)
+            gpu_memory_total_bytes.set(total_bytes, memtype=memtype)
+            gpu_memory_free_trend_bytes_per_second.set(self.get_trend(memtype), memtype=memtype)
+            logger.debug("free %s gpu mem value is %s, total available %s gpu mem value is %s", memtype, free_bytes, memtype, total_bytes)
+
+            pctfree = self.get_pctfree(memtype)
+            if pctfree is not None and pctfree < self.pctfree_threshold:
+                logger.error("Less than %s%% free %s gpu memory (%s/%s=%s%%) Streams might fail to start. Consider assigning more memory to gpu in /boot/config.txt with the gpu_mem option", self.pctfree_threshold*100, memtype, free_bytes, total_bytes, pctfree*100)
+
+    def get_current(self, memtype):
+        '''Returns the latest (free bytes, total bytes) of memtype, None if there is no reading'''
+        if not self.history[memtype]:
+            return None
+        _, free_bytes, total_bytes = self.history[memtype][-1]
+        return free_bytes, total_bytes
+
+    def get_pctfree(self, memtype):
+        '''Returns the latest fraction of free memory of memtype, None if there is no reading'''
+        current = self.get_current(memtype)
+        if current is None or current[1] == 0:
+            return None
+        return current[0] / current[1]
+
+    def get_trend(self, memtype):
+        '''Returns how many bytes per second free memory of memtype changed over the history, negative means memory is being used up'''
+        history = self.history[memtype]
+        if len(history) < 2:
+            return 0.0
+        first_time, first_free, _ = history[0]
+        last_time, last_free, _ = history[-1]
+        if last_time == first_time:
+            return 0.0
+        return (last_free - first_free) / (last_time - first_time)
@@ -0,0 +1,161 @@
+import logging
+import base64
+import http.client
+import os
+import ssl
+import threading
+from urllib.parse import urlparse, urljoin
+
+logger = logging.getLogger('l_default')
+
+#One keep-alive connection per scheme/host/port, shared by all imageurls served by the same server
+connections = {}
+connections_lock = threading.Lock()
+
+
+class PooledConnection:
+    """Keeps one http(s) connection open and serializes requests over it"""
+    def __init__(self, scheme, hostname, port):
+        self.scheme = scheme
+        self.hostname = hostname
+        self.port = port
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def _connect(self, timeout):
+        if self.scheme == "https":
+            self.conn = http.client.HTTPSConnection(self.hostname, self.port, timeout=timeout, context=ssl.create_default_context())
+        else:
+            self.conn = http.client.HTTPConnection(self.hostname, self.port, timeout=timeout)
+        logger.debug("PooledConnection: opened new connection to %s://%s:%s", self.scheme, self.hostname, self.port)
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def _request(self, path, headers, timeout):
+        self.conn.timeout = timeout
+        if self.conn.sock is not None:
+            self.conn.sock.settimeout(timeout)
+        self.conn.request("GET", path, headers=headers)
+        response = self.conn.getresponse()
+        #Always read the complete body, otherwise the connection can not be reused
+        body = response.read()
+        if response.will_close:
+            self.close()
+        return response, body
+
+    def get(self, path, headers, timeout):
+        '''Does one GET request and returns the response and its body, reconnects once if a reused connection turned out to be broken'''
+        with self.lock:
+            reused = self.conn is not None
+            try:
+                if not reused:
+                    self._connect(timeout)
+                return self._request(path, headers, timeout)
+            except (http.client.RemoteDisconnected, http.client.BadStatusLine, ConnectionError, BrokenPipeError) as e:
+                self.close()
+                if not reused:
+                    raise
+                logger.debug("PooledConnection: reused connection to %s:%s is broken (%r), reconnecting", self.hostname, self.port, e)
+            except Exception:
+                self.close()
+                raise
+
+            try:
+                self._connect(timeout)
+                return self._request(path, headers, timeout)
+            except Exception:
+                self.close()
+                raise
+
+
+def get_connection(scheme, hostname, port):
+    with connections_lock:
+        connection = connections.get((scheme, hostname, port))
+        if connection is None:
+            connection = PooledConnection(scheme, hostname, port)
+            connections[(scheme, hostname, port)] = connection
+        return connection
+
+
+class ImageFetcher:
+    """Fetches one imageurl with conditional requests, so an unchanged image is not downloaded again"""
+    def __init__(self, url, timeout):
+        self.url = url
+        self.timeout = timeout
+        self.etag = None
+        self.last_modified = None
+        self.file_signature = None
+        #Image data fetched by probe that was not returned by fetch yet
+        self.prefetched = None
+        #Probes run in the health checker thread, fetches in the main thread
+        self.lock = threading.Lock()
+
+    def reset(self):
+        '''Forget the validators, so the next fetch downloads the image again'''
+        self.etag = None
+        self.last_modified = None
+        self.file_signature = None
+
+    def fetch(self):
+        '''Returns (modified, data). If the image did not change since the previous fetch, modified is False and data is None'''
+        with self.lock:
+            if self.prefetched is not None:
+                data = self.prefetched
+                self.prefetched = None
+                return True, data
+            return self._fetch()
+
+    def probe(self):
+        '''Checks that the image can be fetched with a conditional request, raises if not. New image data is kept for the next fetch, so it is not downloaded twice'''
+        with self.lock:
+            modified, data = self._fetch()
+            if modified:
+                self.prefetched = data
+
+    def _fetch(self):
+        parsed = urlparse(self.url)
+        if parsed.scheme == "file":
+            return self._fetch_file(parsed.path)
+        return self._fetch_http(self.url, redirects_left=3)
+
+    def _fetch_file(self, path):
+        stat = os.stat(path)
+        file_signature = (stat.st_mtime_ns, stat.st_size)
+        if file_signature == self.file_signature:
+            return False, None
+        with open(path, 'rb') as image_file:
+            data = image_file.read()
+        self.file_signature = file_signature
+        return True, data
+
+    def _fetch_http(self, url, redirects_left):
+        parsed = urlparse(url)
+        headers = {'User-Agent': 'Mozilla/5.0'}
+        if parsed.username is not None and parsed.password is not None:
+            cred = '%s:%s' % (parsed.username, parsed.password)
+            headers["Authorization"] = "Basic %s" % base64.b64encode(cred.encode()).decode()
+        if self.etag is not None:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified is not None:
+            headers["If-Modified-Since"] = self.last_modified
+
+        port = parsed.port if parsed.port is not None else (443 if parsed.scheme == "https" else 80)
+        path = parsed.path if parsed.path else "/"
+        if parsed.query:
+            path = path + "?" + parsed.query
+
+        response, body = get_connection(parsed.scheme, parsed.hostname, port).get(path, headers, self.timeout)
+
+        if response.status == 304:
+            return False, None
+        if response.status in [301, 302, 303, 307, 308] and response.getheader("Location") and redirects_left > 0:
+            return self._fetch_http(urljoin(url, response.getheader("Location")), redirects_left - 1)
+        if response.status != 200:
+            raise ConnectionError(f"http response code: {response.status}")
+
+        self.etag = response.getheader("ETag")
+        self.last_modified = response.getheader("Last-Modified")
+        return True, body
@@ -0,0 +1,77 @@
+import bisect
+import logging
+
+logger = logging.getLogger('l_default')
+
+
+class LayerAllocator:
+    """
+    Hands out dispmanx layers to the screens of one display and takes them back when a screen is stopped.
+    Every screen gets a slot of 3 layers: the black layer that hides the cached screens while this screen is active, the layer of its streams and the layer of its "showontop" streams.
+    Allocating returns the layer of the streams, the black layer is one lower and the "showontop" streams are one higher
+    """
+    layers_per_slot = 3
+
+    def __init__(self, name, lowest_layer=2000, highest_layer=2000000000):
+        self.name = name
+        #We may not go in the lower layers since that is where pygame and the console buffer resides
+        #If we go to low the latter will be drawn over our videos
+        self.lowest_layer = lowest_layer
+        self.slot_count = (highest_layer - lowest_layer) // self.layers_per_slot
+        #Sorted numbers of the slots in use
+        self.allocated_slots = []
+
+    def _get_layer(self, slot):
+        return self.lowest_layer + slot * self.layers_per_slot + 1
+
+    def _get_slot(self, layer):
+        return (layer - 1 - self.lowest_layer) // self.layers_per_slot
+
+    def get_black_layer(self, layer):
+        return layer - 1
+
+    def _get_free_ranges(self, lowest_slot, highest_slot):
+        '''Returns the (first, last) slots of the ranges of free slots between lowest_slot and highest_slot, from low to high'''
+        free_ranges = []
+        previous_slot = lowest_slot - 1
+        start = bisect.bisect_left(self.allocated_slots, lowest_slot)
+        end = bisect.bisect_right(self.allocated_slots, highest_slot)
+        for slot in self.allocated_slots[start:end] + [highest_slot + 1]:
+            if slot - previous_slot > 1:
+                free_ranges.append((previous_slot + 1, slot - 1))
+            previous_slot = slot
+        return free_ranges
+
+    def allocate(self, lower_than=None, higher_than=None, gap=1):
+        '''
+        Returns the layer of a free slot that is lower than the layer lower_than and higher than the layer higher_than, None if there is no free slot in between.
+        - Without lower_than the highest free slot is used
+        - Without higher_than the slot gap slots below lower_than is used, so gap - 1 slots stay free for later allocations in between
+        - With both, the slot in the middle of the largest free range is used, so there is room for later allocations on both sides
+        '''
+        lowest_slot = 0 if higher_than is None else self._get_slot(higher_than) + 1
+        highest_slot = self.slot_count - 1 if lower_than is None else self._get_slot(lower_than) - 1
+        free_ranges = self._get_free_ranges(lowest_slot, highest_slot)
+        if not free_ranges:
+            logger.debug("%s: no free layers lower than %s and higher than %s", self.name, lower_than, higher_than)
+            return None
+        if lower_than is None:
+            slot = free_ranges[-1][1]
+        elif higher_than is None:
+            first_slot, last_slot = free_ranges[-1]
+            slot = max(first_slot, last_slot - (gap - 1))
+        else:
+            first_slot, last_slot = max(free_ranges, key=lambda free_range: free_range[1] - free_range[0])
+            slot = (first_slot + last_slot) // 2
+        bisect.insort(self.allocated_slots, slot)
+        return self._get_layer(slot)
+
+    def release(self, layer):
+        '''Returns the slot of layer, releasing a layer that is not allocated is ignored'''
+        slot = self._get_slot(layer)
+        index = bisect.bisect_left(self.allocated_slots, slot)
+        if index < len(self.allocated_slots) and self.allocated_slots[index] == slot:
+            del self.allocated_slots[index]
+
+    def release_all(self):
+        self.allocated_slots = []
@@ -0,0 +1,264 @@
+import logging
+import bisect
+import json
+import math
+import os
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+
+logger = logging.getLogger('l_default')
+
+#Latency buckets in seconds, from fast local probes up to the largest sensible probe_timeout
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _format_labels(labelnames, labelvalues, extra=None):
+    pairs = list(zip(labelnames, labelvalues))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in pairs]
+    return "{" + ",".join([f'{name}="{value}"' for name, value in escaped]) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric:
+    """Base class of all metrics, keeps one value per combination of label values"""
+    metric_type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"Metric {self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple([str(labels[labelname]) for labelname in self.labelnames])
+
+    def remove(self, **labels):
+        '''Forgets the value of these labels, for example of a stream that is not configured anymore'''
+        with self.lock:
+            self.values.pop(self._key(labels), None)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        with self.lock:
+            for labelvalues, value in sorted(self.values.items()):
+                lines.extend(self._render_value(labelvalues, value))
+        return lines
+
+    def _render_value(self, labelvalues, value):
+        return [f"{self.name}{_format_labels(self.labelnames, labelvalues)} {_format_value(value)}"]
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "type": self.metric_type,
+                "help": self.documentation,
+                "values": [{"labels": dict(zip(self.labelnames, labelvalues)), "value": self._dict_value(value)} for labelvalues, value in sorted(self.values.items())],
+            }
+
+    def _dict_value(self, value):
+        return value
+
+
+class Counter(Metric):
+    """A value that only goes up, like the number of restarts"""
+    metric_type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that can go up and down, like free gpu memory"""
+    metric_type = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    """Counts observations in cumulative buckets, like probe latencies"""
+    metric_type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=default_buckets):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                #Per bucket counts (not cumulative), an extra bucket for +Inf, the sum and the number of observations
+                state = {"bucket_counts": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0}
+                self.values[key] = state
+            state["bucket_counts"][bisect.bisect_left(self.buckets, value)] += 1
+            state["sum"] = state["sum"] + value
+            state["count"] = state["count"] + 1
+
+    def _render_value(self, labelvalues, state):
+        lines = []
+        cumulative = 0
+        for upper_bound, bucket_count in zip(self.buckets + (math.inf,), state["bucket_counts"]):
+            cumulative = cumulative + bucket_count
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labelvalues, ('le', _format_value(upper_bound)))} {cumulative}")
+        lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labelvalues)} {_format_value(state['sum'])}")
+        lines.append(f"{self.name}_count{_format_labels(self.labelnames, labelvalues)} {state['count']}")
+        return lines
+
+    def _dict_value(self, state):
+        cumulative = 0
+        buckets = {}
+        for upper_bound, bucket_count in zip(self.buckets + (math.inf,), state["bucket_counts"]):
+            cumulative = cumulative + bucket_count
+            buckets[_format_value(upper_bound)] = cumulative
+        return {"buckets": buckets, "sum": state["sum"], "count": state["count"]}
+
+
+class Registry:
+    """Holds all metrics of rpisurv and renders them as prometheus text or as a dict"""
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _register(self, metric):
+        with self.lock:
+            if metric.name in self.metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=default_buckets):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render_prometheus(self):
+        '''Returns all metrics in the prometheus text exposition format'''
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def to_dict(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return {metric.name: metric.to_dict() for metric in metrics}
+
+
+registry = Registry()
+
+#All metrics exported by rpisurv, updated from the modules that know about them
+probe_latency_seconds = registry.histogram("rpisurv_probe_latency_seconds", "Time it took to probe a camera stream", ["stream"])
+stream_connectable = registry.gauge("rpisurv_stream_connectable", "1 if the last probe of the camera stream succeeded, 0 if not", ["stream"])
+player_exits_total = registry.counter("rpisurv_player_exits_total", "Number of times the player of a camera stream exited unexpectedly", ["stream"])
+player_restarts_total = registry.counter("rpisurv_player_restarts_total", "Number of times the player of a camera stream was restarted", ["stream"])
+player_stalls_total = registry.counter("rpisurv_player_stalls_total", "Number of times the player of a camera stream was restarted because its video made no progress", ["stream"])
+players_running = registry.gauge("rpisurv_players_running", "Number of players that are currently running")
+time_to_first_frame_seconds = registry.histogram("rpisurv_time_to_first_frame_seconds", "Time from starting the player of a camera stream until it showed its first picture", ["stream"], buckets=(0.1, 0.25, 0.5, 1, 2, 3, 5, 10, 20, 30))
+cache_skipped_total = registry.counter("rpisurv_cache_skipped_total", "Number of times the resource budget did not allow caching a screen", ["reason"])
+rotation_duration_seconds = registry.histogram("rpisurv_rotation_duration_seconds", "Time it took to rotate to the next screen", ["screen_manager"])
+main_loop_lag_seconds = registry.histogram("rpisurv_main_loop_lag_seconds", "How late scheduled tasks of the main loop ran after their deadline", ["scheduler"])
+gpu_memory_free_bytes = registry.gauge("rpisurv_gpu_memory_free_bytes", "Free gpu memory", ["memtype"])
+gpu_memory_total_bytes = registry.gauge("rpisurv_gpu_memory_total_bytes", "Total gpu memory", ["memtype"])
+gpu_memory_free_trend_bytes_per_second = registry.gauge("rpisurv_gpu_memory_free_trend_bytes_per_second", "How fast free gpu memory changed over the recent readings, negative while memory is being used up", ["memtype"])
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] == "/metrics":
+            body = registry.render_prometheus().encode()
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        elif self.path.split("?")[0] == "/metrics.json":
+            body = json.dumps(registry.to_dict()).encode()
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        #Unix socket clients do not have an address
+        return str(self.client_address[0]) if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        logger.debug("MetricsServer: %s %s", self.address_string(), format % args)
+
+
+class ThreadingTCPMetricsServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class ThreadingUnixMetricsServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class MetricsServer:
+    """Serves the metrics on /metrics (prometheus text) and /metrics.json, on a loopback tcp port or on a unix socket"""
+    def __init__(self, listen_address="127.0.0.1", port=9877, unix_socket=None):
+        self.listen_address = listen_address
+        self.port = port
+        self.unix_socket = unix_socket
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        if self.unix_socket:
+            if os.path.exists(self.unix_socket):
+                #Left behind by a previous run
+                os.unlink(self.unix_socket)
+            self.server = ThreadingUnixMetricsServer(self.unix_socket, MetricsRequestHandler)
+            logger.info("MetricsServer: serving metrics on unix socket %s", self.unix_socket)
+        else:
+            self.server = ThreadingTCPMetricsServer((self.listen_address, self.port), MetricsRequestHandler)
+            logger.info("MetricsServer: serving metrics on http://%s:%s/metrics", self.listen_address, self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever, name="metrics_server", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.server is None:
+            return
+        self.server.shutdown()
+        self.server.server_close()
+        if self.unix_socket and os.path.exists(self.unix_socket):
+            os.unlink(self.unix_socket)
+        self.server = None
+
+
+def dump_json(path):
+    '''Writes all metrics as json to path, the file is replaced atomically so readers never see a partial dump'''
+    data = registry.to_dict()
+    data["timestamp"] = time.time()
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as dump_file:
+        json.dump(data, dump_file)
+    os.replace(tmp_path, path)
+
@@ -0,0 +1,61 @@
+import logging
+import time
+import concurrent.futures
+
+from .config import cfg
+
+logger = logging.getLogger('l_default')
+
+#How many camera streams may be probed at the same time, override with probe_max_concurrency in general.yml
+probe_max_concurrency = cfg['advanced']['probe_max_concurrency'] if 'probe_max_concurrency' in cfg["advanced"] else 8
+#How long a probe result published by the health checker may be used instead of probing again, override with probe_cache_ttl in general.yml
+probe_cache_ttl = cfg['advanced']['probe_cache_ttl'] if 'probe_cache_ttl' in cfg["advanced"] else 30
+
+
+def probe_camera_streams(camera_streams, deadline, name="prober", max_age=None):
+    '''
+    Probes all given camera streams in parallel and returns a dict with camera stream as key and True/False as connectable value
+    The total time this function blocks is bounded by deadline (in seconds), streams that did not answer in time are considered unconnectable
+    If max_age is given, streams with a probe result younger then max_age seconds are not probed again but their cached result is used
+    '''
+    results = {}
+    streams_to_probe = []
+    for cam_stream in camera_streams:
+        cached_result = cam_stream.get_cached_probe_result(max_age) if max_age is not None else None
+        if cached_result is None:
+            streams_to_probe.append(cam_stream)
+        else:
+            results[cam_stream] = cached_result
+
+    if len(streams_to_probe) == 0:
+        logger.debug("Prober: %s used cached results for all %s streams", name, len(camera_streams))
+        return results
+
+    start_time = time.monotonic()
+    max_workers = min(int(probe_max_concurrency), len(streams_to_probe))
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+    futures = {executor.submit(cam_stream.is_connectable): cam_stream for cam_stream in streams_to_probe}
+    done, not_done = concurrent.futures.wait(futures, timeout=deadline)
+    #Do not wait for probes that are still running, they will end by themselves once their own probe_timeout expires
+    #Probes that did not start yet are cancelled by hand, shutdown(cancel_futures=True) needs python 3.9
+    executor.shutdown(wait=False)
+    for future in not_done:
+        future.cancel()
+
+    for future in done:
+        cam_stream = futures[future]
+        try:
+            results[cam_stream] = bool(future.result())
+        except Exception as e:
+            logger.error("Prober: %s probing %s failed with %r", name, cam_stream.name, e)
+            results[cam_stream] = False
+        cam_stream.set_probe_result(results[cam_stream])
+
+    for future in not_done:
+        cam_stream = futures[future]
+        logger.error("Prober: %s %s Not Connectable (probe did not finish within deadline of %s seconds)", name, cam_stream.name, deadline)
+        results[cam_stream] = False
+        cam_stream.set_probe_result(False)
+
+    logger.debug("Prober: %s probed %s of %s streams with %s workers in %.3f seconds", name, len(streams_to_probe), len(camera_streams), max_workers, time.monotonic() - start_time)
+    return results
@@ -0,0 +1,115 @@
+import logging
+import re
+import socket
+import threading
+
+from .config import cfg
+
+logger = logging.getLogger('l_default')
+
+#How many idle connections are kept open per rtsp server, override with rtsp_sessions_per_host in general.yml
+rtsp_sessions_per_host = cfg['advanced']['rtsp_sessions_per_host'] if 'rtsp_sessions_per_host' in cfg["advanced"] else 4
+
+#Idle sessions per host:port, shared by all camera streams behind the same rtsp server (like a NVR)
+sessions = {}
+sessions_lock = threading.Lock()
+
+
+class RTSPSession:
+    """Keeps one tcp connection to an rtsp server open and reuses it for OPTIONS requests, a session is used by one probe at a time"""
+    def __init__(self, hostname, port):
+        self.hostname = hostname
+        self.port = port
+        self.sock = None
+        self.cseq = 0
+
+    def _connect(self, timeout):
+        self.sock = socket.create_connection((self.hostname, self.port), timeout=timeout)
+        logger.debug("RTSPSession: opened new connection to %s:%s", self.hostname, self.port)
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+    def _read_response(self):
+        '''Reads one rtsp response (headers and body, if a Content-Length is given)'''
+        response = b""
+        while b"\r\n\r\n" not in response:
+            data = self.sock.recv(4096)
+            if not data:
+                raise ConnectionError("connection closed by rtsp server")
+            response = response + data
+            if len(response) > 65536:
+                raise ConnectionError("rtsp response headers too long")
+        headers, _, body = response.partition(b"\r\n\r\n")
+        content_length = re.search(rb"(?im)^content-length:\s*(\d+)", headers)
+        if content_length is not None:
+            while len(body) < int(content_length.group(1)):
+                data = self.sock.recv(4096)
+                if not data:
+                    raise ConnectionError("connection closed by rtsp server")
+                body = body + data
+        return headers
+
+    def _send_options(self, url, timeout):
+        self.sock.settimeout(timeout)
+        self.cseq = self.cseq + 1
+        options_cmd = "OPTIONS " + url + " RTSP/1.0\r\nCSeq: " + str(self.cseq) + "\r\nUser-Agent: rpisurv\r\nAccept: application/sdp\r\n\r\n"
+        self.sock.sendall(options_cmd.encode())
+        response = self._read_response()
+        cseq_result = re.search(rb"(?im)^cseq:\s*(\d+)", response)
+        if cseq_result is not None and int(cseq_result.group(1)) != self.cseq:
+            raise ConnectionError(f"rtsp response CSeq {int(cseq_result.group(1))} does not match request CSeq {self.cseq}")
+        return response
+
+    def options(self, url, timeout):
+        '''Sends an OPTIONS request for url and returns the raw response headers, reconnects once if a reused connection turned out to be broken'''
+        reused = self.sock is not None
+        try:
+            if not reused:
+                self._connect(timeout)
+            return self._send_options(url, timeout)
+        except Exception as e:
+            self.close()
+            if not reused or isinstance(e, socket.timeout):
+                raise
+            logger.debug("RTSPSession: reused connection to %s:%s is broken (%r), reconnecting", self.hostname, self.port, e)
+
+        try:
+            self._connect(timeout)
+            return self._send_options(url, timeout)
+        except Exception:
+            self.close()
+            raise
+
+
+def acquire_session(hostname, port):
+    '''Returns an idle session of hostname:port, or a new one if all of them are in use, so probes of streams behind the same server never wait on each other'''
+    with sessions_lock:
+        idle_sessions = sessions.get((hostname, port))
+        if idle_sessions:
+            return idle_sessions.pop()
+    return RTSPSession(hostname, port)
+
+
+def release_session(session):
+    '''Keeps the session for the next probe, up to rtsp_sessions_per_host per server, broken sessions were closed already and reconnect when used'''
+    with sessions_lock:
+        idle_sessions = sessions.setdefault((session.hostname, session.port), [])
+        if len(idle_sessions) < rtsp_sessions_per_host:
+            idle_sessions.append(session)
+            return
+    session.close()
+
+
+def options(hostname, port, url, timeout):
+    '''Sends an rtsp OPTIONS request for url over a pooled session of hostname:port and returns the response headers'''
+    session = acquire_session(hostname, port)
+    try:
+        return session.options(url, timeout)
+    finally:
+        release_session(session)
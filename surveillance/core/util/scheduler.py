@@ -0,0 +1,81 @@
+import logging
+import heapq
+import itertools
+import time
+
+from .metrics import main_loop_lag_seconds
+logger = logging.getLogger('l_default')
+
+
+class Task:
+    """A callback that the scheduler runs once its monotonic deadline has passed"""
+    def __init__(self, name, callback, interval):
+        self.name = name
+        self.callback = callback
+        self.interval = interval
+        self.deadline = None
+        self.cancelled = False
+
+
+class Scheduler:
+    """This class runs timed tasks on monotonic deadlines, it replaces polling on a fixed tick"""
+    def __init__(self, name="scheduler"):
+        self.name = name
+        self.queue = []
+        self.counter = itertools.count()
+
+    def schedule(self, name, callback, delay=0, interval=None):
+        '''
+        Schedules callback to run after delay seconds.
+        If the callback returns a number, the task is run again after that many seconds, otherwise it is run again after interval seconds (if interval is not None)
+        '''
+        task = Task(name, callback, interval)
+        self._push(task, delay)
+        return task
+
+    def reschedule(self, task, delay=0):
+        '''Moves the deadline of an existing task, the old deadline is forgotten'''
+        task.cancelled = False
+        self._push(task, delay)
+
+    def cancel(self, task):
+        task.cancelled = True
+
+    def _push(self, task, delay):
+        self._push_at(task, time.monotonic() + delay)
+
+    def _push_at(self, task, deadline):
+        task.deadline = deadline
+        #Entries with an outdated deadline stay in the heap and are ignored when they are popped
+        heapq.heappush(self.queue, (task.deadline, next(self.counter), task))
+
+    def _pop_stale(self):
+        while self.queue and (self.queue[0][2].cancelled or self.queue[0][0] != self.queue[0][2].deadline):
+            heapq.heappop(self.queue)
+
+    def time_until_next(self):
+        '''Returns the number of seconds until the next task is due, None if nothing is scheduled'''
+        self._pop_stale()
+        if not self.queue:
+            return None
+        return max(0, self.queue[0][0] - time.monotonic())
+
+    def run_due(self):
+        '''Runs all tasks whose deadline has passed'''
+        now = time.monotonic()
+        self._pop_stale()
+        while self.queue and self.queue[0][0] <= now:
+            deadline, _, task = heapq.heappop(self.queue)
+            task.deadline = None
+            lag = time.monotonic() - deadline
+            main_loop_lag_seconds.observe(lag, scheduler=self.name)
+            logger.debug("%s: running task %s %.3f seconds after its deadline", self.name, task.name, lag)
+            next_delay = task.callback()
+            # The callback may have rescheduled or cancelled the task itself
+            if task.deadline is None and not task.cancelled:
+                if next_delay is not None:
+                    self._push(task, next_delay)
+                elif task.interval is not None:
+                    #Count the interval from the previous deadline so that a slow callback does not make the task drift
+                    self._push_at(task, max(deadline + task.interval, time.monotonic()))
+            self._pop_stale()
@@ -1,9 +1,51 @@
-import logging, logging.config
+import logging, logging.config, logging.handlers
+import atexit
+import queue
 import yaml
 import os
 import errno
 
+#All log records of all threads are put on this queue, the handlers of conf/logging.yml run in one listener thread
+log_queue = queue.SimpleQueue()
+listener = None
+#(logger, queue handler, configured handlers) of every logger that logs through the queue
+queued_loggers = []
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Puts records on the queue with their message merged, formatting them for the handlers (time, level, ...) is left to the listener thread"""
+    def prepare(self, record):
+        #The arguments are merged now, they can change before the listener thread gets to the record (like a list that is logged and then modified)
+        #The queue never leaves this process, so the record does not need to be made picklable otherwise
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class LogListener(logging.handlers.QueueListener):
+    """Hands every record to the handlers its logger has in conf/logging.yml"""
+    def __init__(self, log_queue, handlers_by_logger, root_handlers):
+        all_handlers = list(dict.fromkeys(root_handlers + [handler for handlers in handlers_by_logger.values() for handler in handlers]))
+        super().__init__(log_queue, *all_handlers, respect_handler_level=True)
+        self.handlers_by_logger = handlers_by_logger
+        self.root_handlers = root_handlers
+
+    def handle(self, record):
+        for handler in self.handlers_by_logger.get(record.name, self.root_handlers):
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+
 def setup_logging(logfilepath = None,loggername=None):
+    '''Configures logging from conf/logging.yml once, every later call only returns the requested logger'''
+    global listener
+
+    if loggername is None:
+        loggername="l_default"
+
+    if listener is not None:
+        return logging.getLogger(loggername)
+
     #Create default logs directory
     try:
         os.makedirs("logs")
@@ -12,7 +54,7 @@ def setup_logging(logfilepath = None,loggername=None):
             raise
 
     with open("conf/logging.yml", 'r') as ymlfile:
-        logcfg = yaml.load(ymlfile)
+        logcfg = yaml.load(ymlfile, Loader=yaml.Loader)
 
     #Override some contents of config yaml file if needed
     if logfilepath is not None:
@@ -22,18 +64,42 @@ def setup_logging(logfilepath = None,loggername=None):
 
     logging.config.dictConfig(logcfg)
 
-
-    if loggername is None:
-        loggername="l_default"
+    #Move the configured handlers behind the queue, so logging from the hot paths never waits on console or file io
+    queue_handler = DeferredQueueHandler(log_queue)
+    root_logger = logging.getLogger()
+    root_handlers = list(root_logger.handlers)
+    handlers_by_logger = {}
+    for name in logcfg.get('loggers', {}):
+        configured_logger = logging.getLogger(name)
+        handlers_by_logger[name] = list(configured_logger.handlers)
+        for handler in handlers_by_logger[name]:
+            configured_logger.removeHandler(handler)
+        configured_logger.addHandler(queue_handler)
+        queued_loggers.append((configured_logger, queue_handler, handlers_by_logger[name]))
+    for handler in root_handlers:
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(queue_handler)
+    queued_loggers.append((root_logger, queue_handler, root_handlers))
+
+    #Records that no handler would write are dropped before their message is merged
+    queue_handler.setLevel(min([handler.level for handler in root_handlers + [handler for handlers in handlers_by_logger.values() for handler in handlers]], default=logging.NOTSET))
+
+    listener = LogListener(log_queue, handlers_by_logger, root_handlers)
+    listener.start()
+    atexit.register(stop_logging)
 
     return logging.getLogger(loggername)
 
 
-
-
-
-
-
-
-
-
+def stop_logging():
+    '''Writes out all queued records and lets the loggers use their handlers directly again, so logging during exit is not lost'''
+    global listener
+    if listener is None:
+        return
+    for configured_logger, queue_handler, handlers in queued_loggers:
+        for handler in handlers:
+            configured_logger.addHandler(handler)
+        configured_logger.removeHandler(queue_handler)
+    queued_loggers.clear()
+    listener.stop()
+    listener = None
@@ -4,21 +4,20 @@ import time
 import ssl
 import logging
 from uuid import getnode as get_mac
-from .setuplogging import setup_logging
-import multiprocessing
+import threading
 
 logger = logging.getLogger('l_default')
 
 def start_timer():
     start_time = time.time()
-    logger.debug("Start_time is " + str(start_time))
+    logger.debug("Start_time is %s", start_time)
     return start_time
 
 def get_runtime(start_time):
     '''get runtime in seconds'''
     currentime=time.time()
     runtime=int(round((currentime - start_time)))
-    logger.debug("Current time detected is " + str(currentime) + " runtime calculated is " + str(runtime))
+    logger.debug("Current time detected is %s runtime calculated is %s", currentime, runtime)
 
     return runtime
 
@@ -29,21 +28,18 @@ def generate_uniqid():
     m = hashlib.new('sha256')
     m.update(mac)
     mac_hash=m.hexdigest()
-    logger.info("Unique id of this installation is " + mac_hash)
+    logger.info("Unique id of this installation is %s", mac_hash)
     return str(mac_hash)
 
 
 def update_stats(version, uniqid, runtime, update_stats_enabled):
     if update_stats_enabled:
-        # Run stats in separate short lived process to not interfere main program
-        multiprocessing.Process(target=send_stats, args=(version, uniqid, runtime)).start()
+        # Run stats in a separate short lived thread to not interfere main program, it only waits on the network
+        threading.Thread(target=send_stats, args=(version, uniqid, runtime), name="send_stats", daemon=True).start()
     else:
         logger.info("Sending stats is disabled, not sending stats")
 
 def send_stats(version, uniqid, runtime):
-    #Because this is run as a subprocess we need to start logging again
-    logger_send_stats = setup_logging(logfilepath="logs/send_stats.log",loggername="send_stats")
-
     destination="https://statscollector.rpisurv.net"
 
     #SSL options
@@ -70,14 +66,14 @@ def send_stats(version, uniqid, runtime):
     urllib.request.install_opener(opener)
 
     #f = opener.open("http://httpbin.org/cookies")
-    logger_send_stats.debug("Start sending uniqid " + uniqid + ", runtime " + runtime + ", version " + str(version) + " to " + destination + " for updating stats rpisurv community")
+    logger.debug("Start sending uniqid %s, runtime %s, version %s to %s for updating stats rpisurv community", uniqid, runtime, version, destination)
     try:
         response = opener.open(destination, timeout=20)
     except urllib.error.HTTPError as e:
-        logger_send_stats.error("There was an error connecting to the statistics server at " + destination + ". Failed with code " + str(e.code))
+        logger.error("There was an error connecting to the statistics server at %s. Failed with code %s", destination, e.code)
     except Exception as e:
-        logger_send_stats.error("There was an error connecting to the statistics server at " + destination + " , the error is " + repr(e))
+        logger.error("There was an error connecting to the statistics server at %s , the error is %r", destination, e)
     else:
-        logger_send_stats.debug("data sent succesfully, response code " + str(response.getcode()))
+        logger.debug("data sent succesfully, response code %s", response.getcode())
 
 
@@ -0,0 +1,134 @@
+import logging
+import os
+import re
+import socket
+import threading
+
+logger = logging.getLogger('l_default')
+
+#Statistic lines of the rc "stats" command (| name : value unit) and the keys they are returned with
+stats_keys = {
+    "input bytes read": "input_bytes_read",
+    "input bitrate": "input_bitrate_kbps",
+    "demux bytes read": "demux_bytes_read",
+    "video decoded": "decoded_frames",
+    "frames displayed": "displayed_frames",
+    "frames lost": "lost_frames",
+}
+size_units = {"B": 1, "KiB": 1024, "MiB": 1024 * 1024, "GiB": 1024 * 1024 * 1024}
+state_pattern = re.compile(r"\( state (\w+) \)")
+
+
+class PlayerControlError(Exception):
+    """The player could not be reached over its control socket or did not answer in time"""
+
+
+def parse_stats(lines):
+    '''Returns a dict with the numbers of the rc "stats" output, byte counts are converted to bytes'''
+    stats = {}
+    for line in lines:
+        name, separator, value = line.strip("|+ ").partition(":")
+        key = stats_keys.get(name.strip())
+        if not separator or key is None:
+            continue
+        fields = value.split()
+        if not fields:
+            continue
+        try:
+            number = float(fields[0])
+        except ValueError:
+            continue
+        if len(fields) > 1 and fields[1] in size_units:
+            number = number * size_units[fields[1]]
+        stats[key] = number if key == "input_bitrate_kbps" else int(number)
+    return stats
+
+
+def parse_state(lines):
+    '''Returns the playback state of the rc "status" output (playing, paused, ...), "stopped" if no input is playing'''
+    for line in lines:
+        match = state_pattern.search(line)
+        if match:
+            return match.group(1)
+    return "stopped"
+
+
+class VlcRcClient:
+    """
+    Talks to the rc interface of one cvlc player over its unix socket.
+    The rc interface has no framing, every command is followed by an unknown command that vlc echoes back in its error message, which marks the end of the response
+    """
+    def __init__(self, socket_path, name, timeout=1):
+        self.socket_path = socket_path
+        self.name = name
+        self.timeout = timeout
+        self.socket = None
+        self.buffer = b""
+        self.sequence = 0
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.settimeout(self.timeout)
+        self.socket.connect(self.socket_path)
+        self.buffer = b""
+
+    def _read_line(self):
+        while b"\n" not in self.buffer:
+            data = self.socket.recv(4096)
+            if not data:
+                raise ConnectionResetError("player closed the control socket")
+            self.buffer = self.buffer + data
+        line, self.buffer = self.buffer.split(b"\n", 1)
+        #With --rc-fake-tty every response starts with a prompt
+        return line.decode(errors="replace").rstrip("\r").lstrip("> ")
+
+    def command(self, command):
+        '''Sends one rc command and returns the lines of its response, raises PlayerControlError if the player can not be reached'''
+        with self.lock:
+            self.sequence = self.sequence + 1
+            end_marker = f"rpisurv_end_{self.sequence}"
+            try:
+                if self.socket is None:
+                    self._connect()
+                self.socket.sendall(f"{command}\n{end_marker}\n".encode())
+                lines = []
+                while True:
+                    line = self._read_line()
+                    if end_marker in line:
+                        return lines
+                    lines.append(line)
+            except OSError as e:
+                #A half read response would end up in the next command, start over with a new connection
+                self._close()
+                raise PlayerControlError(f"{self.name}: rc command {command} failed {repr(e)}") from e
+
+    def get_state(self):
+        return parse_state(self.command("status"))
+
+    def get_stats(self):
+        '''Returns the decode statistics of the player: decoded_frames, displayed_frames, lost_frames, input_bytes_read, input_bitrate_kbps and demux_bytes_read'''
+        return parse_stats(self.command("stats"))
+
+    def pause(self):
+        #The rc pause command toggles, only send it when playing
+        if self.get_state() == "playing":
+            self.command("pause")
+
+    def resume(self):
+        if self.get_state() == "paused":
+            self.command("pause")
+
+    def _close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+    def close(self):
+        '''Closes the connection and removes the socket the player leaves behind when it is killed'''
+        with self.lock:
+            self._close()
+        try:
+            os.unlink(self.socket_path)
+        except FileNotFoundError:
+            pass
@@ -1,74 +1,104 @@
 #!/usr/bin/python3
+import concurrent.futures
+import logging
+import os
 import re
 import signal
 import subprocess
 import sys
-import time
+import functools
 
 #from core.util import draw
 
-from core.util.config import cfg
+from core.util.config import cfg, config_path, reload_config
+from core.util.configwatcher import ConfigWatcher
 from core.util.setuplogging import setup_logging
 from core.util import stats
+from core.util.scheduler import Scheduler
+from core.util.gpumem import GpuMemSampler, VcgencmdBackend
+from core.util.budget import ResourceBudget
+from core.util import metrics
+from core.PlayerSupervisor import supervisor
 from core.ScreenManager import ScreenManager
+from core.HealthChecker import HealthChecker
+from core.StallWatchdog import StallWatchdog
 
+logger = logging.getLogger('l_default')
 
-def convert_gpumem_string_to_bytes(inputmem):
-    """ Converts the memory related string returned by command line tools into bytes"""
-    conversions = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
-    outputmem_bytes = float(re.sub('[A-Za-z]+', '', inputmem)) * conversions.get(re.sub('\d+', '', inputmem), 1)
-    logger.debug("convert_gpumem_string_to_bytes: inputmem:" + str(inputmem) + " outputmem_bytes:" + str(outputmem_bytes))
-    return outputmem_bytes
 
-
-def log_free_gpumem(logtype="reloc"):
-    '''Returns free gpu memory'''
-    freekeyword=logtype
-    totalkeyword=logtype + "_total"
+def fix_vlc_executed_as_root(vlc_path="/usr/bin/vlc"):
+    logger.debug("Make sure vlc binary can be executed as root")
+    #Only rewrite the binary when it still checks geteuid, so the file is not rewritten on every start
     try:
-        free_raw=subprocess.check_output(['/usr/bin/vcgencmd', 'get_mem', freekeyword], text=True, timeout=1 )
-        total_raw=subprocess.check_output(['/usr/bin/vcgencmd','get_mem', totalkeyword], text=True, timeout=1 )
-    except Exception as e:
-        logger.error(f"Skipping calculating free {freekeyword} memory because of {repr(e)}")
-    else:
-        try:
-            regex_result=re.search(freekeyword + "=(\d+[a-zA-Z]?)", free_raw)
-            free=str(regex_result.group(1))
-            regex_result=re.search(totalkeyword + "=(\d+[a-zA-Z]?)",total_raw)
-            total=str(regex_result.group(1))
-        except AttributeError as parseerror:
-            logger.debug("Got " + str(parseerror) + " error when parsing free memory")
-        else:
-            logger.debug("free " + str(freekeyword) + " gpu mem value is " + str(free))
-            logger.debug("total available " + str(freekeyword) + " gpu mem value is " + str(total))
-
-        free_bytes=convert_gpumem_string_to_bytes(free)
-        total_bytes=convert_gpumem_string_to_bytes(total)
-        pctfree=free_bytes/total_bytes
+        with open(vlc_path, 'rb') as vlc_binary:
+            if b"geteuid" not in vlc_binary.read():
+                logger.debug("%s can already be executed as root", vlc_path)
+                return
+    except OSError as e:
+        logger.debug("Could not read %s %r", vlc_path, e)
+    subprocess.check_call(["/bin/sed", "-i", "s/geteuid/getppid/", vlc_path])
 
-        pctfree_threshold=0.05
-        if pctfree < pctfree_threshold:
-            logger.error("Less than " + str(pctfree_threshold*100) + "% free" + str(freekeyword) + " gpu memory (" + str(free_bytes) + "/" + str(total_bytes) + "=" + str(pctfree*100) + "%" + ") Streams might fail to start. Consider assigning more memory to gpu in /boot/config.txt with the gpu_mem option")
-            return 1
-        return 0
+def handle_stats():
+    # Updating stats for rpisurv community, scheduled every hour
+    stats.update_stats(version, uniqid, str(stats.get_runtime(start_time)), update_stats_enabled)
 
+def handle_memory_check():
+    #Check free mem and log warning
+    gpumem_sampler.sample()
 
-def fix_vlc_executed_as_root():
-    logger.debug("Make sure vlc binary can be executed as root")
-    subprocess.check_call(["/bin/sed -i 's/geteuid/getppid/' /usr/bin/vlc" ], shell=True)
+def handle_metrics_dump():
+    #Periodic json dump of all metrics, for tools that can not scrape the metrics endpoint
+    try:
+        metrics.dump_json(metrics_json_dump_file)
+    except OSError as e:
+        logger.error("Could not write metrics to %s %r", metrics_json_dump_file, e)
+
+def handle_config_reload():
+    #Apply config files that changed, only the screens and camera streams that changed are touched
+    for changed_path in config_watcher.get_changed_paths():
+        if changed_path == os.path.abspath(config_path):
+            try:
+                changed_options = reload_config()
+            except Exception as e:
+                logger.error("Could not reload %s, keep running with the previous config (%r)", config_path, e)
+                continue
+            if changed_options:
+                logger.info("Changed options in %s: %s. Options that are read at startup only take effect after restarting rpisurv", config_path, ", ".join(changed_options))
+        for screenmanager in screenmanagers:
+            if changed_path == os.path.abspath(screenmanager.get_config_path()):
+                logger.info("MAIN %s: %s changed, reloading", screenmanager.name, changed_path)
+                added_camera_streams, removed_camera_streams = screenmanager.reload_config()
+                health_checker.unregister(removed_camera_streams)
+                health_checker.register(added_camera_streams)
+                for cam_stream in removed_camera_streams:
+                    metrics.stream_connectable.remove(stream=cam_stream.name)
+                #The duration or disable_autorotation of the active screen may have changed
+                for rotation_task in rotation_tasks:
+                    scheduler.reschedule(rotation_task)
+
+def handle_rotation(screenmanager):
+    '''Rotates to the next screen once the active screen has been shown for its duration, returns the seconds until the next check is needed'''
+    if screenmanager.get_disable_autorotation():
+        #Do not reschedule, the rotation task is rescheduled on every input event (like resume_rotation)
+        return None
+    if screenmanager.get_active_screen_remaining_time() <= 0:
+        screenmanager.rotate_next()
+        #In case the screen in cache had disconnected or reconnectable streams, check and update it once it becomes active
+        logger.debug("MAIN %s: after rotate_next start update_active_screen", screenmanager.name)
+        screenmanager.update_active_screen()
+    return max(0, screenmanager.get_active_screen_remaining_time())
 
-def handle_stats( stats_counter ):
-    stats_counter_thresh=3600
-    # Updating stats for rpisurv community every 1800 loops
-    if stats_counter % stats_counter_thresh == 0:
-        stats.update_stats(version, uniqid, str(stats.get_runtime(start_time)), update_stats_enabled)
+def handle_status_check(screenmanager):
+    #Only update the screen/check connectable cameras every interval_check_status seconds
+    logger.debug("MAIN %s: regular start update_active_screen (every %s seconds)", screenmanager.name, interval_check_status)
+    screenmanager.update_active_screen()
 
-def parse_tvservice():
+def parse_tvservice(tvservice_path="/usr/bin/tvservice"):
     autodetected_displays=[]
     try:
-        tvserviceresult_l = subprocess.check_output(['/usr/bin/tvservice', '-l'], text=True )
+        tvserviceresult_l = subprocess.check_output([tvservice_path, '-l'], text=True )
     except OSError as e:
-        logger.error("Can not find or run the /usr/bin/tvservice binary to autodetect attached displays")
+        logger.error("Can not find or run the %s binary to autodetect attached displays", tvservice_path)
         use_fallback_config = True
     else:
         use_fallback_config = False
@@ -76,16 +106,17 @@ def parse_tvservice():
         if len(regex_results) == 0:
             use_fallback_config = True
         else:
-            for regex_result in regex_results:
+            #Get more details of all displays at once
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(regex_results), thread_name_prefix="tvservice") as executor:
+                tvserviceresults_detail_display = list(executor.map(lambda regex_result: subprocess.check_output([tvservice_path, '-snv', regex_result[0]], text=True), regex_results))
+            for regex_result, tvserviceresult_detail_display in zip(regex_results, tvserviceresults_detail_display):
                 autodetected_display = {}
                 autodetected_display["display_number"]=regex_result[0]
                 autodetected_display["hdmi"]=regex_result[1]
                 autodetected_displays.append(autodetected_display)
-                #Get more details
-                tvserviceresult_detail_display = subprocess.check_output(['/usr/bin/tvservice', '-snv', autodetected_display["display_number"]], text=True)
                 regex_result = re.search("state .*, (\d+)x(\d+) .*", tvserviceresult_detail_display)
                 if regex_result is None:
-                    logger.error(f"Could not retrieve resolution for display {autodetected_display['display_number']}")
+                    logger.error("Could not retrieve resolution for display %s", autodetected_display['display_number'])
                     use_fallback_config = True
                     break
                 autodetected_display["resolution"] = {}
@@ -93,7 +124,7 @@ def parse_tvservice():
                 autodetected_display["resolution"]["height"] = regex_result.group(2)
                 regex_result = re.search("device_name=(.*)", tvserviceresult_detail_display)
                 if regex_result is None:
-                    logger.error(f"Could not retrieve devicename for display {autodetected_display['display_number']}")
+                    logger.error("Could not retrieve devicename for display %s", autodetected_display['display_number'])
                     use_fallback_config = True
                     break
                 autodetected_display["device_name"] = regex_result.group(1)
@@ -101,44 +132,55 @@ def parse_tvservice():
     if use_fallback_config:
         fallback_displays = cfg['fallbacks']['displays']
 
-        logger.error(f"Could not autodetect displays, use values from fallback config")
+        logger.error("Could not autodetect displays, use values from fallback config")
         for display in fallback_displays:
-            logger.error(f"Using config display {display['device_name']} at HDMI {display['hdmi']} with display number {display['display_number']} {display['resolution']['width']} x {display['resolution']['height']}")
+            logger.error("Using config display %s at HDMI %s with display number %s %s x %s", display['device_name'], display['hdmi'], display['display_number'], display['resolution']['width'], display['resolution']['height'])
 
         displays = fallback_displays
     else:
         for display in autodetected_displays:
-            logger.info(f"Auto detected display {display['device_name']} at HDMI {display['hdmi']} with display number {display['display_number']} {display['resolution']['width']} x {display['resolution']['height']}")
+            logger.info("Auto detected display %s at HDMI %s with display number %s %s x %s", display['device_name'], display['hdmi'], display['display_number'], display['resolution']['width'], display['resolution']['height'])
 
         displays = autodetected_displays
 
     return displays
 
-def handle_input(drawinstance):
-    event = drawinstance.check_input()
+def handle_input(event):
     for screenmanager in screenmanagers:
         if event == "next_event":
-            logger.debug(f"MAIN: force next screen input event detected, start rotate_next event")
+            logger.debug("MAIN: force next screen input event detected, start rotate_next event")
             screenmanager.rotate_next()
             # This can do no harm, but is not really needed in this case, since the screen was already updated in cache and we merely swap it on screen as is.
             # We do not check update_connectable_cameras this time as this is too slow for the user to wait for and we live with the fact if there is one unavailable or one became available since cache time,
             # it is not updated until next regular update of the screen
         if event == "end_event":
-            logger.debug(f"MAIN: quit input event detected")
+            logger.debug("MAIN: quit input event detected")
+            health_checker.stop()
+            stall_watchdog.stop()
+            metrics_server.stop()
+            config_watcher.stop()
             screenmanager.destroy()
             sys.exit(0)
         if event == "resume_rotation":
-            logger.debug(f"MAIN: resume_rotation event detected")
+            logger.debug("MAIN: resume_rotation event detected")
             screenmanager.disable_autorotation = False
         if event == "pause_rotation":
-            logger.debug(f"MAIN: pause_rotation event detected")
+            logger.debug("MAIN: pause_rotation event detected")
             screenmanager.disable_autorotation = True
         if event in range(0, 11):
-            logger.debug(f"MAIN: force screen:{event} request detected")
+            logger.debug("MAIN: force screen:%s request detected", event)
             screenmanager.force_show_screen(event)
 
+    #Input can reset the active timer or resume rotation, let the rotation tasks recalculate their deadline
+    for rotation_task in rotation_tasks:
+        scheduler.reschedule(rotation_task)
+
 
 def sigterm_handler(_signo, _stack_frame):
+    health_checker.stop()
+    stall_watchdog.stop()
+    metrics_server.stop()
+    config_watcher.stop()
     for screenmanager in screenmanagers:
         screenmanager.destroy()
     sys.exit(0)
@@ -155,29 +197,60 @@ if __name__ == '__main__':
     fullversion_for_installer = "3.0.0"
 
     version = fullversion_for_installer
-    logger.info("Starting rpisurv " + version)
-
-    fix_vlc_executed_as_root()
+    logger.info("Starting rpisurv %s", version)
 
     #Read in config
+    vlc_path=cfg['advanced']['vlc_path'] if 'vlc_path' in cfg["advanced"] else "/usr/bin/vlc" #Override of vlc_path if set
+    tvservice_path=cfg['advanced']['tvservice_path'] if 'tvservice_path' in cfg["advanced"] else "/usr/bin/tvservice" #Override of tvservice_path if set
+    vcgencmd_path=cfg['advanced']['vcgencmd_path'] if 'vcgencmd_path' in cfg["advanced"] else "/usr/bin/vcgencmd" #Override of vcgencmd_path if set
     update_stats_enabled=cfg['advanced']['update_stats'] if 'update_stats' in cfg["advanced"] else False #Override of update_stats if set
     interval_check_status=cfg['advanced']['interval_check_status'] if 'interval_check_status' in cfg["advanced"] else 19 #Override of interval_check_status if set
     memory_usage_check=cfg['advanced']['memory_usage_check'] if 'memory_usage_check' in cfg["advanced"] else True #Override of memory_usage_check if set
+    memory_usage_check_interval=cfg['advanced']['memory_usage_check_interval'] if 'memory_usage_check_interval' in cfg["advanced"] else 10 #Override of memory_usage_check_interval if set
     enable_opportunistic_caching_next_screen=cfg['advanced']['enable_opportunistic_caching_next_screen'] if 'enable_opportunistic_caching_next_screen' in cfg["advanced"] else True #Override of enable_opportunistic_caching_next_screen if set
+    metrics_enabled=cfg['advanced']['metrics_enabled'] if 'metrics_enabled' in cfg["advanced"] else False #Override of metrics_enabled if set
+    metrics_listen_address=cfg['advanced']['metrics_listen_address'] if 'metrics_listen_address' in cfg["advanced"] else "127.0.0.1" #Override of metrics_listen_address if set
+    metrics_port=cfg['advanced']['metrics_port'] if 'metrics_port' in cfg["advanced"] else 9877 #Override of metrics_port if set
+    metrics_unix_socket=cfg['advanced']['metrics_unix_socket'] if 'metrics_unix_socket' in cfg["advanced"] else None #Override of metrics_unix_socket if set
+    metrics_json_dump_file=cfg['advanced']['metrics_json_dump_file'] if 'metrics_json_dump_file' in cfg["advanced"] else None #Override of metrics_json_dump_file if set
+    metrics_json_dump_interval=cfg['advanced']['metrics_json_dump_interval'] if 'metrics_json_dump_interval' in cfg["advanced"] else 60 #Override of metrics_json_dump_interval if set
+    config_reload=cfg['advanced']['config_reload'] if 'config_reload' in cfg["advanced"] else True #Override of config_reload if set
+    config_reload_check_interval=cfg['advanced']['config_reload_check_interval'] if 'config_reload_check_interval' in cfg["advanced"] else 1 #Override of config_reload_check_interval if set
+    fast_startup=cfg['advanced']['fast_startup'] if 'fast_startup' in cfg["advanced"] else True #Override of fast_startup if set
+
+    #Local metrics endpoint, metrics are always collected but only served when enabled
+    metrics_server = metrics.MetricsServer(metrics_listen_address, int(metrics_port), metrics_unix_socket)
+    if metrics_enabled:
+        try:
+            metrics_server.start()
+        except OSError as e:
+            logger.error("Could not start metrics server %r", e)
+
 
+    fix_vlc_executed_as_root(vlc_path)
 
     #Detect displays attached and their config
-    displays=parse_tvservice()
+    displays=parse_tvservice(tvservice_path)
+
+    #Samples free gpu memory and keeps recent readings
+    gpumem_sampler = GpuMemSampler(VcgencmdBackend(vcgencmd_path))
 
     #Timers for statistics
     uniqid = stats.generate_uniqid()
     start_time = stats.start_timer()
-    loop_counter=0
 
-    if len(displays) > 1:
-        logger.info("Globally force disable caching screen if more than one display is detected, since this takes too much resources for the pi on dual hdmi screen")
+    #Caching the next screen is decided per rotation, depending on the resources used by all displays together
+    resource_budget = ResourceBudget(supervisor, gpumem_sampler if memory_usage_check else None)
+
+    if len(displays) > 1 and resource_budget.max_decoder_load is None:
+        #Without a decoder limit the budget can not tell if the pi decodes the streams of both displays and their cached screens
+        logger.info("Globally force disable caching screen if more than one display is detected and max_decoder_load is not set, since this takes too much resources for the pi on dual hdmi screen")
         enable_opportunistic_caching_next_screen = False
 
+    #Probe camera streams in the background, rotation and redraw use the published results instead of waiting on the network
+    #Every screenmanager registers the camera streams of a screen once the screen is instantiated
+    health_checker = HealthChecker()
+
     screenmanagers=[]
     count=0
     for display in displays:
@@ -185,45 +258,63 @@ if __name__ == '__main__':
         # Only one screenmanager may be the master of the pygame in the case we have multiple instances. choose the first screen detected
         if count == 0:
             disable_pygame = False
-        screen_manager=ScreenManager(f'screen_manager_{count}', display, enable_opportunistic_caching_next_screen, disable_pygame)
+        screen_manager=ScreenManager(f'screen_manager_{count}', display, enable_opportunistic_caching_next_screen, disable_pygame, resource_budget, health_checker)
         screenmanagers.append(screen_manager)
         count= count + 1
-        
-        
-    #First rotate to init first run
-    for screenmanager in screenmanagers:
-        screenmanager.rotate_next()
-        logger.debug(f"MAIN {screenmanager.name}: bootstrap update_active_screen")
-        screenmanager.update_active_screen()
-
 
-    while True:
-        #Handle stats
-        handle_stats(loop_counter)
-        loop_counter += 1
+    health_checker.start()
 
-        #Handle keypresses
-        #Only the first screenmanager is the controller of pygame
-        handle_input(screenmanagers[0].get_drawinstance())
+    #Restart players whose video froze while the process keeps running
+    stall_watchdog = StallWatchdog(supervisor)
+    stall_watchdog.start()
 
-        #Check free mem and log warning
-        if memory_usage_check:
-            log_free_gpumem(logtype="malloc")
-            log_free_gpumem(logtype="reloc")
+    #Watch general.yml and the display configs, changes are applied from the main loop
+    config_watcher = ConfigWatcher([config_path] + [screenmanager.get_config_path() for screenmanager in screenmanagers])
+    if config_reload:
+        config_watcher.start()
 
-        #Check if we need to rotate:
+    if fast_startup:
+        #Start the first screen of every display without waiting on probes, all its streams are started at once.
+        #The next screens are only probed and cached after that, and the first status check removes streams that are not connectable
+        for screenmanager in screenmanagers:
+            logger.debug("MAIN %s: bootstrap show first screen", screenmanager.name)
+            screenmanager.show_first_screen()
         for screenmanager in screenmanagers:
-            if not screenmanager.get_disable_autorotation():
-                if screenmanager.get_active_screen_run_time() >= screenmanager.get_active_screen_duration():
-                    screenmanager.rotate_next()
-                    #In case the screen in cache had disconnected or reconnectable streams, check and update it once it becomes active
-                    logger.debug(f"MAIN {screenmanager.name}: after rotate_next start update_active_screen")
-                    screenmanager.update_active_screen()
-
-            #Only update the screen/check connectable cameras every interval_check_status seconds
-            if loop_counter % int(interval_check_status) == 0:
-                # Only try to redraw the screen when disable_probing_for_all_streams option is false, but keep the loop
-                logger.debug(f"MAIN {screenmanager.name}: regular start update_active_screen (every " + str(interval_check_status) + " seconds since start of rpisurv)")
-                screenmanager.update_active_screen()
-
-        time.sleep(1)
+            screenmanager.rotate_next()
+    else:
+        #First rotate to init first run
+        for screenmanager in screenmanagers:
+            screenmanager.rotate_next()
+            logger.debug("MAIN %s: bootstrap update_active_screen", screenmanager.name)
+            screenmanager.update_active_screen()
+
+
+    #Every recurring job is a task on a monotonic deadline, between deadlines the main loop blocks on input
+    scheduler = Scheduler("MAIN scheduler")
+    scheduler.schedule("stats", handle_stats, delay=0, interval=3600)
+    if memory_usage_check:
+        scheduler.schedule("memory_check", handle_memory_check, delay=0, interval=memory_usage_check_interval)
+    if config_reload:
+        scheduler.schedule("config_reload", handle_config_reload, delay=config_reload_check_interval, interval=config_reload_check_interval)
+    if metrics_json_dump_file:
+        scheduler.schedule("metrics_dump", handle_metrics_dump, delay=0, interval=metrics_json_dump_interval)
+    rotation_tasks = []
+    for screenmanager in screenmanagers:
+        rotation_tasks.append(scheduler.schedule(f"rotation_{screenmanager.name}", functools.partial(handle_rotation, screenmanager)))
+        #With fast_startup the first screen was started without probing, check it right away with the probe results of the health checker
+        scheduler.schedule(f"status_check_{screenmanager.name}", functools.partial(handle_status_check, screenmanager), delay=0 if fast_startup else int(interval_check_status), interval=int(interval_check_status))
+
+    #Only the first screenmanager is the controller of pygame
+    main_drawinstance = screenmanagers[0].get_drawinstance()
+    #Never block longer then this on input, so signals are still handled in time
+    max_input_wait = 1
+
+    while True:
+        #Handle keypresses as soon as they arrive, or wait until the next task is due
+        time_until_next_task = scheduler.time_until_next()
+        input_timeout = max_input_wait if time_until_next_task is None else min(time_until_next_task, max_input_wait)
+        event = main_drawinstance.check_input(timeout=input_timeout)
+        if event is not None:
+            handle_input(event)
+
+        scheduler.run_due()